@@ -0,0 +1,341 @@
+"""
+Runs uploads through Django's multipart parser and the upload handlers
+against local S3 and ClamAV stand-ins, reporting throughput, request
+latency, S3 requests and peak memory for each file size and concurrency.
+
+    $ python benchmarks/run.py --sizes 1,32,256 --concurrency 1,8 --output results.json
+    $ python benchmarks/run.py --compare results.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from stubs import start_clamav_stub, start_s3_stub  # noqa: E402
+
+
+MB = 1024 * 1024
+BOUNDARY = "benchmarkboundary"
+HANDLERS = {
+    "sync": [
+        "django_chunk_upload_handlers.clam_av.ClamAVFileUploadHandler",
+        "django_chunk_upload_handlers.s3.S3FileUploadHandler",
+    ],
+    "async": [
+        "django_chunk_upload_handlers.async_handlers.AsyncClamAVFileUploadHandler",
+        "django_chunk_upload_handlers.async_handlers.AsyncS3FileUploadHandler",
+    ],
+}
+
+
+class MultipartBody(io.RawIOBase):
+    # A multipart request with one file of the given size, generated as it
+    # is read so that building requests does not skew memory use
+    pattern = os.urandom(MB)
+
+    def __init__(self, size):
+        super().__init__()
+        self.header = (
+            f"--{BOUNDARY}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="benchmark.bin"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        self.footer = f"\r\n--{BOUNDARY}--\r\n".encode()
+        self.size = size
+        self.length = len(self.header) + size + len(self.footer)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        written = 0
+        view = memoryview(buffer)
+
+        while written < len(view) and self.position < self.length:
+            if self.position < len(self.header):
+                source = self.header
+                offset = self.position
+            elif self.position < len(self.header) + self.size:
+                offset = (self.position - len(self.header)) % len(self.pattern)
+                remaining = len(self.header) + self.size - self.position
+                source = memoryview(self.pattern)[:offset + remaining]
+            else:
+                source = self.footer
+                offset = self.position - len(self.header) - self.size
+
+            size = min(len(view) - written, len(source) - offset)
+            view[written:written + size] = source[offset:offset + size]
+            written += size
+            self.position += size
+
+        return written
+
+
+class MemorySampler:
+    # Anonymous memory is reported apart from the total, as file backed pages
+    # such as spooled parts can be dropped by the kernel rather than
+    # counting towards running out of memory
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.peak_anonymous = 0
+        self._stop = threading.Event()
+
+    def get_rss(self):
+        try:
+            with open("/proc/self/statm") as statm:
+                fields = statm.read().split()
+        except OSError:
+            import resource
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            return rss, rss
+
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        resident, shared = int(fields[1]), int(fields[2])
+        return resident * page_size, (resident - shared) * page_size
+
+    def sample(self):
+        rss, anonymous = self.get_rss()
+        self.peak = max(self.peak, rss)
+        self.peak_anonymous = max(self.peak_anonymous, anonymous)
+
+    def run(self):
+        while not self._stop.is_set():
+            self.sample()
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self.thread.join()
+
+
+def configure_django(s3_stub, clamav_stub, database, extra_settings):
+    # The package reads its settings on import, so this is done before it
+    # is imported
+    import django
+    from django.conf import settings
+
+    os.environ.setdefault("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+
+    settings.configure(
+        DEBUG=False,
+        DATABASES={
+            "default": {
+                "ENGINE": "django.db.backends.sqlite3",
+                "NAME": database,
+                "OPTIONS": {"timeout": 30},
+            },
+        },
+        INSTALLED_APPS=["django_chunk_upload_handlers"],
+        USE_TZ=True,
+        DATA_UPLOAD_MAX_MEMORY_SIZE=None,
+        CLAM_AV_USERNAME="benchmark",
+        CLAM_AV_PASSWORD="benchmark",
+        CLAM_AV_DOMAIN=clamav_stub.url.split("://")[1],
+        CLAM_USE_HTTP=True,
+        AWS_ACCESS_KEY_ID="benchmark",
+        AWS_SECRET_ACCESS_KEY="benchmark",
+        AWS_STORAGE_BUCKET_NAME="benchmark",
+        AWS_S3_ENDPOINT_URL=s3_stub.url,
+        CHUNK_UPLOADER_AWS_REGION="eu-west-2",
+        CHUNK_UPLOADER_PART_ATTEMPTS=5,
+        CHUNK_UPLOADER_RETRY_BASE_DELAY=0.05,
+        DEFAULT_FILE_STORAGE="storages.backends.s3boto3.S3Boto3Storage",
+        **extra_settings,
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    call_command("migrate", verbosity=0)
+
+
+def upload(handler_classes, size):
+    from django.http.multipartparser import MultiPartParser
+    from django.utils.module_loading import import_string
+
+    body = MultipartBody(size)
+    handlers = [import_string(handler_class)() for handler_class in handler_classes]
+    meta = {
+        "CONTENT_TYPE": f"multipart/form-data; boundary={BOUNDARY}",
+        "CONTENT_LENGTH": str(body.length),
+    }
+
+    started_at = time.perf_counter()
+    try:
+        _, files = MultiPartParser(meta, io.BufferedReader(body, MB), handlers, "utf-8").parse()
+        error = None if "file" in files else "No file returned"
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"
+
+    return time.perf_counter() - started_at, error
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_scenario(handler_classes, size, concurrency, requests, s3_stub, clamav_stub):
+    s3_stub.reset_counts()
+    clamav_stub.reset_counts()
+
+    with MemorySampler() as memory:
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            outcomes = list(executor.map(
+                lambda _: upload(handler_classes, size),
+                range(requests),
+            ))
+        elapsed = time.perf_counter() - started_at
+
+    latencies = [latency for latency, _ in outcomes]
+    errors = [error for _, error in outcomes if error]
+
+    return {
+        "size_mb": size / MB,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "seconds": round(elapsed, 4),
+        "mb_per_s": round((requests - len(errors)) * size / MB / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "s3_requests": dict(s3_stub.requests),
+        "clamav_requests": sum(clamav_stub.requests.values()),
+        "peak_rss_mb": round(memory.peak / MB, 1),
+        "peak_anonymous_mb": round(memory.peak_anonymous / MB, 1),
+    }
+
+
+def get_environment(args):
+    try:
+        revision = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=BASE_DIR, text=True, stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {
+        "revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "handlers": args.handlers,
+        "s3_latency_ms": args.s3_latency,
+        "s3_error_rate": args.s3_error_rate,
+        "clamav_latency_ms": args.clamav_latency,
+        "clamav_error_rate": args.clamav_error_rate,
+        "max_in_flight_mb": args.max_in_flight_mb,
+        "spool_max_mb": args.spool_max_mb,
+    }
+
+
+def compare(results, baseline):
+    # Matches scenarios on size and concurrency and prints the change
+    previous = {
+        (result["size_mb"], result["concurrency"]): result
+        for result in baseline["results"]
+    }
+
+    for result in results:
+        before = previous.get((result["size_mb"], result["concurrency"]))
+        if before is None:
+            continue
+
+        changes = []
+        for metric in ("mb_per_s", "p50_ms", "p99_ms", "peak_rss_mb", "peak_anonymous_mb"):
+            if before[metric]:
+                change = (result[metric] - before[metric]) / before[metric] * 100
+                changes.append(f"{metric} {change:+.1f}%")
+
+        print(f"{result['size_mb']:>8g}MB x{result['concurrency']:<3} " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1,16,128", help="File sizes in MB")
+    parser.add_argument("--concurrency", default="1,4,16", help="Concurrent uploads")
+    parser.add_argument("--requests", type=int, default=0, help="Uploads per scenario, twice the concurrency if not set")
+    parser.add_argument("--handlers", choices=sorted(HANDLERS), default="sync")
+    parser.add_argument("--s3-latency", type=float, default=0, help="Milliseconds added to each S3 request")
+    parser.add_argument("--s3-error-rate", type=float, default=0, help="Fraction of S3 requests answered with SlowDown")
+    parser.add_argument("--clamav-latency", type=float, default=0, help="Milliseconds added to each scan")
+    parser.add_argument("--clamav-error-rate", type=float, default=0, help="Fraction of scans answered with a 500")
+    parser.add_argument("--max-in-flight-mb", type=float, help="CHUNK_UPLOADER_MAX_IN_FLIGHT_BYTES in MB")
+    parser.add_argument("--spool-max-mb", type=float, help="CHUNK_UPLOADER_SPOOL_MAX_BYTES in MB")
+    parser.add_argument("--output", help="File to write the results to as JSON")
+    parser.add_argument("--compare", help="Results file to compare against")
+    args = parser.parse_args()
+
+    s3_stub = start_s3_stub(args.s3_latency / 1000, args.s3_error_rate)
+    clamav_stub = start_clamav_stub(args.clamav_latency / 1000, args.clamav_error_rate)
+
+    with tempfile.TemporaryDirectory() as directory:
+        extra_settings = {}
+        if args.max_in_flight_mb:
+            extra_settings["CHUNK_UPLOADER_MAX_IN_FLIGHT_BYTES"] = int(args.max_in_flight_mb * MB)
+        if args.spool_max_mb:
+            extra_settings["CHUNK_UPLOADER_SPOOL_MAX_BYTES"] = int(args.spool_max_mb * MB)
+            extra_settings["CHUNK_UPLOADER_SPOOL_DIRECTORY"] = directory
+
+        configure_django(
+            s3_stub,
+            clamav_stub,
+            os.path.join(directory, "benchmark.sqlite3"),
+            extra_settings,
+        )
+
+        results = []
+        for size in [int(float(size) * MB) for size in args.sizes.split(",")]:
+            for concurrency in [int(concurrency) for concurrency in args.concurrency.split(",")]:
+                result = run_scenario(
+                    HANDLERS[args.handlers],
+                    size,
+                    concurrency,
+                    args.requests or concurrency * 2,
+                    s3_stub,
+                    clamav_stub,
+                )
+                results.append(result)
+                print(
+                    f"{result['size_mb']:>8g}MB x{concurrency:<3} "
+                    f"{result['mb_per_s']:>9.2f} MB/s  p50 {result['p50_ms']:>9.2f}ms  "
+                    f"p99 {result['p99_ms']:>9.2f}ms  S3 {sum(result['s3_requests'].values()):>5}  "
+                    f"RSS {result['peak_rss_mb']:>7.1f}MB (anonymous {result['peak_anonymous_mb']:>7.1f}MB)  "
+                    f"errors {result['errors']}"
+                )
+
+    s3_stub.stop()
+    clamav_stub.stop()
+
+    output = {"environment": get_environment(args), "results": results}
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(output, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Local stand-ins for S3 and the ClamAV REST service, with configurable
+latency and error injection. Request bodies are read and thrown away so
+that the stubs add as little memory and CPU as possible to a benchmark.
+"""
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+READ_SIZE = 1024 * 1024
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler_class, latency=0, error_rate=0):
+        super().__init__(("127.0.0.1", 0), handler_class)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = Counter()
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def record(self, operation, size):
+        with self._lock:
+            self.requests[operation] += 1
+            self.bytes_received += size
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests = Counter()
+            self.bytes_received = 0
+
+    def handle_error(self, request, client_address):
+        # Uploads that are aborted close their connections part way through
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def should_fail(self):
+        return self.error_rate and random.random() < self.error_rate
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        # Returns the size of the body, which is not kept
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            return self.read_chunked_body()
+
+        size = remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            data = self.rfile.read(min(remaining, READ_SIZE))
+            if not data:
+                break
+            remaining -= len(data)
+
+        return size
+
+    def read_chunked_body(self):
+        size = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                raise ConnectionResetError("Client closed the connection mid body")
+
+            chunk_size = int(line.split(b";")[0], 16)
+            if not chunk_size:
+                self.rfile.readline()
+                return size
+
+            self.rfile.read(chunk_size)
+            self.rfile.readline()
+            size += chunk_size
+
+    def respond(self, status, content=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+
+class S3StubHandler(StubHandler):
+    # Just enough of the S3 API, with path style addressing, for the upload
+    # handlers
+    def get_operation(self):
+        query = parse_qs(urlsplit(self.path).query, keep_blank_values=True)
+
+        if self.command == "POST" and "uploads" in query:
+            return "CreateMultipartUpload"
+        if self.command == "POST" and "uploadId" in query:
+            return "CompleteMultipartUpload"
+        if self.command == "PUT" and "partNumber" in query:
+            if "x-amz-copy-source" in self.headers:
+                return "UploadPartCopy"
+            return "UploadPart"
+        if self.command == "PUT" and "tagging" in query:
+            return "PutObjectTagging"
+        if self.command == "PUT" and "x-amz-copy-source" in self.headers:
+            return "CopyObject"
+        if self.command == "PUT":
+            return "PutObject"
+        if self.command == "DELETE" and "uploadId" in query:
+            return "AbortMultipartUpload"
+        if self.command == "DELETE":
+            return "DeleteObject"
+        if self.command == "HEAD":
+            return "HeadObject"
+        return "GetObject"
+
+    def handle_request(self):
+        operation = self.get_operation()
+        size = self.read_body()
+        self.server.record(operation, size)
+        self.delay()
+
+        if self.server.should_fail():
+            self.respond(
+                503,
+                b"<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>",
+                {"Content-Type": "application/xml"},
+            )
+            return
+
+        etag = f'"{uuid.uuid4().hex}"'
+        _, _, path = self.path.partition("/")
+        bucket, _, key = urlsplit(path).path.partition("/")
+
+        if operation == "CreateMultipartUpload":
+            content = (
+                f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                f"<UploadId>{uuid.uuid4().hex}</UploadId></InitiateMultipartUploadResult>"
+            )
+        elif operation == "CompleteMultipartUpload":
+            content = (
+                f"<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                f"<ETag>{etag}</ETag></CompleteMultipartUploadResult>"
+            )
+        elif operation in ("CopyObject", "UploadPartCopy"):
+            result = "CopyObjectResult" if operation == "CopyObject" else "CopyPartResult"
+            content = (
+                f"<{result}><ETag>{etag}</ETag>"
+                f"<LastModified>2026-01-01T00:00:00.000Z</LastModified></{result}>"
+            )
+        elif operation in ("DeleteObject", "AbortMultipartUpload"):
+            self.respond(204)
+            return
+        else:
+            self.respond(200, headers={"ETag": etag})
+            return
+
+        self.respond(200, content.encode(), {"Content-Type": "application/xml", "ETag": etag})
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = handle_request
+
+
+class ClamAVStubHandler(StubHandler):
+    def do_POST(self):
+        size = self.read_body()
+        self.server.record("Scan", size)
+        self.delay()
+
+        if self.server.should_fail():
+            self.respond(500, b"Internal Server Error")
+            return
+
+        self.respond(
+            200,
+            json.dumps({"malware": False, "reason": None}).encode(),
+            {"Content-Type": "application/json"},
+        )
+
+
+def start_s3_stub(latency=0, error_rate=0):
+    return StubServer(S3StubHandler, latency, error_rate).start()
+
+
+def start_clamav_stub(latency=0, error_rate=0):
+    return StubServer(ClamAVStubHandler, latency, error_rate).start()
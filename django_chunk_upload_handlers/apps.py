@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class FileUploadHandlerConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "django_chunk_upload_handlers"
+
+    def ready(self):
+        from django_chunk_upload_handlers.metrics import (
+            CHUNK_UPLOADER_METRICS,
+            get_metrics_collector,
+        )
+
+        if CHUNK_UPLOADER_METRICS:
+            get_metrics_collector()
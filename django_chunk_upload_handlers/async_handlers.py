@@ -0,0 +1,363 @@
+import asyncio
+import logging
+import os
+import ssl
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from django_chunk_upload_handlers import clam_av, clamd
+from django_chunk_upload_handlers.buffers import is_spooled
+from django_chunk_upload_handlers.clam_av import (
+    AntiVirusServiceErrorException,
+    ClamAVFileUploadHandler,
+)
+from django_chunk_upload_handlers.clamd import ClamdError, parse_reply
+from django_chunk_upload_handlers.s3 import (
+    CHUNK_UPLOADER_PART_ATTEMPTS,
+    S3FileUploadHandler,
+    ThreadedS3ChunkUploader,
+    get_retry_delay,
+    get_s3_client_kwargs,
+    is_retryable,
+)
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:
+    get_session = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# The most parts sent to S3 at once by all async uploads in a process
+CHUNK_UPLOADER_ASYNC_CONCURRENCY = getattr(
+    settings, "CHUNK_UPLOADER_ASYNC_CONCURRENCY",
+    100,
+)
+
+
+_loop = None
+_loop_lock = threading.Lock()
+_part_semaphore = None
+_s3_client = None
+_s3_client_lock = None
+
+
+def get_event_loop():
+    # Network IO of every async upload in the process runs on one event
+    # loop, request threads only wait when they get ahead of it
+    global _loop
+
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever,
+                    name="chunk_uploader_loop",
+                    daemon=True,
+                ).start()
+                _loop = loop
+
+    return _loop
+
+
+def run(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop())
+
+
+def reset_event_loop():
+    global _loop, _loop_lock, _part_semaphore, _s3_client, _s3_client_lock
+
+    _loop = None
+    _loop_lock = threading.Lock()
+    _part_semaphore = None
+    _s3_client = None
+    _s3_client_lock = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_event_loop)
+
+
+def get_part_semaphore():
+    # Only called on the event loop
+    global _part_semaphore
+
+    if _part_semaphore is None:
+        _part_semaphore = asyncio.Semaphore(CHUNK_UPLOADER_ASYNC_CONCURRENCY)
+
+    return _part_semaphore
+
+
+async def get_async_s3_client():
+    global _s3_client, _s3_client_lock
+
+    if get_session is None:
+        raise ImproperlyConfigured(
+            "aiobotocore is needed to use AsyncS3FileUploadHandler"
+        )
+
+    if _s3_client_lock is None:
+        _s3_client_lock = asyncio.Lock()
+
+    async with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = await get_session().create_client(
+                "s3", **get_s3_client_kwargs(),
+            ).__aenter__()
+
+    return _s3_client
+
+
+class AsyncClamdStream:
+    async def open(self):
+        if clamd.CLAMD_SOCKET:
+            connection = asyncio.open_unix_connection(clamd.CLAMD_SOCKET)
+        else:
+            connection = asyncio.open_connection(clamd.CLAMD_HOST, clamd.CLAMD_PORT)
+
+        self.reader, self.writer = await asyncio.wait_for(connection, clamd.CLAMD_TIMEOUT)
+        self.bytes_sent = 0
+        self.exceeded_max_length = False
+        self.writer.write(b"zINSTREAM\0")
+
+    async def send(self, data):
+        if self.exceeded_max_length:
+            return
+
+        if self.bytes_sent + len(data) > clamd.CLAMD_STREAM_MAX_LENGTH:
+            self.exceeded_max_length = True
+            return
+
+        self.writer.writelines([struct.pack("!L", len(data)), data])
+        self.bytes_sent += len(data)
+        await self.writer.drain()
+
+    async def get_result(self):
+        try:
+            if self.exceeded_max_length:
+                raise ClamdError(
+                    f"File is larger than the clamd stream limit of "
+                    f"{clamd.CLAMD_STREAM_MAX_LENGTH} bytes"
+                )
+
+            self.writer.write(struct.pack("!L", 0))
+            await self.writer.drain()
+            reply = await asyncio.wait_for(
+                self.reader.readuntil(b"\0"),
+                clamd.CLAMD_TIMEOUT,
+            )
+            return parse_reply(reply.rstrip(b"\0").decode("utf-8", "replace").strip())
+        finally:
+            self.writer.close()
+
+    def close(self):
+        get_event_loop().call_soon_threadsafe(self.writer.close)
+
+
+class AsyncClamAVRestStream:
+    def __init__(self, content_type, credentials):
+        self.content_type = content_type
+        self.credentials = credentials
+
+    async def open(self):
+        host, _, port = clam_av.CLAM_AV_DOMAIN.partition(":")
+
+        if clam_av.CLAM_USE_HTTP:
+            connection = asyncio.open_connection(host, int(port or 80))
+        else:
+            connection = asyncio.open_connection(
+                host,
+                int(port or 443),
+                ssl=ssl.create_default_context(),
+            )
+
+        self.reader, self.writer = await connection
+        self.writer.write(
+            (
+                f"POST {clam_av.CLAM_PATH} HTTP/1.1\r\n"
+                f"Host: {clam_av.CLAM_AV_DOMAIN}\r\n"
+                f"Content-Type: {self.content_type}\r\n"
+                f"Authorization: Basic {self.credentials}\r\n"
+                f"Transfer-Encoding: chunked\r\n"
+                f"Connection: close\r\n"
+                f"\r\n"
+            ).encode("latin-1")
+        )
+
+    async def send(self, data):
+        if not data:
+            return
+
+        self.writer.writelines([b"%X\r\n" % len(data), data, b"\r\n"])
+        await self.writer.drain()
+
+    async def read_body(self, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if not size:
+                    return body
+                body += await self.reader.readexactly(size)
+                await self.reader.readline()
+
+        if "content-length" in headers:
+            return await self.reader.readexactly(int(headers["content-length"]))
+
+        return await self.reader.read()
+
+    async def get_result(self):
+        try:
+            self.writer.write(b"0\r\n\r\n")
+            await self.writer.drain()
+
+            status_line = await self.reader.readline()
+            try:
+                status = int(status_line.split()[1])
+            except IndexError:
+                # The server closed the connection without replying
+                raise ValueError(f"Malformed status line from AV server: {status_line!r}")
+
+            headers = {}
+            while True:
+                line = (await self.reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            return status, await self.read_body(headers)
+        finally:
+            self.writer.close()
+
+    def close(self):
+        get_event_loop().call_soon_threadsafe(self.writer.close)
+
+
+class AsyncClamAVFileUploadHandler(ClamAVFileUploadHandler):
+    def start_scan(self):
+        if clam_av.CLAM_AV_BACKEND == "clamd":
+            self.stream = AsyncClamdStream()
+        else:
+            self.stream = AsyncClamAVRestStream(self.content_type, self.get_credentials())
+
+        self.pending_send = None
+
+        try:
+            run(self.stream.open()).result()
+        except Exception as ex:
+            logger.error("Error connecting to ClamAV", exc_info=True)
+            raise AntiVirusServiceErrorException(ex)
+
+    def send_chunk(self, raw_data):
+        # Only one chunk of each file waits on the event loop, so the
+        # request is held back rather than buffering the whole file
+        self.wait_for_send()
+        self.pending_send = run(self.stream.send(raw_data))
+
+    def wait_for_send(self):
+        if self.pending_send is not None:
+            pending_send, self.pending_send = self.pending_send, None
+            pending_send.result()
+
+    def get_result(self):
+        try:
+            self.wait_for_send()
+            result = run(self.stream.get_result()).result()
+        except (ClamdError, OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as ex:
+            logger.error("Error scanning file", exc_info=True)
+            self.record_failure(str(ex)[:255])
+
+            raise AntiVirusServiceErrorException(ex)
+
+        if clam_av.CLAM_AV_BACKEND == "clamd":
+            return result
+
+        return self.parse_rest_response(*result)
+
+    def abandon_scan(self):
+        self.stream.close()
+
+
+class AsyncS3ChunkUploader(ThreadedS3ChunkUploader):
+    # Parts are sent by aiobotocore on the shared event loop rather than by
+    # a thread each, the rest of the upload is unchanged
+    def start_part(self, future, part_number, buffer, size):
+        run(self.run_part_async(future, part_number, buffer, size))
+
+    async def run_part_async(self, future, part_number, buffer, size):
+        try:
+            if future.set_running_or_notify_cancel():
+                started_at = time.monotonic()
+                try:
+                    response = await self.upload_part_async(part_number, buffer, size)
+                except Exception as exc:
+                    self.part_completed(part_number, size, started_at, exc)
+                    future.set_exception(exc)
+                else:
+                    self.part_completed(part_number, size, started_at)
+                    future.set_result(response)
+        finally:
+            with self._pending_lock:
+                self.running -= 1
+            self.submit_pending()
+
+    async def upload_part_async(self, part_number, buffer, size):
+        client = await get_async_s3_client()
+
+        if buffer is None:
+            body = b""
+        elif size == len(buffer) and not is_spooled(buffer):
+            body = buffer
+        else:
+            # aiobotocore needs the part in memory while it is sent
+            body = bytes(memoryview(buffer)[:size])
+
+        attempt = 1
+        while True:
+            started_at = time.monotonic()
+            try:
+                async with get_part_semaphore():
+                    return await client.upload_part(
+                        Bucket=self.bucket,
+                        Key=self.key,
+                        PartNumber=part_number,
+                        UploadId=self.upload_id,
+                        Body=body,
+                        ContentLength=size,
+                        **self.get_checksum_kwargs(self.digests[part_number]),
+                    )
+            except Exception as exc:
+                if attempt >= CHUNK_UPLOADER_PART_ATTEMPTS or not is_retryable(exc):
+                    self.failed = True
+                    raise
+
+                logger.warning(
+                    "Retrying part %s of %s after attempt %s failed: %s",
+                    part_number, self.key, attempt, exc,
+                )
+                await asyncio.sleep(get_retry_delay(attempt))
+                attempt += 1
+
+                with self._retry_lock:
+                    self.retry_count += 1
+                    self.retry_time += time.monotonic() - started_at
+
+
+class AsyncS3FileUploadHandler(S3FileUploadHandler):
+    uploader_class = AsyncS3ChunkUploader
+
+    def new_file(self, *args, **kwargs):
+        if get_session is None:
+            raise ImproperlyConfigured(
+                "aiobotocore is needed to use AsyncS3FileUploadHandler"
+            )
+
+        super().new_file(*args, **kwargs)
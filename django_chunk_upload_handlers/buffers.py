@@ -0,0 +1,110 @@
+import io
+import mmap
+import tempfile
+import threading
+
+
+class PartBufferPool:
+    def __init__(self, max_retained_bytes):
+        self.max_retained_bytes = max_retained_bytes
+        self.retained_bytes = 0
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        with self._lock:
+            buffers = self._buffers.get(size)
+            if buffers:
+                self.retained_bytes -= size
+                return buffers.pop()
+
+        return bytearray(size)
+
+    def release(self, buffer):
+        size = len(buffer)
+
+        with self._lock:
+            # Buffers beyond the limit are left to the garbage collector so
+            # that memory is returned once load drops
+            if self.retained_bytes + size > self.max_retained_bytes:
+                return
+
+            self._buffers.setdefault(size, []).append(buffer)
+            self.retained_bytes += size
+
+
+def spooled_buffer(size, directory=None):
+    # A part buffer in a memory-mapped temporary file, whose pages the
+    # kernel can write out and drop rather than holding them in memory. The
+    # file is unlinked, so its space is freed once the mapping is closed
+    with tempfile.TemporaryFile(dir=directory) as spool_file:
+        spool_file.truncate(size)
+        return mmap.mmap(spool_file.fileno(), size)
+
+
+def is_spooled(buffer):
+    return isinstance(buffer, mmap.mmap)
+
+
+def close_spooled_buffer(buffer):
+    try:
+        buffer.close()
+    except BufferError:
+        # A request body still has a view of it, it is unmapped once that
+        # has been garbage collected
+        pass
+
+
+class MemoryViewReader(io.RawIOBase):
+    # A seekable file-like object over a memoryview, so that part of a
+    # buffer can be sent without copying it into a new bytes object
+    def __init__(self, view):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = max(0, min(len(buffer), len(self._view) - self._position))
+        buffer[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+
+        self._position = position
+        return position
+
+    def tell(self):
+        return self._position
+
+
+def part_body(buffer, size):
+    # A full buffer can be sent as it is, bytearray being accepted by boto3.
+    # Spooled buffers are always wrapped, so each attempt reads from the start
+    if buffer is None:
+        return b""
+
+    if size == len(buffer) and not is_spooled(buffer):
+        return buffer
+
+    return MemoryViewReader(memoryview(buffer)[:size])
@@ -0,0 +1,58 @@
+import hashlib
+import zlib
+from base64 import b64encode
+
+try:
+    from awscrt.checksums import crc32c
+except ImportError:
+    crc32c = None
+
+
+class CRCHasher:
+    def __init__(self, crc_function):
+        self.crc_function = crc_function
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = self.crc_function(data, self.crc)
+
+    def digest(self):
+        return self.crc.to_bytes(4, "big")
+
+
+def crc32(data, previous=0):
+    return zlib.crc32(data, previous)
+
+
+def get_hasher(algorithm):
+    # The names are those of the S3 ChecksumAlgorithm parameter
+    if algorithm == "CRC32":
+        return CRCHasher(crc32)
+    if algorithm == "CRC32C":
+        return CRCHasher(crc32c)
+    if algorithm == "SHA1":
+        return hashlib.sha1()
+    if algorithm == "SHA256":
+        return hashlib.sha256()
+
+    raise ValueError(f"Unsupported checksum algorithm {algorithm}")
+
+
+def is_available(algorithm):
+    return algorithm in ("CRC32", "SHA1", "SHA256") or (
+        algorithm == "CRC32C" and crc32c is not None
+    )
+
+
+def encode(digest):
+    return b64encode(digest).decode("ascii")
+
+
+def composite_checksum(algorithm, digests):
+    # S3's checksum of a multipart object is the checksum of the
+    # concatenated part checksums, suffixed with the number of parts
+    hasher = get_hasher(algorithm)
+    for digest in digests:
+        hasher.update(digest)
+
+    return f"{encode(hasher.digest())}-{len(digests)}"
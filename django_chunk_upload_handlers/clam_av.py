@@ -1,7 +1,16 @@
+import copy
+import hashlib
 import json
 import logging
+import os
 import pathlib
+import select
+import ssl
+import threading
+import time
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from http.client import HTTPConnection, HTTPSConnection
 
 # Check that HTTPSConnection is secure in the version of Python you are using
@@ -14,10 +23,29 @@ from django.core.files.uploadhandler import (
     FileUploadHandler,
     UploadFileException,
 )
+from django.db import connection
+from django.db.models.fields.files import FieldFile
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from django_chunk_upload_handlers import signals
+from django_chunk_upload_handlers.clamd import (
+    ClamdError,
+    ClamdInstream,
+    get_version as get_clamd_version,
+)
 from django_chunk_upload_handlers.models import ScannedFile
-from django_chunk_upload_handlers.util import check_required_setting
+from django_chunk_upload_handlers.scanned_files import (
+    CLAM_AV_SCANNED_FILE_WRITES,
+    get_scanned_file_writer,
+    save_scanned_files,
+)
+from django_chunk_upload_handlers.util import (
+    add_timing,
+    check_required_setting,
+    sendmsg_all,
+)
+from django_chunk_upload_handlers.verdict_cache import get_verdict_cache
 
 
 logger = logging.getLogger(__name__)
@@ -26,28 +54,74 @@ logger = logging.getLogger(__name__)
 CHUNK_SIZE = 5 * 1024 * 1024
 
 # Clam AV
-CLAM_AV_USERNAME = check_required_setting("CLAM_AV_USERNAME")
-CLAM_AV_PASSWORD = check_required_setting("CLAM_AV_PASSWORD")
-CLAM_AV_DOMAIN = check_required_setting("CLAM_AV_DOMAIN")
+# Either "rest" for the ClamAV REST service or "clamd" to stream files
+# directly to clamd
+CLAM_AV_BACKEND = getattr(settings, "CLAM_AV_BACKEND", "rest")
+
+if CLAM_AV_BACKEND == "rest":
+    CLAM_AV_USERNAME = check_required_setting("CLAM_AV_USERNAME")
+    CLAM_AV_PASSWORD = check_required_setting("CLAM_AV_PASSWORD")
+    CLAM_AV_DOMAIN = check_required_setting("CLAM_AV_DOMAIN")
+else:
+    CLAM_AV_USERNAME = getattr(settings, "CLAM_AV_USERNAME", None)
+    CLAM_AV_PASSWORD = getattr(settings, "CLAM_AV_PASSWORD", None)
+    CLAM_AV_DOMAIN = getattr(settings, "CLAM_AV_DOMAIN", None)
+
 CLAM_PATH = getattr(settings, "CLAM_PATH", "/v2/scan-chunked")
 CLAM_AV_IGNORE_EXTENSIONS = getattr(settings, "CLAM_AV_IGNORE_EXTENSIONS", {})
 CLAM_USE_HTTP = getattr(settings, "CLAM_USE_HTTP", False)  # Do not use in production!
+CLAM_AV_POOL_SIZE = getattr(settings, "CLAM_AV_POOL_SIZE", 10)
+CLAM_AV_POOL_IDLE_TIMEOUT = getattr(settings, "CLAM_AV_POOL_IDLE_TIMEOUT", 30)
+# Chunks smaller than this are combined into one chunked transfer frame
+CLAM_AV_FRAME_SIZE = getattr(settings, "CLAM_AV_FRAME_SIZE", 0)
+# The version of the virus signatures in use, clamd is asked for it if
+# not set. Cached verdicts are only used with a known signature version
+CLAM_AV_SIGNATURE_VERSION = getattr(settings, "CLAM_AV_SIGNATURE_VERSION", None)
+CLAMD_VERSION_CHECK_INTERVAL = 60
+# The most plaintext a single TLS record can carry
+TLS_RECORD_SIZE = 16 * 1024
+
+# Scan files after the upload request has returned, either "thread" to
+# wait for the verdict in a background thread or "database" to leave the
+# scan to the process_pending_scans management command
+CHUNK_UPLOADER_ASYNC_SCAN = getattr(settings, "CHUNK_UPLOADER_ASYNC_SCAN", None)
+CHUNK_UPLOADER_SCAN_WORKERS = getattr(settings, "CHUNK_UPLOADER_SCAN_WORKERS", 10)
 
 
 class VirusFoundInFileException(UploadFileException):
     pass
 
 
+_missing = object()
+
+
 def validate_virus_check_result(file):
-    try:
-        file.readline()
-    except VirusFoundInFileException:
+    # Files returned by the upload handlers carry their AV result, model
+    # fields wrap them in a FieldFile. Only attributes already set are
+    # looked at, as the file of an S3UploadedFile is fetched from S3
+    if hasattr(file, "av_passed"):
+        av_passed = file.av_passed
+    elif isinstance(file, FieldFile):
+        av_passed = getattr(file._file, "av_passed", _missing)
+    else:
+        av_passed = _missing
+
+    if av_passed is _missing:
+        try:
+            file.readline()
+        except VirusFoundInFileException:
+            raise ValidationError(
+                _('A virus was found'),
+            )
+    elif av_passed is False:
         raise ValidationError(
             _('A virus was found'),
         )
 
 
 class FileWithVirus(UploadedFile):
+    av_passed = False
+
     def __init__(self, field_name):
         super().__init__(file="virus", name="virus", size="virus")
         self.field_name = field_name
@@ -81,9 +155,191 @@ class MalformedAntiVirusResponseException(UploadFileException):
     pass
 
 
+def send_chunks(sock, chunks, last=False):
+    # Each chunk is framed for chunked transfer encoding and everything is
+    # sent in one write, rather than a write for each length, payload and
+    # line ending
+    buffers = []
+    for chunk in chunks:
+        buffers += [b"%x\r\n" % len(chunk), chunk, b"\r\n"]
+
+    if last:
+        buffers.append(b"0\r\n\r\n")
+
+    if isinstance(sock, ssl.SSLSocket):
+        # SSL sockets do not support sendmsg. Pieces smaller than a TLS record
+        # are joined, saving a record and a system call for each, larger
+        # chunks are sent as they are rather than copied
+        pending = b""
+        for buffer in buffers:
+            if len(buffer) < TLS_RECORD_SIZE:
+                pending += buffer
+                continue
+            if pending:
+                sock.sendall(pending)
+                pending = b""
+            sock.sendall(buffer)
+        if pending:
+            sock.sendall(pending)
+    else:
+        sendmsg_all(sock, buffers)
+
+
+class ClamAVConnectionPool:
+    def __init__(self, max_size, idle_timeout):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def create_connection(self):
+        if CLAM_USE_HTTP:
+            return HTTPConnection(
+                host=CLAM_AV_DOMAIN,
+            )
+
+        return HTTPSConnection(  # noqa S309
+            host=CLAM_AV_DOMAIN,
+            port=443,
+        )
+
+    def is_healthy(self, conn):
+        if conn.sock is None:
+            return False
+
+        # An idle keep-alive connection should have nothing to read, if it
+        # is readable the server has closed it (or sent something unexpected)
+        try:
+            readable, _writable, _errored = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+
+        return not readable
+
+    def get(self):
+        now = time.monotonic()
+
+        while True:
+            with self._lock:
+                if not self._connections:
+                    break
+                conn, returned_at = self._connections.pop()
+
+            if now - returned_at < self.idle_timeout and self.is_healthy(conn):
+                return conn
+
+            conn.close()
+
+        return self.create_connection()
+
+    def put(self, conn):
+        with self._lock:
+            if len(self._connections) < self.max_size:
+                self._connections.append((conn, time.monotonic()))
+                return
+
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+
+        for conn, _returned_at in connections:
+            conn.close()
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    global _connection_pool
+
+    if _connection_pool is None:
+        with _connection_pool_lock:
+            if _connection_pool is None:
+                _connection_pool = ClamAVConnectionPool(
+                    CLAM_AV_POOL_SIZE,
+                    CLAM_AV_POOL_IDLE_TIMEOUT,
+                )
+
+    return _connection_pool
+
+
+def reset_connection_pool():
+    global _connection_pool, _connection_pool_lock
+
+    # Sockets inherited from a parent process must not be reused, they are
+    # dropped rather than closed so the parent's connections are unaffected
+    _connection_pool = None
+    _connection_pool_lock = threading.Lock()
+
+
+_scan_executor = None
+_scan_executor_lock = threading.Lock()
+
+
+def get_scan_executor():
+    global _scan_executor
+
+    if _scan_executor is None:
+        with _scan_executor_lock:
+            if _scan_executor is None:
+                _scan_executor = ThreadPoolExecutor(
+                    max_workers=CHUNK_UPLOADER_SCAN_WORKERS,
+                    thread_name_prefix="clam_av_scan",
+                )
+
+    return _scan_executor
+
+
+def reset_scan_executor():
+    global _scan_executor, _scan_executor_lock
+
+    _scan_executor = None
+    _scan_executor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_connection_pool)
+    os.register_at_fork(after_in_child=reset_scan_executor)
+
+
+_clamd_version = (None, 0)
+
+
+def get_signature_version():
+    global _clamd_version
+
+    if CLAM_AV_SIGNATURE_VERSION:
+        return CLAM_AV_SIGNATURE_VERSION
+
+    if CLAM_AV_BACKEND != "clamd":
+        return None
+
+    version, checked_at = _clamd_version
+    if time.monotonic() - checked_at > CLAMD_VERSION_CHECK_INTERVAL:
+        try:
+            version = get_clamd_version()
+        except OSError:
+            logger.warning("Unable to get the clamd version", exc_info=True)
+            version = None
+
+        _clamd_version = (version, time.monotonic())
+
+    return version
+
+
 class ClamAVFileUploadHandler(FileUploadHandler):
     chunk_size = CHUNK_SIZE
     skip_av_check = False
+    async_scan = CHUNK_UPLOADER_ASYNC_SCAN
+    scanned_file_writes = CLAM_AV_SCANNED_FILE_WRITES
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Scan records written at the end of the request
+        self.unsaved_scanned_files = []
 
     def new_file(self, *args, **kwargs):
         super().new_file(*args, **kwargs)
@@ -93,98 +349,328 @@ class ClamAVFileUploadHandler(FileUploadHandler):
             self.skip_av_check = True
             return
 
-        if CLAM_USE_HTTP:
-            self.av_conn = HTTPConnection(
-                host=CLAM_AV_DOMAIN,
-            )
-        else:
-            self.av_conn = HTTPSConnection(  # noqa S309
-                host=CLAM_AV_DOMAIN,
-                port=443,
-            )
+        self.content_hash = hashlib.sha256()
+        self.scan_started_at = time.monotonic()
+        # Seconds spent in each phase of the scan
+        self.timings = {}
+        self.scanned_file = ScannedFile(
+            file_name=self.file_name[:255],
+            content_type=self.content_type,
+        )
+
+        signals.upload_started.send_robust(
+            sender=self.__class__,
+            handler=self,
+            file_name=self.file_name,
+        )
 
-        credentials = b64encode(
+        if self.async_scan == "database":
+            # The file is scanned once it is in S3
+            return
+
+        self.start_scan()
+        add_timing(self.timings, "av_connect", self.scan_started_at)
+
+    def get_credentials(self):
+        return b64encode(
             bytes(
                 f"{CLAM_AV_USERNAME}:{CLAM_AV_PASSWORD}",
                 encoding="utf8",
             )
         ).decode("ascii")
 
+    def start_scan(self):
+        if CLAM_AV_BACKEND == "clamd":
+            try:
+                self.clamd_stream = ClamdInstream()
+            except Exception as ex:
+                logger.error("Error connecting to clamd", exc_info=True)
+                raise AntiVirusServiceErrorException(ex)
+
+            return
+
+        credentials = self.get_credentials()
+
+        self.frame_buffer = bytearray()
+
+        connection_pool = get_connection_pool()
+        self.av_conn = connection_pool.get()
+        reused = self.av_conn.sock is not None
+
         try:
-            self.av_conn.connect()
-            self.av_conn.putrequest("POST", CLAM_PATH)
-            self.av_conn.putheader("Content-Type", self.content_type)
-            self.av_conn.putheader("Authorization", f"Basic {credentials}")
-            self.av_conn.putheader("Transfer-encoding", "chunked")
-            self.av_conn.endheaders()
+            self.start_request(credentials)
         except Exception as ex:
-            logger.error("Error connecting to ClamAV service", exc_info=True)
-            raise AntiVirusServiceErrorException(ex)
+            if not reused:
+                logger.error("Error connecting to ClamAV service", exc_info=True)
+                raise AntiVirusServiceErrorException(ex)
+
+            # A pooled connection may have been closed by the server since
+            # it was checked, so try once more with a new one
+            self.av_conn.close()
+            self.av_conn = connection_pool.create_connection()
+
+            try:
+                self.start_request(credentials)
+            except Exception as ex:
+                logger.error("Error connecting to ClamAV service", exc_info=True)
+                raise AntiVirusServiceErrorException(ex)
+
+    def start_request(self, credentials):
+        if self.av_conn.sock is None:
+            self.av_conn.connect()
+
+        self.av_conn.putrequest("POST", CLAM_PATH)
+        self.av_conn.putheader("Content-Type", self.content_type)
+        self.av_conn.putheader("Authorization", f"Basic {credentials}")
+        self.av_conn.putheader("Transfer-encoding", "chunked")
+        self.av_conn.endheaders()
 
     def receive_data_chunk(self, raw_data, start):
-        if not self.skip_av_check:
-            self.av_conn.send(hex(len(raw_data))[2:].encode("utf-8"))
-            self.av_conn.send(b"\r\n")
-            self.av_conn.send(raw_data)
-            self.av_conn.send(b"\r\n")
+        if self.skip_av_check:
+            return raw_data
+
+        self.content_hash.update(raw_data)
+
+        if self.async_scan != "database":
+            started_at = time.monotonic()
+            self.send_chunk(raw_data)
+            add_timing(self.timings, "av_stream", started_at)
 
         return raw_data
 
-    def file_complete(self, file_size):
-        if self.skip_av_check:
-            return None
+    def send_chunk(self, raw_data):
+        if CLAM_AV_BACKEND == "clamd":
+            self.clamd_stream.send(raw_data)
+        elif len(raw_data) < CLAM_AV_FRAME_SIZE:
+            self.frame_buffer += raw_data
+
+            if len(self.frame_buffer) >= CLAM_AV_FRAME_SIZE:
+                send_chunks(self.av_conn.sock, [self.frame_buffer])
+                self.frame_buffer = bytearray()
+        else:
+            send_chunks(self.av_conn.sock, self.drain_frame_buffer() + [raw_data])
 
-        self.av_conn.send(b"0\r\n\r\n")
+    def drain_frame_buffer(self):
+        if not self.frame_buffer:
+            return []
+
+        frame_buffer = self.frame_buffer
+        self.frame_buffer = bytearray()
+        return [frame_buffer]
+
+    def record_failure(self, av_reason):
+        if self.scanned_file.pending:
+            # A quarantined file stays pending, to be scanned again, until
+            # ClamAV gives a verdict
+            return
+
+        self.scanned_file.content_hash = self.content_hash.hexdigest()
+        self.record_result(False, av_reason)
+
+    def record_result(self, av_passed, av_reason):
+        self.scanned_file.av_passed = av_passed
+        self.scanned_file.av_reason = av_reason
+        self.scanned_file.pending = False
+        self.scanned_file.scanned_at = timezone.now()
+        self.scanned_file.scan_duration = timedelta(
+            seconds=time.monotonic() - self.scan_started_at,
+        )
+        self.save_scanned_file()
+
+    def save_scanned_file(self):
+        # Records that already exist, such as those of pending scans, are
+        # updated straight away
+        if self.scanned_file.pk or self.scanned_file_writes == "immediate":
+            self.scanned_file.save()
+        elif not self.scanned_file.av_passed:
+            # A failure usually ends the request before upload_complete is
+            # called, so it is written along with anything waiting
+            self.unsaved_scanned_files.append(self.scanned_file)
+            self.save_unsaved_scanned_files()
+        elif self.scanned_file_writes == "background":
+            get_scanned_file_writer().put(self.scanned_file)
+        else:
+            self.unsaved_scanned_files.append(self.scanned_file)
+
+    def save_unsaved_scanned_files(self):
+        scanned_files = self.unsaved_scanned_files
+        self.unsaved_scanned_files = []
+        save_scanned_files(scanned_files)
+
+    def upload_complete(self):
+        self.save_unsaved_scanned_files()
+
+    def upload_interrupted(self):
+        self.save_unsaved_scanned_files()
+
+    def abandon_scan(self):
+        # The verdict is already known, closing the connection stops the
+        # scan without waiting for its response
+        if CLAM_AV_BACKEND == "clamd":
+            self.clamd_stream.close()
+        else:
+            self.av_conn.close()
+
+    def get_rest_result(self):
+        send_chunks(self.av_conn.sock, self.drain_frame_buffer(), last=True)
 
         resp = self.av_conn.getresponse()
         response_content = resp.read()
 
-        scanned_file = ScannedFile()
+        # The response has been read in full so the connection can be
+        # reused by the next file, unless the server is closing it
+        if resp.will_close:
+            self.av_conn.close()
+        else:
+            get_connection_pool().put(self.av_conn)
+
+        return self.parse_rest_response(resp.status, response_content)
 
-        if resp.status != 200:
-            scanned_file.av_passed = False
-            scanned_file.av_reason = "Non 200 response from AV server"
-            scanned_file.save()
+    def parse_rest_response(self, status, response_content):
+        if status != 200:
+            self.record_failure("Non 200 response from AV server")
 
             raise AntiVirusServiceErrorException(
                 f"Non 200 response from anti virus service, content: {response_content}"
             )
-        else:
-            json_response = json.loads(response_content)
-
-            if "malware" not in json_response:
-                scanned_file.av_passed = False
-                scanned_file.av_reason = "Malformed response from AV server"
-                scanned_file.save()
-
-                raise MalformedAntiVirusResponseException()
-
-            if json_response["malware"]:
-                scanned_file.av_passed = False
-                scanned_file.av_reason = json_response["reason"]
-                scanned_file.save()
-                logger.error(
-                    f"Malware found in user uploaded file "
-                    f"'{self.file_name}', exiting upload process"
-                )
-            else:
-                scanned_file.av_passed = True
-                scanned_file.save()
-
-            # We are using 'content_type_extra' as the a means of making
-            # the results available to following file handlers
-
-            #  TODO - put in a PR to Django project to allow file_complete
-            # to return objects and not break out of file handler loop
-            if not hasattr(self.content_type_extra, "clam_av_results"):
-                self.content_type_extra["clam_av_results"] = []
-
-            self.content_type_extra["clam_av_results"].append(
-                {
-                    "file_name": self.file_name,
-                    "av_passed": scanned_file.av_passed,
-                    "scanned_at": scanned_file.scanned_at,
-                }
+
+        json_response = json.loads(response_content)
+
+        if "malware" not in json_response:
+            self.record_failure("Malformed response from AV server")
+
+            raise MalformedAntiVirusResponseException()
+
+        if json_response["malware"]:
+            return False, json_response["reason"]
+
+        return True, None
+
+    def get_clamd_result(self):
+        try:
+            return self.clamd_stream.get_result()
+        except (ClamdError, OSError) as ex:
+            logger.error("Error scanning file with clamd", exc_info=True)
+            self.record_failure(str(ex)[:255])
+
+            raise AntiVirusServiceErrorException(ex)
+
+    def get_result(self):
+        if CLAM_AV_BACKEND == "clamd":
+            return self.get_clamd_result()
+
+        return self.get_rest_result()
+
+    def scan(self, verdict_cache, signature_version):
+        started_at = time.monotonic()
+        try:
+            av_passed, av_reason = self.get_result()
+        except Exception as exc:
+            self.av_response(None, None, started_at, exc)
+            raise
+
+        add_timing(self.timings, "av_verdict", started_at)
+        self.av_response(av_passed, av_reason, started_at)
+
+        if av_passed and signature_version:
+            verdict_cache.set_clean(self.scanned_file.content_hash, signature_version)
+
+        self.record_result(av_passed, av_reason)
+
+        if not av_passed:
+            logger.error(
+                f"Malware found in user uploaded file "
+                f"'{self.file_name}', exiting upload process"
             )
 
+        return av_passed
+
+    def av_response(self, av_passed, av_reason, started_at, exception=None):
+        signals.av_response.send_robust(
+            sender=self.__class__,
+            handler=self,
+            file_name=self.file_name,
+            av_passed=av_passed,
+            av_reason=av_reason,
+            duration=time.monotonic() - started_at,
+            exception=exception,
+        )
+
+    def scan_in_background(self, verdict_cache, signature_version):
+        try:
+            return self.scan(verdict_cache, signature_version)
+        except Exception:
+            # The file stays in quarantine for process_pending_scans
+            logger.error("Error scanning file in the background", exc_info=True)
+            return None
+        finally:
+            connection.close()
+
+    def file_complete(self, file_size):
+        if self.skip_av_check:
             return None
+
+        self.scanned_file.content_hash = self.content_hash.hexdigest()
+        self.scanned_file.file_size = file_size
+        verdict_cache = get_verdict_cache()
+        signature_version = get_signature_version() if verdict_cache else None
+
+        # We are using 'content_type_extra' as the a means of making
+        # the results available to following file handlers
+
+        #  TODO - put in a PR to Django project to allow file_complete
+        # to return objects and not break out of file handler loop
+        if not hasattr(self.content_type_extra, "clam_av_results"):
+            self.content_type_extra["clam_av_results"] = []
+
+        # Following file handlers add their own phases
+        self.content_type_extra.setdefault("upload_timings", {})
+
+        if signature_version and verdict_cache.is_clean(
+            self.scanned_file.content_hash, signature_version,
+        ):
+            if self.async_scan != "database":
+                self.abandon_scan()
+            self.record_result(True, None)
+        elif self.async_scan:
+            # Following file handlers put the file in quarantine until the
+            # scan is complete
+            self.scanned_file.pending = True
+            self.scanned_file.save()
+
+            result = {
+                "file_name": self.file_name,
+                "av_passed": None,
+                "scanned_at": None,
+                "pending": True,
+                "scanned_file": self.scanned_file,
+            }
+
+            self.content_type_extra["upload_timings"].update(self.timings)
+
+            if self.async_scan == "thread":
+                # The handler is reused for the request's next file, which
+                # replaces its connection, record and timings, so the scan
+                # runs on a copy holding this file's
+                result["verdict"] = get_scan_executor().submit(
+                    copy.copy(self).scan_in_background,
+                    verdict_cache,
+                    signature_version,
+                )
+
+            self.content_type_extra["clam_av_results"].append(result)
+
+            return None
+        else:
+            self.scan(verdict_cache, signature_version)
+
+        self.content_type_extra["upload_timings"].update(self.timings)
+        self.content_type_extra["clam_av_results"].append(
+            {
+                "file_name": self.file_name,
+                "av_passed": self.scanned_file.av_passed,
+                "scanned_at": self.scanned_file.scanned_at,
+            }
+        )
+
+        return None
@@ -0,0 +1,127 @@
+import logging
+import socket
+import struct
+
+from django.conf import settings
+
+from django_chunk_upload_handlers.util import sendmsg_all
+
+
+logger = logging.getLogger(__name__)
+
+
+# clamd
+CLAMD_SOCKET = getattr(settings, "CLAMD_SOCKET", None)
+CLAMD_HOST = getattr(settings, "CLAMD_HOST", "localhost")
+CLAMD_PORT = getattr(settings, "CLAMD_PORT", 3310)
+CLAMD_TIMEOUT = getattr(settings, "CLAMD_TIMEOUT", 60)
+# Must not be more than the StreamMaxLength of the clamd configuration
+CLAMD_STREAM_MAX_LENGTH = getattr(
+    settings, "CLAMD_STREAM_MAX_LENGTH",
+    25 * 1024 * 1024,
+)
+
+
+class ClamdError(Exception):
+    pass
+
+
+def connect():
+    if CLAMD_SOCKET:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CLAMD_TIMEOUT)
+        try:
+            sock.connect(CLAMD_SOCKET)
+        except OSError:
+            sock.close()
+            raise
+
+        return sock
+
+    return socket.create_connection(
+        (CLAMD_HOST, CLAMD_PORT),
+        timeout=CLAMD_TIMEOUT,
+    )
+
+
+def read_reply(sock):
+    reply = b""
+
+    # Replies to z prefixed commands are terminated by a null byte
+    while not reply.endswith(b"\0"):
+        data = sock.recv(4096)
+        if not data:
+            break
+        reply += data
+
+    return reply.rstrip(b"\0").decode("utf-8", "replace").strip()
+
+
+def parse_reply(reply):
+    # Replies are "stream: OK", "stream: <signature> FOUND" or
+    # "<message> ERROR"
+    _, _, result = reply.partition(": ")
+
+    if result == "OK":
+        return True, None
+
+    if result.endswith(" FOUND"):
+        return False, result[:-len(" FOUND")]
+
+    raise ClamdError(f"Unexpected response from clamd: {reply}")
+
+
+def get_version():
+    sock = connect()
+
+    try:
+        sock.sendall(b"zVERSION\0")
+        reply = read_reply(sock)
+    finally:
+        sock.close()
+
+    # "ClamAV <engine version>/<signature version>/<signature date>"
+    _, _, version = reply.partition(" ")
+    return "/".join(version.split("/")[:2])
+
+
+class ClamdInstream:
+    def __init__(self):
+        self.bytes_sent = 0
+        self.exceeded_max_length = False
+        self.sock = connect()
+
+        try:
+            self.sock.sendall(b"zINSTREAM\0")
+        except OSError:
+            self.sock.close()
+            raise
+
+    def send(self, data):
+        if self.exceeded_max_length:
+            return
+
+        # clamd drops the connection once StreamMaxLength is reached, so
+        # stop sending rather than have the scan fail part way through
+        if self.bytes_sent + len(data) > CLAMD_STREAM_MAX_LENGTH:
+            self.exceeded_max_length = True
+            return
+
+        sendmsg_all(self.sock, [struct.pack("!L", len(data)), data])
+        self.bytes_sent += len(data)
+
+    def get_result(self):
+        try:
+            if self.exceeded_max_length:
+                raise ClamdError(
+                    f"File is larger than the clamd stream limit of "
+                    f"{CLAMD_STREAM_MAX_LENGTH} bytes"
+                )
+
+            self.sock.sendall(struct.pack("!L", 0))
+            return parse_reply(read_reply(self.sock))
+        finally:
+            self.sock.close()
+
+    def close(self):
+        self.sock.close()
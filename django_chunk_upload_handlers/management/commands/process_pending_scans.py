@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_chunk_upload_handlers.pipeline import process_pending_scans
+
+
+class Command(BaseCommand):
+    help = "Scan quarantined files uploaded with CHUNK_UPLOADER_ASYNC_SCAN set to 'database'"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of files to scan in each batch",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep scanning files as they are uploaded",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to wait when there are no files to scan",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_pending_scans(options["batch_size"])
+            self.stdout.write(f"Scanned {processed} files")
+
+            if not options["loop"]:
+                break
+
+            if processed < options["batch_size"]:
+                time.sleep(options["interval"])
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from django_chunk_upload_handlers.scanned_files import (
+    CLAM_AV_SCANNED_FILE_RETENTION_DAYS,
+    prune_scanned_files,
+)
+
+
+class Command(BaseCommand):
+    help = "Delete scanned file records older than the retention window"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=CLAM_AV_SCANNED_FILE_RETENTION_DAYS,
+            help="Number of days of records to keep",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of records to delete in each query",
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0.1,
+            help="Seconds to wait between batches",
+        )
+
+    def handle(self, *args, **options):
+        deleted = prune_scanned_files(
+            options["days"],
+            batch_size=options["batch_size"],
+            pause=options["pause"],
+        )
+        self.stdout.write(f"Deleted {deleted} scanned file records")
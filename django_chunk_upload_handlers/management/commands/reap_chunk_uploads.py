@@ -0,0 +1,55 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from django_chunk_upload_handlers.reaper import reap_chunk_uploads
+from django_chunk_upload_handlers.s3 import S3_TEMPORARY_KEY_PREFIX
+
+
+class Command(BaseCommand):
+    help = "Abort multipart uploads and delete temporary objects left behind by interrupted uploads"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-age-hours",
+            type=float,
+            default=24,
+            help="Only remove uploads started more than this many hours ago",
+        )
+        parser.add_argument(
+            "--prefix",
+            default=S3_TEMPORARY_KEY_PREFIX,
+            help="Key prefix of the multipart uploads to abort",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report what would be removed without removing it",
+        )
+
+    def handle(self, *args, **options):
+        summary = reap_chunk_uploads(
+            options["prefix"],
+            timezone.now() - timedelta(hours=options["max_age_hours"]),
+            dry_run=options["dry_run"],
+        )
+
+        if summary["resumable_uploads_found"]:
+            self.stdout.write(
+                f"{'Would forget' if options['dry_run'] else 'Forgot'} "
+                f"{summary['resumable_uploads_found']} resumable uploads"
+            )
+
+        if options["dry_run"]:
+            self.stdout.write(
+                f"Would abort {summary['uploads_found']} multipart uploads and delete "
+                f"{summary['objects_found']} objects ({summary['bytes_found']} bytes)"
+            )
+            return
+
+        self.stdout.write(
+            f"Aborted {summary['uploads_aborted']} of {summary['uploads_found']} multipart "
+            f"uploads and deleted {summary['objects_deleted']} of {summary['objects_found']} "
+            f"objects ({summary['bytes_found']} bytes), {summary['errors']} errors"
+        )
@@ -0,0 +1,193 @@
+import bisect
+import os
+import threading
+
+from django.conf import settings
+
+from django_chunk_upload_handlers import signals
+from django_chunk_upload_handlers.clam_av import ClamAVFileUploadHandler
+
+
+# Keep counters and latency histograms of the upload signals in each process
+CHUNK_UPLOADER_METRICS = getattr(settings, "CHUNK_UPLOADER_METRICS", False)
+# Upper bounds in seconds of the histogram buckets
+CHUNK_UPLOADER_METRICS_BUCKETS = getattr(
+    settings, "CHUNK_UPLOADER_METRICS_BUCKETS",
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        # The last count is of observations above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        # The upper bound of the bucket holding the quantile, or None if it
+        # is above every bucket
+        if not self.count:
+            return None
+
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bucket
+
+        return None
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip(self.buckets + (float("inf"),), self.counts)),
+        }
+
+
+class MetricsCollector:
+    def __init__(self, buckets=CHUNK_UPLOADER_METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {
+                    name: histogram.snapshot()
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def upload_started(self, sender, **kwargs):
+        # Every handler in the chain starts each file, so scans are counted
+        # apart from the files being stored
+        if issubclass(sender, ClamAVFileUploadHandler):
+            self.increment("scans_started")
+        else:
+            self.increment("files_started")
+
+    def part_submitted(self, sender, queued, in_flight_bytes, spooled_bytes, **kwargs):
+        self.increment("parts_submitted")
+        self.set_gauge("parts_queued", queued)
+        self.set_gauge("bytes_in_flight", in_flight_bytes)
+        self.set_gauge("bytes_spooled", spooled_bytes)
+
+    def part_completed(self, sender, size, duration, exception, **kwargs):
+        if exception is None:
+            self.increment("parts_uploaded")
+            self.increment("bytes_uploaded", size)
+        else:
+            self.increment("parts_failed")
+
+        self.observe("part_seconds", duration)
+
+    def av_response(self, sender, av_passed, duration, exception, **kwargs):
+        if exception is not None:
+            self.increment("av_errors")
+        elif av_passed:
+            self.increment("av_passed")
+        else:
+            self.increment("av_failed")
+
+        self.observe("av_response_seconds", duration)
+
+    def s3_request(self, sender, operation, duration, **kwargs):
+        self.increment(f"s3_{operation}")
+        self.observe(f"s3_{operation}_seconds", duration)
+
+    def upload_completed(self, sender, file_size, duration, **kwargs):
+        self.increment("files_uploaded")
+        self.increment("bytes_stored", file_size)
+        if duration is not None:
+            self.observe("upload_seconds", duration)
+
+    def upload_aborted(self, sender, **kwargs):
+        self.increment("files_aborted")
+
+    def get_receivers(self):
+        return [
+            (signals.upload_started, self.upload_started),
+            (signals.part_submitted, self.part_submitted),
+            (signals.part_completed, self.part_completed),
+            (signals.av_response, self.av_response),
+            (signals.s3_request, self.s3_request),
+            (signals.upload_completed, self.upload_completed),
+            (signals.upload_aborted, self.upload_aborted),
+        ]
+
+    def connect(self):
+        for signal, receiver in self.get_receivers():
+            signal.connect(receiver)
+
+    def disconnect(self):
+        for signal, receiver in self.get_receivers():
+            signal.disconnect(receiver)
+
+
+_metrics_collector = None
+_metrics_collector_lock = threading.Lock()
+
+
+def get_metrics_collector():
+    global _metrics_collector
+
+    if _metrics_collector is None:
+        with _metrics_collector_lock:
+            if _metrics_collector is None:
+                collector = MetricsCollector()
+                collector.connect()
+                _metrics_collector = collector
+
+    return _metrics_collector
+
+
+def reset_metrics_collector():
+    # Counts are per process, a child starts from nothing. The collector is
+    # kept connected so that signals are not counted twice
+    global _metrics_collector_lock
+
+    _metrics_collector_lock = threading.Lock()
+    if _metrics_collector is not None:
+        _metrics_collector._lock = threading.Lock()
+        _metrics_collector.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_metrics_collector)
@@ -0,0 +1,74 @@
+import logging
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+# Log the upload timings of each request as well as adding the header
+CHUNK_UPLOADER_LOG_TIMINGS = getattr(settings, "CHUNK_UPLOADER_LOG_TIMINGS", False)
+
+
+def get_upload_timings(request):
+    # Only files the view has already parsed are included, the request body
+    # is never read here
+    files = request.__dict__.get("_files")
+    if not files:
+        return {}
+
+    timings = {}
+    for _, uploaded_files in files.lists():
+        for uploaded_file in uploaded_files:
+            file_timings = getattr(uploaded_file, "timings", None)
+            if file_timings is None:
+                file_timings = (
+                    getattr(uploaded_file, "content_type_extra", None) or {}
+                ).get("upload_timings", {})
+
+            for phase, seconds in file_timings.items():
+                timings[phase] = timings.get(phase, 0) + seconds
+
+    return timings
+
+
+def format_server_timing(timings):
+    return ", ".join(
+        f"{phase.replace('_', '-')};dur={seconds * 1000:.1f}"
+        for phase, seconds in timings.items()
+    )
+
+
+class ServerTimingMiddleware:
+    # Adds the time spent in each phase of the request's uploads, summed
+    # over its files, as a Server-Timing header
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        timings = get_upload_timings(request)
+        if not timings:
+            return response
+
+        server_timing = format_server_timing(timings)
+        if response.has_header("Server-Timing"):
+            server_timing = f"{response['Server-Timing']}, {server_timing}"
+        response["Server-Timing"] = server_timing
+
+        if CHUNK_UPLOADER_LOG_TIMINGS:
+            logger.info(
+                "Upload timings for %s: %s",
+                request.path,
+                server_timing,
+                extra={
+                    "upload_path": request.path,
+                    "upload_timings": {
+                        phase: round(seconds * 1000, 1)
+                        for phase, seconds in timings.items()
+                    },
+                },
+            )
+
+        return response
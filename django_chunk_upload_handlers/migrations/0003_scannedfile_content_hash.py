@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-16 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_chunk_upload_handlers", "0002_alter_scannedfile_id"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scannedfile",
+            name="content_hash",
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.16 on 2026-10-16 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_chunk_upload_handlers", "0003_scannedfile_content_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scannedfile",
+            name="pending",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="scannedfile",
+            name="quarantine_key",
+            field=models.CharField(blank=True, max_length=1024, null=True),
+        ),
+        migrations.AddField(
+            model_name="scannedfile",
+            name="final_key",
+            field=models.CharField(blank=True, max_length=1024, null=True),
+        ),
+        migrations.AddField(
+            model_name="scannedfile",
+            name="content_type",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name="scannedfile",
+            name="file_size",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
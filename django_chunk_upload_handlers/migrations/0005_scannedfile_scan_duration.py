@@ -0,0 +1,24 @@
+# Generated by Django 4.2.16 on 2026-10-16 13:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_chunk_upload_handlers", "0004_scannedfile_pending"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="scannedfile",
+            name="scanned_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="scannedfile",
+            name="scan_duration",
+            field=models.DurationField(blank=True, null=True),
+        ),
+    ]
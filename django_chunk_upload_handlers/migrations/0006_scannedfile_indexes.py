@@ -0,0 +1,60 @@
+# Generated by Django 4.2.16 on 2026-10-16 14:20
+
+from django.db import migrations, models
+
+
+class AddIndexConcurrentlyOnPostgres(migrations.AddIndex):
+    # The table can be large, on PostgreSQL the indexes are built without
+    # blocking writes to it. This needs the migration to be non-atomic
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+
+        if schema_editor.connection.vendor == "postgresql":
+            schema_editor.add_index(model, self.index, concurrently=True)
+        else:
+            schema_editor.add_index(model, self.index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+
+        if schema_editor.connection.vendor == "postgresql":
+            schema_editor.remove_index(model, self.index, concurrently=True)
+        else:
+            schema_editor.remove_index(model, self.index)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ("django_chunk_upload_handlers", "0005_scannedfile_scan_duration"),
+    ]
+
+    operations = [
+        AddIndexConcurrentlyOnPostgres(
+            model_name="scannedfile",
+            index=models.Index(fields=["scanned_at"], name="scannedfile_scanned_at_idx"),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name="scannedfile",
+            index=models.Index(fields=["av_passed", "scanned_at"], name="scannedfile_av_passed_idx"),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name="scannedfile",
+            index=models.Index(fields=["content_hash"], name="scannedfile_content_hash_idx"),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name="scannedfile",
+            index=models.Index(
+                condition=models.Q(("pending", True)),
+                fields=["scanned_at"],
+                name="scannedfile_pending_idx",
+            ),
+        ),
+    ]
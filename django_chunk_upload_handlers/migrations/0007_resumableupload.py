@@ -0,0 +1,39 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:59
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_chunk_upload_handlers", "0006_scannedfile_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ResumableUpload",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("token", models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ("created_at", models.DateTimeField(default=django.utils.timezone.now)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("file_name", models.CharField(max_length=255)),
+                ("content_type", models.CharField(blank=True, max_length=255, null=True)),
+                ("size", models.BigIntegerField()),
+                ("key", models.CharField(max_length=1024)),
+                ("final_key", models.CharField(max_length=1024)),
+                ("upload_id", models.CharField(max_length=1024)),
+                ("part_size", models.BigIntegerField()),
+                ("checksum_algorithm", models.CharField(blank=True, max_length=16, null=True)),
+                ("offset", models.BigIntegerField(default=0)),
+                ("parts", models.JSONField(default=list)),
+                ("scanned_file", models.OneToOneField(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to="django_chunk_upload_handlers.scannedfile")),
+            ],
+            options={
+                "indexes": [models.Index(fields=["created_at"], name="resumableupload_created_idx")],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.16 on 2026-10-16 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_chunk_upload_handlers", "0007_resumableupload"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scannedfile",
+            name="scan_attempts",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="scannedfile",
+            name="next_scan_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,8 +1,12 @@
+import uuid
+
 from django.db import models
+from django.utils import timezone
 
 
 class ScannedFile(models.Model):
-    scanned_at = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, records written in batches keep the time of the scan
+    scanned_at = models.DateTimeField(default=timezone.now)
     file_name = models.CharField(max_length=255)
     av_passed = models.BooleanField(default=False)
     av_reason = models.CharField(
@@ -10,3 +14,101 @@ class ScannedFile(models.Model):
         blank=True,
         null=True,
     )
+    content_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        null=True,
+    )
+    # Used when files are scanned after the upload request has returned,
+    # the file waits under quarantine_key until it is scanned
+    pending = models.BooleanField(default=False)
+    quarantine_key = models.CharField(
+        max_length=1024,
+        blank=True,
+        null=True,
+    )
+    final_key = models.CharField(
+        max_length=1024,
+        blank=True,
+        null=True,
+    )
+    content_type = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+    )
+    file_size = models.BigIntegerField(
+        blank=True,
+        null=True,
+    )
+    scan_duration = models.DurationField(
+        blank=True,
+        null=True,
+    )
+    # Used by process_pending_scans, a pending file is not scanned again
+    # before next_scan_at, either while a worker has it or after a failure
+    scan_attempts = models.PositiveIntegerField(default=0)
+    next_scan_at = models.DateTimeField(
+        blank=True,
+        null=True,
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["scanned_at"], name="scannedfile_scanned_at_idx"),
+            models.Index(fields=["av_passed", "scanned_at"], name="scannedfile_av_passed_idx"),
+            models.Index(fields=["content_hash"], name="scannedfile_content_hash_idx"),
+            # Only the few rows waiting for a scan are indexed
+            models.Index(
+                fields=["scanned_at"],
+                name="scannedfile_pending_idx",
+                condition=models.Q(pending=True),
+            ),
+        ]
+
+
+class ResumableUpload(models.Model):
+    # An S3 multipart upload continued across requests, see resumable.py.
+    # The token is the upload's public id
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+    file_name = models.CharField(max_length=255)
+    content_type = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+    )
+    size = models.BigIntegerField()
+    key = models.CharField(max_length=1024)
+    final_key = models.CharField(max_length=1024)
+    upload_id = models.CharField(max_length=1024)
+    part_size = models.BigIntegerField()
+    checksum_algorithm = models.CharField(
+        max_length=16,
+        blank=True,
+        null=True,
+    )
+    # Bytes stored in acknowledged parts, always a whole number of parts
+    # until the upload is complete
+    offset = models.BigIntegerField(default=0)
+    # Part numbers, ETags and checksums to complete the upload with
+    parts = models.JSONField(default=list)
+    # Left pointing at nothing once prune_scanned_files removes the record,
+    # so that pruning does not have to look for resumable uploads
+    scanned_file = models.OneToOneField(
+        ScannedFile,
+        blank=True,
+        null=True,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at"], name="resumableupload_created_idx"),
+        ]
+
+    @property
+    def completed(self):
+        return self.scanned_file_id is not None
@@ -0,0 +1,172 @@
+import logging
+import os
+from datetime import timedelta
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from django_chunk_upload_handlers import clam_av, clamd
+from django_chunk_upload_handlers.clam_av import (
+    CHUNK_SIZE,
+    ClamAVFileUploadHandler,
+)
+from django_chunk_upload_handlers.models import ScannedFile
+from django_chunk_upload_handlers.s3 import (
+    AWS_STORAGE_BUCKET_NAME,
+    get_s3_client,
+    promote_scanned_file,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+# Files that could not be scanned this many times are given up on
+CHUNK_UPLOADER_SCAN_MAX_ATTEMPTS = getattr(settings, "CHUNK_UPLOADER_SCAN_MAX_ATTEMPTS", 10)
+# Seconds before a file is scanned again after an error, doubled for each
+# attempt
+CHUNK_UPLOADER_SCAN_RETRY_DELAY = getattr(settings, "CHUNK_UPLOADER_SCAN_RETRY_DELAY", 60)
+# Seconds a worker has to scan a file before another worker may take it
+CHUNK_UPLOADER_SCAN_LEASE = getattr(settings, "CHUNK_UPLOADER_SCAN_LEASE", 15 * 60)
+
+
+class UnscannableFileException(Exception):
+    # Trying again would give the same result
+    pass
+
+
+def scan_pending_file(scanned_file):
+    # Streams a quarantined file from S3 to ClamAV and promotes or deletes it
+    try:
+        response = get_s3_client().get_object(
+            Bucket=AWS_STORAGE_BUCKET_NAME,
+            Key=scanned_file.quarantine_key,
+        )
+    except ClientError as exc:
+        if exc.response.get("Error", {}).get("Code") == "NoSuchKey":
+            raise UnscannableFileException("File is missing from quarantine")
+        raise
+
+    size = response.get("ContentLength", scanned_file.file_size)
+    if (
+        clam_av.CLAM_AV_BACKEND == "clamd"
+        and size is not None
+        and size > clamd.CLAMD_STREAM_MAX_LENGTH
+    ):
+        response["Body"].close()
+        raise UnscannableFileException("File is too large to scan")
+
+    handler = ClamAVFileUploadHandler()
+    handler.async_scan = None
+    handler.new_file(
+        "file",
+        scanned_file.file_name or os.path.basename(scanned_file.final_key),
+        scanned_file.content_type,
+        scanned_file.file_size,
+        content_type_extra={},
+    )
+    handler.scanned_file = scanned_file
+
+    start = 0
+    for chunk in response["Body"].iter_chunks(CHUNK_SIZE):
+        handler.receive_data_chunk(chunk, start)
+        start += len(chunk)
+
+    # Errors from ClamAV leave the file pending and in quarantine
+    handler.file_complete(start)
+
+    promote_scanned_file(scanned_file)
+
+
+def claim_pending_file(pk):
+    # A conditional update rather than a lock, so that no transaction is
+    # held open while the file is scanned. The lease runs out if the worker
+    # dies, letting another worker take the file
+    now = timezone.now()
+    claimed = ScannedFile.objects.filter(
+        Q(next_scan_at__isnull=True) | Q(next_scan_at__lte=now),
+        pk=pk,
+        pending=True,
+    ).update(
+        scan_attempts=F("scan_attempts") + 1,
+        next_scan_at=now + timedelta(seconds=CHUNK_UPLOADER_SCAN_LEASE),
+    )
+
+    if not claimed:
+        return None
+
+    return ScannedFile.objects.get(pk=pk)
+
+
+def retry_pending_file(scanned_file):
+    if scanned_file.scan_attempts >= CHUNK_UPLOADER_SCAN_MAX_ATTEMPTS:
+        fail_pending_file(scanned_file, "File could not be scanned")
+        return
+
+    delay = CHUNK_UPLOADER_SCAN_RETRY_DELAY * 2 ** (scanned_file.scan_attempts - 1)
+    # A file may have its verdict but still be in quarantine, it is scanned
+    # again in full
+    ScannedFile.objects.filter(pk=scanned_file.pk).update(
+        pending=True,
+        next_scan_at=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+def fail_pending_file(scanned_file, av_reason):
+    # The file is treated as having failed its scan and is deleted
+    scanned_file.pending = False
+    scanned_file.av_passed = False
+    scanned_file.av_reason = av_reason
+    scanned_file.scanned_at = timezone.now()
+    scanned_file.next_scan_at = None
+    scanned_file.save(
+        update_fields=["pending", "av_passed", "av_reason", "scanned_at", "next_scan_at"],
+    )
+
+    try:
+        promote_scanned_file(scanned_file)
+    except ClientError:
+        logger.error(
+            f"Error deleting '{scanned_file.quarantine_key}' from quarantine",
+            exc_info=True,
+        )
+
+
+def scan_claimed_file(scanned_file):
+    # Returns whether the file has its final result, errors only hold up
+    # this file, which is scanned again later
+    try:
+        scan_pending_file(scanned_file)
+    except UnscannableFileException as exc:
+        logger.error(f"Cannot scan '{scanned_file.quarantine_key}': {exc}")
+        fail_pending_file(scanned_file, str(exc))
+    except Exception:
+        logger.error(
+            f"Error scanning '{scanned_file.quarantine_key}', "
+            f"attempt {scanned_file.scan_attempts}",
+            exc_info=True,
+        )
+        retry_pending_file(scanned_file)
+        return False
+
+    return True
+
+
+def process_pending_scans(batch_size=100):
+    now = timezone.now()
+    pending = ScannedFile.objects.filter(
+        Q(next_scan_at__isnull=True) | Q(next_scan_at__lte=now),
+        pending=True,
+        quarantine_key__isnull=False,
+    ).order_by("scanned_at").values_list("pk", flat=True)[:batch_size]
+
+    processed = 0
+    for pk in list(pending):
+        # Files taken by another worker are skipped
+        scanned_file = claim_pending_file(pk)
+        if scanned_file is not None and scan_claimed_file(scanned_file):
+            processed += 1
+
+    return processed
@@ -0,0 +1,147 @@
+import logging
+from concurrent.futures import wait
+
+from django_chunk_upload_handlers.models import ResumableUpload, ScannedFile
+from django_chunk_upload_handlers.s3 import (
+    AWS_STORAGE_BUCKET_NAME,
+    S3_DELETE_OBJECTS_BATCH_SIZE,
+    S3_TEMPORARY_KEY_PREFIX,
+    get_executor,
+    get_s3_client,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def list_stale_uploads(client, bucket, prefix, cutoff):
+    paginator = client.get_paginator("list_multipart_uploads")
+
+    return [
+        (upload["Key"], upload["UploadId"])
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for upload in page.get("Uploads", [])
+        if upload["Initiated"] < cutoff
+    ]
+
+
+def list_stale_objects(client, bucket, prefix, cutoff):
+    paginator = client.get_paginator("list_objects_v2")
+
+    return [
+        (item["Key"], item["Size"])
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for item in page.get("Contents", [])
+        if item["LastModified"] < cutoff
+    ]
+
+
+def abort_upload(client, bucket, key, upload_id):
+    client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+
+def delete_objects(client, bucket, keys):
+    response = client.delete_objects(
+        Bucket=bucket,
+        Delete={
+            "Objects": [{"Key": key} for key in keys],
+            "Quiet": True,
+        },
+    )
+
+    # Only failures are listed in quiet mode
+    for error in response.get("Errors", []):
+        logger.error(f"Could not delete {error['Key']}: {error.get('Message')}")
+
+    return len(keys) - len(response.get("Errors", []))
+
+
+def reap_chunk_uploads(prefix, cutoff, dry_run=False):
+    # Removes what is left behind by uploads whose worker died before
+    # aborting them, the multipart uploads under prefix and temporary
+    # objects. Only temporary objects are listed, whatever the prefix, as
+    # finished files may be stored alongside the multipart uploads
+    client = get_s3_client()
+    bucket = AWS_STORAGE_BUCKET_NAME
+    executor = get_executor()
+
+    uploads_future = executor.submit(list_stale_uploads, client, bucket, prefix, cutoff)
+    objects_future = executor.submit(
+        list_stale_objects, client, bucket, S3_TEMPORARY_KEY_PREFIX, cutoff,
+    )
+    uploads = uploads_future.result()
+    objects = objects_future.result()
+
+    # Resumable uploads are reaped along with their multipart uploads once
+    # nothing has been sent to them since the cutoff, however long ago they
+    # were started. Completed ones waiting to be scanned are kept
+    unfinished_uploads = ResumableUpload.objects.filter(
+        key__startswith=prefix,
+        scanned_file__isnull=True,
+    )
+    resumable_uploads = unfinished_uploads.filter(updated_at__lt=cutoff)
+    active_upload_ids = set(
+        unfinished_uploads.filter(updated_at__gte=cutoff).values_list("upload_id", flat=True)
+    )
+    pending_keys = set(
+        ScannedFile.objects.filter(
+            pending=True,
+            quarantine_key__startswith=S3_TEMPORARY_KEY_PREFIX,
+        ).values_list("quarantine_key", flat=True)
+    )
+    uploads = [
+        (key, upload_id)
+        for key, upload_id in uploads
+        if upload_id not in active_upload_ids
+    ]
+    objects = [(key, size) for key, size in objects if key not in pending_keys]
+
+    summary = {
+        "resumable_uploads_found": resumable_uploads.count(),
+        "uploads_found": len(uploads),
+        "uploads_aborted": 0,
+        "objects_found": len(objects),
+        "objects_deleted": 0,
+        "bytes_found": sum(size for _, size in objects),
+        "errors": 0,
+    }
+
+    if dry_run:
+        return summary
+
+    resumable_uploads.delete()
+
+    abort_futures = [
+        executor.submit(abort_upload, client, bucket, key, upload_id)
+        for key, upload_id in uploads
+    ]
+    keys = [key for key, _ in objects]
+    delete_futures = [
+        executor.submit(
+            delete_objects,
+            client,
+            bucket,
+            keys[offset:offset + S3_DELETE_OBJECTS_BATCH_SIZE],
+        )
+        for offset in range(0, len(keys), S3_DELETE_OBJECTS_BATCH_SIZE)
+    ]
+    wait(abort_futures + delete_futures)
+
+    for future in abort_futures:
+        if future.exception():
+            logger.error("Could not abort multipart upload", exc_info=future.exception())
+        else:
+            summary["uploads_aborted"] += 1
+
+    for future in delete_futures:
+        if future.exception():
+            logger.error("Could not delete objects", exc_info=future.exception())
+        else:
+            summary["objects_deleted"] += future.result()
+
+    summary["errors"] = (
+        summary["uploads_found"] - summary["uploads_aborted"]
+        + summary["objects_found"] - summary["objects_deleted"]
+    )
+
+    return summary
@@ -0,0 +1,245 @@
+import logging
+import uuid
+from concurrent.futures import wait
+
+from botocore.exceptions import ClientError
+from django.db import connection
+from django.http import UnreadablePostError
+from django.utils import timezone
+
+from django_chunk_upload_handlers import checksums
+from django_chunk_upload_handlers.clam_av import (
+    CHUNK_SIZE,
+    CHUNK_UPLOADER_ASYNC_SCAN,
+    get_scan_executor,
+)
+from django_chunk_upload_handlers.models import ResumableUpload, ScannedFile
+from django_chunk_upload_handlers.pipeline import claim_pending_file, scan_claimed_file
+from django_chunk_upload_handlers.s3 import (
+    AWS_STORAGE_BUCKET_NAME,
+    CHUNK_UPLOADER_CHECKSUM_ALGORITHM,
+    CHUNK_UPLOADER_PART_SIZE,
+    S3_MAX_PART_SIZE,
+    S3_MAX_PARTS,
+    S3_TEMPORARY_KEY_PREFIX,
+    AbortS3UploadException,
+    ThreadedS3ChunkUploader,
+    get_new_file_name,
+    get_s3_client,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class ResumableUploadError(Exception):
+    status = 400
+
+
+class UploadOffsetMismatch(ResumableUploadError):
+    # The client's idea of how much has been stored is out of date, it
+    # should continue from offset
+    status = 409
+
+    def __init__(self, offset):
+        super().__init__(f"Upload continues from byte {offset}")
+        self.offset = offset
+
+
+class UploadGone(ResumableUploadError):
+    status = 410
+
+
+def get_part_size(size):
+    # Parts are the same size throughout, so that the number of each part
+    # follows from its offset. Ceiling division fits the file in the part
+    # count limit
+    return max(CHUNK_UPLOADER_PART_SIZE, -(-size // S3_MAX_PARTS))
+
+
+def get_uploader(upload):
+    uploader = ThreadedS3ChunkUploader(
+        get_s3_client(),
+        AWS_STORAGE_BUCKET_NAME,
+        key=upload.key,
+        upload_id=upload.upload_id or None,
+        content_type=upload.content_type,
+        part_size=upload.part_size,
+        max_part_size=upload.part_size,
+        checksum_algorithm=upload.checksum_algorithm,
+    )
+    uploader.part_number = upload.offset // upload.part_size
+
+    return uploader
+
+
+def create_resumable_upload(file_name, size, content_type=None):
+    part_size = get_part_size(size)
+    if size < 0 or part_size > S3_MAX_PART_SIZE:
+        raise ResumableUploadError(f"Cannot upload a file of {size} bytes")
+
+    upload = ResumableUpload(
+        file_name=file_name[:255],
+        content_type=content_type,
+        size=size,
+        key=f"{S3_TEMPORARY_KEY_PREFIX}{uuid.uuid4()}",
+        final_key=get_new_file_name(file_name),
+        part_size=part_size,
+        checksum_algorithm=CHUNK_UPLOADER_CHECKSUM_ALGORITHM,
+    )
+
+    uploader = get_uploader(upload)
+    uploader.start()
+    upload.upload_id = uploader.upload_id
+    upload.save()
+
+    return upload
+
+
+def get_acknowledged_parts(uploader):
+    # Parts are only kept up to the first that failed, so that the offset
+    # covers every byte before it
+    parts = []
+    for part_number, future in uploader.parts:
+        if future.exception() is not None:
+            if (
+                isinstance(future.exception(), ClientError)
+                and future.exception().response.get("Error", {}).get("Code") == "NoSuchUpload"
+            ):
+                raise UploadGone("The upload has expired")
+
+            logger.warning(
+                "Part %s of %s failed and will be sent again",
+                part_number, uploader.key, exc_info=future.exception(),
+            )
+            break
+
+        part = {"PartNumber": part_number, "ETag": future.result()["ETag"]}
+        if uploader.checksum_algorithm:
+            part[f"Checksum{uploader.checksum_algorithm}"] = checksums.encode(
+                uploader.digests[part_number],
+            )
+        parts.append(part)
+
+    return parts
+
+
+def append_to_upload(upload, stream, start, end):
+    # Sends bytes start to end (inclusive) of the file, read from stream, as
+    # parts of the upload. Only whole parts are kept, apart from the last
+    # part of the file, so a request that is cut short keeps everything up
+    # to the last part it completed and the client continues from there
+    if upload.completed or start != upload.offset:
+        raise UploadOffsetMismatch(upload.offset)
+
+    if end < start - 1 or end >= upload.size:
+        raise ResumableUploadError(f"Range {start}-{end} is outside the file")
+
+    uploader = get_uploader(upload)
+    length = end - start + 1
+    received = 0
+
+    try:
+        while received < length:
+            chunk = stream.read(min(CHUNK_SIZE, length - received))
+            if not chunk:
+                break
+            uploader.add(chunk)
+            received += len(chunk)
+    except (OSError, UnreadablePostError, AbortS3UploadException):
+        logger.warning("Upload of %s was cut short", upload.key, exc_info=True)
+
+    if received == length and start + received == upload.size:
+        uploader.add(None)
+    else:
+        uploader.discard()
+
+    wait(uploader.futures)
+
+    try:
+        parts = get_acknowledged_parts(uploader)
+    except UploadGone:
+        upload.delete()
+        raise
+
+    offset = min(upload.size, start + len(parts) * upload.part_size)
+
+    # Another request for the same upload may have moved it on meanwhile
+    updated = ResumableUpload.objects.filter(pk=upload.pk, offset=start).update(
+        offset=offset,
+        parts=upload.parts + parts,
+        updated_at=timezone.now(),
+    )
+    if not updated:
+        upload.refresh_from_db()
+        raise UploadOffsetMismatch(upload.offset)
+
+    upload.offset = offset
+    upload.parts = upload.parts + parts
+
+    return upload
+
+
+def scan_in_background(scanned_file):
+    # Claimed as process_pending_scans would, which tries the file again
+    # if it cannot be scanned here
+    try:
+        scanned_file = claim_pending_file(scanned_file.pk)
+        if scanned_file is not None:
+            scan_claimed_file(scanned_file)
+    except Exception:
+        logger.error("Error scanning resumable upload in the background", exc_info=True)
+    finally:
+        connection.close()
+
+
+def complete_resumable_upload(upload):
+    # Once every byte has been stored the upload is completed and the file
+    # is scanned in quarantine, as with CHUNK_UPLOADER_ASYNC_SCAN. The scan
+    # is never left to the request, which would have to wait for the whole
+    # file to be downloaded again
+    if upload.completed:
+        return upload.scanned_file
+
+    if upload.offset != upload.size:
+        raise UploadOffsetMismatch(upload.offset)
+
+    try:
+        get_s3_client().complete_multipart_upload(
+            Bucket=AWS_STORAGE_BUCKET_NAME,
+            Key=upload.key,
+            UploadId=upload.upload_id,
+            MultipartUpload={"Parts": upload.parts},
+        )
+    except ClientError as exc:
+        if exc.response.get("Error", {}).get("Code") == "NoSuchUpload":
+            upload.delete()
+            raise UploadGone("The upload has expired")
+        raise
+
+    scanned_file = ScannedFile.objects.create(
+        file_name=upload.file_name,
+        content_type=upload.content_type,
+        file_size=upload.size,
+        pending=True,
+        quarantine_key=upload.key,
+        final_key=upload.final_key,
+    )
+    upload.scanned_file = scanned_file
+    upload.save(update_fields=["scanned_file", "updated_at"])
+
+    if CHUNK_UPLOADER_ASYNC_SCAN != "database":
+        get_scan_executor().submit(scan_in_background, scanned_file)
+
+    return scanned_file
+
+
+def abort_resumable_upload(upload):
+    if not upload.completed:
+        get_s3_client().abort_multipart_upload(
+            Bucket=AWS_STORAGE_BUCKET_NAME,
+            Key=upload.key,
+            UploadId=upload.upload_id,
+        )
+
+    upload.delete()
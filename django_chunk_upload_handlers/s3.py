@@ -1,14 +1,24 @@
 import concurrent.futures
 import logging
+import os
 import pathlib
+import random
+import threading
+import time
 import uuid
+from collections import deque
 from concurrent.futures import (
     wait,
+    Future,
     ThreadPoolExecutor,
 )
 
 from boto3 import client as boto3_client
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
 from django.core.files.uploadhandler import (
     FileUploadHandler,
     UploadFileException,
@@ -19,8 +29,20 @@ from storages.backends.s3boto3 import (
     S3Boto3StorageFile,
 )
 
-from django_chunk_upload_handlers.util import check_required_setting
-from django_chunk_upload_handlers.clam_av import FileWithVirus, VirusFoundInFileException
+from django_chunk_upload_handlers import checksums, signals
+from django_chunk_upload_handlers.buffers import (
+    PartBufferPool,
+    close_spooled_buffer,
+    is_spooled,
+    part_body,
+    spooled_buffer,
+)
+from django_chunk_upload_handlers.util import add_timing, check_required_setting
+from django_chunk_upload_handlers.clam_av import (
+    CHUNK_UPLOADER_ASYNC_SCAN,
+    FileWithVirus,
+    VirusFoundInFileException,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -49,12 +71,110 @@ AWS_S3_ENDPOINT_URL = getattr(settings, "AWS_S3_ENDPOINT_URL", None)
 S3_ROOT_DIRECTORY = getattr(settings, "CHUNK_UPLOADER_S3_ROOT_DIRECTORY", "")
 
 S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+S3_MAX_PARTS = 10000
+# Part size doubles after every interval so that uploads of unknown size
+# can reach the S3 object size limit within the part count limit
+S3_PART_SIZE_GROWTH_INTERVAL = 1000
+S3_MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+S3_COPY_PART_SIZE = 512 * 1024 * 1024
+S3_DELETE_OBJECTS_BATCH_SIZE = 1000
+# Files are uploaded to a temporary key under this prefix and then copied
+S3_TEMPORARY_KEY_PREFIX = "chunk_upload_"
+
+
+
+def check_part_size(part_size):
+    # S3 refuses to complete an upload whose parts, other than the last,
+    # are smaller than this
+    if part_size < S3_MIN_PART_SIZE:
+        raise ImproperlyConfigured(
+            f"The part size must be at least {S3_MIN_PART_SIZE} bytes, not {part_size}"
+        )
+
+    return part_size
+
+
+CHUNK_UPLOADER_PART_SIZE = check_part_size(getattr(
+    settings, "CHUNK_UPLOADER_PART_SIZE",
+    S3_MIN_PART_SIZE,
+))
+CHUNK_UPLOADER_MAX_PART_SIZE = getattr(
+    settings, "CHUNK_UPLOADER_MAX_PART_SIZE",
+    512 * 1024 * 1024,
+)
+
+CHUNK_UPLOADER_MAX_WORKERS = getattr(settings, "CHUNK_UPLOADER_MAX_WORKERS", 10)
+CHUNK_UPLOADER_MAX_POOL_CONNECTIONS = getattr(
+    settings, "CHUNK_UPLOADER_MAX_POOL_CONNECTIONS",
+    CHUNK_UPLOADER_MAX_WORKERS,
+)
+CHUNK_UPLOADER_MAX_IN_FLIGHT_BYTES = getattr(
+    settings, "CHUNK_UPLOADER_MAX_IN_FLIGHT_BYTES",
+    2 * CHUNK_UPLOADER_MAX_WORKERS * S3_MIN_PART_SIZE,
+)
+
+# Parts beyond the in flight budget are written to memory-mapped temporary
+# files, up to this many bytes per process, rather than holding up the
+# request. Disabled if not set
+CHUNK_UPLOADER_SPOOL_MAX_BYTES = getattr(settings, "CHUNK_UPLOADER_SPOOL_MAX_BYTES", None)
+# Where spooled parts are written, the default temporary directory if not set
+CHUNK_UPLOADER_SPOOL_DIRECTORY = getattr(settings, "CHUNK_UPLOADER_SPOOL_DIRECTORY", None)
+
+# The number of parts sent at once by a process adapts between these limits,
+# growing while S3 keeps up and halving when it slows down or throttles
+CHUNK_UPLOADER_MIN_CONCURRENCY = getattr(settings, "CHUNK_UPLOADER_MIN_CONCURRENCY", 2)
+CHUNK_UPLOADER_LATENCY_SPIKE_FACTOR = getattr(
+    settings, "CHUNK_UPLOADER_LATENCY_SPIKE_FACTOR",
+    2,
+)
+# The most parts of a single upload sent at once, unlimited if not set
+CHUNK_UPLOADER_UPLOAD_CONCURRENCY = getattr(
+    settings, "CHUNK_UPLOADER_UPLOAD_CONCURRENCY",
+    None,
+)
+
+# Checksums sent with each part and recorded for the whole object, one of
+# "CRC32", "CRC32C" (needs awscrt), "SHA1" or "SHA256"
+CHUNK_UPLOADER_CHECKSUM_ALGORITHM = getattr(
+    settings, "CHUNK_UPLOADER_CHECKSUM_ALGORITHM",
+    None,
+)
+
+# Parts are retried with jittered exponential backoff, on top of any retries
+# made by botocore, so that a failed part does not fail the whole upload
+CHUNK_UPLOADER_PART_ATTEMPTS = getattr(settings, "CHUNK_UPLOADER_PART_ATTEMPTS", 5)
+CHUNK_UPLOADER_RETRY_BASE_DELAY = getattr(settings, "CHUNK_UPLOADER_RETRY_BASE_DELAY", 0.5)
+CHUNK_UPLOADER_RETRY_MAX_DELAY = getattr(settings, "CHUNK_UPLOADER_RETRY_MAX_DELAY", 20)
+
+S3_RETRYABLE_ERROR_CODES = {
+    "InternalError",
+    "RequestTimeout",
+    "RequestTimeoutException",
+    "ServiceUnavailable",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+}
 
 CHUNK_UPLOADER_RAISE_EXCEPTION_ON_VIRUS_FOUND = getattr(
     settings, "CHUNK_UPLOADER_RAISE_EXCEPTION_ON_VIRUS_FOUND",
     False,
 )
 
+# Upload straight to the final key and record AV results as object tags
+# rather than uploading to a temporary key and copying
+CHUNK_UPLOADER_DIRECT_UPLOAD = getattr(
+    settings, "CHUNK_UPLOADER_DIRECT_UPLOAD",
+    False,
+)
+
+# Files waiting for an asynchronous scan are kept under this prefix
+CHUNK_UPLOADER_QUARANTINE_PREFIX = getattr(
+    settings, "CHUNK_UPLOADER_QUARANTINE_PREFIX",
+    "quarantine/",
+)
+
 if (
     (getattr(settings, "DEFAULT_FILE_STORAGE", None) is None)
     or settings.DEFAULT_FILE_STORAGE  # noqa W504
@@ -65,54 +185,754 @@ if (
         "or a class that inherits from it with this file handler"
     )
 
+if CHUNK_UPLOADER_CHECKSUM_ALGORITHM and not checksums.is_available(
+    CHUNK_UPLOADER_CHECKSUM_ALGORITHM,
+):
+    logger.error(
+        f"Checksum algorithm '{CHUNK_UPLOADER_CHECKSUM_ALGORITHM}' is not "
+        f"available, files will be uploaded without checksums"
+    )
+    CHUNK_UPLOADER_CHECKSUM_ALGORITHM = None
+
 if S3_ROOT_DIRECTORY and not S3_ROOT_DIRECTORY.endswith("/"):
     S3_ROOT_DIRECTORY = f"{S3_ROOT_DIRECTORY}/"
 
 
-class ThreadedS3ChunkUploader(ThreadPoolExecutor):
-    def __init__(self, client, bucket, key, upload_id, max_workers=None):
-        max_workers = max_workers or 10
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+
+def get_s3_client():
+    # boto3 clients are thread safe, so one client (and its connection
+    # pool) is shared by every upload in the process rather than paying
+    # for service model loading, credential resolution and TLS handshakes
+    # on every file
+    key = (
+        AWS_REGION,
+        AWS_S3_ENDPOINT_URL,
+        AWS_ACCESS_KEY_ID,
+        AWS_SECRET_ACCESS_KEY,
+        CHUNK_UPLOADER_MAX_POOL_CONNECTIONS,
+    )
+
+    client = _s3_clients.get(key)
+    if client is not None:
+        return client
+
+    with _s3_clients_lock:
+        client = _s3_clients.get(key)
+        if client is None:
+            client = boto3_client("s3", **get_s3_client_kwargs())
+            _s3_clients[key] = client
+
+    return client
+
+
+def get_s3_client_kwargs():
+    extra_kwargs = {}
+    if AWS_S3_ENDPOINT_URL:
+        extra_kwargs['endpoint_url'] = AWS_S3_ENDPOINT_URL
+
+    if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
+        extra_kwargs['aws_access_key_id'] = AWS_ACCESS_KEY_ID
+        extra_kwargs['aws_secret_access_key'] = AWS_SECRET_ACCESS_KEY
+
+    return {
+        "region_name": AWS_REGION,
+        "config": Config(
+            max_pool_connections=CHUNK_UPLOADER_MAX_POOL_CONNECTIONS,
+        ),
+        **extra_kwargs,
+    }
+
+
+_storage = None
+
+
+def get_storage():
+    global _storage
+
+    if _storage is None:
+        _storage = S3Boto3Storage()
+
+    return _storage
+
+
+def reset_s3_clients():
+    global _s3_clients_lock, _storage
+
+    # Connection pools must not be shared with a parent process, and the
+    # lock may have been held by another thread at the time of the fork
+    _s3_clients_lock = threading.Lock()
+    _s3_clients.clear()
+    _storage = None
+
+
+class InFlightBudget:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        # A part larger than the whole budget is let through on its own
+        # rather than blocking forever
+        size = min(size, self.capacity)
+
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.in_flight + size <= self.capacity
+            )
+            self.in_flight += size
+
+        return size
+
+    def release(self, size):
+        with self._condition:
+            self.in_flight -= size
+            self._condition.notify_all()
+
+    def has_room(self, size):
+        return self.in_flight + min(size, self.capacity) <= self.capacity
+
+
+class ConcurrencyController:
+    def __init__(self, min_limit, max_limit, spike_factor):
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.spike_factor = spike_factor
+        self.limit = float(self.min_limit)
+        self.in_flight = 0
+        # Seconds per byte, averaged over recent parts
+        self.latency = None
+        self.slow_start = True
+        self.last_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    def release(self, size, elapsed, congested=False):
+        with self._condition:
+            self.in_flight -= 1
+
+            # Small parts are mostly request overhead, so say nothing
+            # about throughput
+            sample = elapsed / size if size >= S3_MIN_PART_SIZE else None
+            if sample is not None and self.latency is not None:
+                congested = congested or sample > self.latency * self.spike_factor
+
+            if congested:
+                # Parts sent at the same time see the same congestion, so
+                # back off once for each of them
+                now = time.monotonic()
+                if now - self.last_decrease > elapsed:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.slow_start = False
+                    self.last_decrease = now
+            elif self.slow_start:
+                self.limit = min(self.max_limit, self.limit + 1)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            if sample is not None:
+                self.latency = sample if self.latency is None else (
+                    0.8 * self.latency + 0.2 * sample
+                )
+
+            self._condition.notify_all()
+
+
+_executor = None
+_in_flight_budget = None
+_spool_budget = None
+_concurrency_controller = None
+_buffer_pool = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=CHUNK_UPLOADER_MAX_WORKERS,
+                    thread_name_prefix="chunk_uploader",
+                )
+
+    return _executor
+
+
+def get_in_flight_budget():
+    global _in_flight_budget
+
+    if _in_flight_budget is None:
+        with _executor_lock:
+            if _in_flight_budget is None:
+                _in_flight_budget = InFlightBudget(
+                    CHUNK_UPLOADER_MAX_IN_FLIGHT_BYTES,
+                )
+
+    return _in_flight_budget
+
+
+def get_spool_budget():
+    global _spool_budget
+
+    if _spool_budget is None and CHUNK_UPLOADER_SPOOL_MAX_BYTES:
+        with _executor_lock:
+            if _spool_budget is None:
+                _spool_budget = InFlightBudget(CHUNK_UPLOADER_SPOOL_MAX_BYTES)
+
+    return _spool_budget
+
+
+def get_concurrency_controller():
+    global _concurrency_controller
+
+    if _concurrency_controller is None:
+        with _executor_lock:
+            if _concurrency_controller is None:
+                _concurrency_controller = ConcurrencyController(
+                    min(CHUNK_UPLOADER_MIN_CONCURRENCY, CHUNK_UPLOADER_MAX_WORKERS),
+                    CHUNK_UPLOADER_MAX_WORKERS,
+                    CHUNK_UPLOADER_LATENCY_SPIKE_FACTOR,
+                )
+
+    return _concurrency_controller
+
+
+def get_buffer_pool():
+    global _buffer_pool
+
+    if _buffer_pool is None:
+        with _executor_lock:
+            if _buffer_pool is None:
+                # Enough buffers are kept to fill the in flight budget
+                # without allocating
+                _buffer_pool = PartBufferPool(
+                    CHUNK_UPLOADER_MAX_IN_FLIGHT_BYTES,
+                )
+
+    return _buffer_pool
+
+
+def reset_executor():
+    global _executor, _in_flight_budget, _spool_budget, _concurrency_controller, _buffer_pool, _executor_lock
+
+    # Worker threads do not survive a fork, so the child needs a fresh
+    # executor and an empty budget
+    _executor = None
+    _in_flight_budget = None
+    _spool_budget = None
+    _concurrency_controller = None
+    _buffer_pool = None
+    _executor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_s3_clients)
+    os.register_at_fork(after_in_child=reset_executor)
+
+
+def is_retryable(exc):
+    if isinstance(exc, ClientError):
+        error = exc.response.get("Error", {})
+        status = exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return error.get("Code") in S3_RETRYABLE_ERROR_CODES or status >= 500
+
+    return isinstance(exc, (ConnectionError, HTTPClientError))
+
+
+def get_retry_delay(attempt):
+    # Full jitter, so that parts failing together are not retried together
+    return random.uniform(
+        0,
+        min(CHUNK_UPLOADER_RETRY_MAX_DELAY, CHUNK_UPLOADER_RETRY_BASE_DELAY * 2 ** (attempt - 1)),
+    )
+
+
+def copy_object(client, bucket, source_key, key, size, **kwargs):
+    # copy_object is limited to 5GB, larger objects are copied with
+    # concurrent upload_part_copy requests
+    if size <= S3_MAX_COPY_SIZE:
+        response = client.copy_object(
+            Bucket=bucket,
+            CopySource=f"{bucket}/{source_key}",
+            Key=key,
+            MetadataDirective="REPLACE",
+            **kwargs,
+        )
+        return response["CopyObjectResult"]["ETag"]
+
+    multipart = client.create_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        **kwargs,
+    )
+    upload_id = multipart["UploadId"]
+
+    executor = get_executor()
+    futures = []
+    for part_number, offset in enumerate(range(0, size, S3_COPY_PART_SIZE), 1):
+        last_byte = min(offset + S3_COPY_PART_SIZE, size) - 1
+        futures.append((
+            part_number,
+            executor.submit(
+                client.upload_part_copy,
+                Bucket=bucket,
+                CopySource=f"{bucket}/{source_key}",
+                CopySourceRange=f"bytes={offset}-{last_byte}",
+                Key=key,
+                PartNumber=part_number,
+                UploadId=upload_id,
+            ),
+        ))
+
+    try:
+        parts = [
+            {
+                "PartNumber": part_number,
+                "ETag": future.result()["CopyPartResult"]["ETag"],
+            }
+            for part_number, future in futures
+        ]
+    except Exception:
+        wait([future for _, future in futures])
+        client.abort_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+        )
+        raise
+
+    response = client.complete_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": parts},
+    )
+    return response["ETag"]
+
+
+def get_new_file_name(file_name):
+    # The key files are stored under, timestamped so that uploads of files
+    # with the same name do not overwrite each other
+    extension = pathlib.Path(file_name).suffix
+    time_stamp = f'{timezone.now().strftime("%Y%m%d%H%M%S")}'
+    return f"{S3_ROOT_DIRECTORY}{file_name.replace(extension, '')}_{time_stamp}{extension}"
+
+
+def get_av_metadata(scanned_at):
+    return {
+        "av-scanned-at": scanned_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "av-passed": "True",
+    }
+
+
+def promote_scanned_file(scanned_file):
+    # Moves a file out of quarantine once its scan has passed, files that
+    # failed are deleted. Files without a verdict are left where they are
+    if scanned_file.pending:
+        return
+
+    client = get_s3_client()
+
+    if scanned_file.av_passed:
+        copy_object(
+            client,
+            AWS_STORAGE_BUCKET_NAME,
+            scanned_file.quarantine_key,
+            scanned_file.final_key,
+            scanned_file.file_size,
+            ContentType=scanned_file.content_type,
+            Metadata=get_av_metadata(scanned_file.scanned_at),
+        )
+    else:
+        logger.warning(
+            f"Deleting quarantined file '{scanned_file.quarantine_key}' "
+            f"that failed its virus scan"
+        )
+
+    client.delete_object(
+        Bucket=AWS_STORAGE_BUCKET_NAME,
+        Key=scanned_file.quarantine_key,
+    )
+
+
+class S3UploadedFile(File):
+    # Everything known about the object once it has been uploaded is set
+    # up front, S3 is only asked for the object if its content is read
+    def __init__(
+        self,
+        key,
+        storage,
+        size,
+        content_type,
+        original_name,
+        etag=None,
+        av_passed=None,
+        scanned_at=None,
+        checksum=None,
+        checksum_algorithm=None,
+        timings=None,
+    ):
+        self.key = key
+        self.storage = storage
+        self.name = key[len(storage.location):].lstrip("/")
+        self.mode = "rb"
+        self._file = None
+        self.size = size
+        self.file_size = size
+        self.content_type = content_type
+        self.original_name = original_name
+        self.etag = etag
+        self.av_passed = av_passed
+        self.scanned_at = scanned_at
+        self.checksum = checksum
+        self.checksum_algorithm = checksum_algorithm
+        # Seconds spent in each phase of the upload
+        self.timings = timings
+
+    def _get_file(self):
+        if self._file is None:
+            self._file = S3Boto3StorageFile(self.key, self.mode, self.storage)
+        return self._file
+
+    def _set_file(self, value):
+        self._file = value
+
+    file = property(_get_file, _set_file)
+
+    @property
+    def closed(self):
+        return self._file is None or self._file.closed
+
+    def open(self, mode=None):
+        self.file.open(mode)
+        return self
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class ThreadedS3ChunkUploader:
+    def __init__(
+        self,
+        client,
+        bucket,
+        key,
+        upload_id=None,
+        content_type=None,
+        part_size=None,
+        max_part_size=None,
+        expected_size=None,
+        max_concurrency=None,
+        checksum_algorithm=None,
+    ):
         self.bucket = bucket
         self.key = key
         self.upload_id = upload_id
+        self.content_type = content_type
         self.client = client
+        self.part_size = part_size or CHUNK_UPLOADER_PART_SIZE
+        self.max_part_size = min(
+            max_part_size or CHUNK_UPLOADER_MAX_PART_SIZE,
+            S3_MAX_PART_SIZE,
+        )
+        self.expected_size = expected_size
+        self.max_concurrency = max_concurrency or CHUNK_UPLOADER_UPLOAD_CONCURRENCY
+        self.checksum_algorithm = checksum_algorithm or CHUNK_UPLOADER_CHECKSUM_ALGORITHM
+        # Hashes the part being filled as chunks are copied into it
+        self.hasher = None
+        self.digests = {}
+        self.checksum = None
         self.part_number = 0
         self.parts = []
-        self.queue = []
+        self.buffer = None
         self.current_queue_size = 0
         self.futures = []
-        super().__init__(max_workers=max_workers)
+        self.failed = False
+        self.retry_count = 0
+        self.retry_time = 0
+        self._retry_lock = threading.Lock()
+        # Parts waiting for one of this upload's concurrency slots
+        self.pending = deque()
+        self.running = 0
+        self._pending_lock = threading.Lock()
+        self.executor = get_executor()
+        self.concurrency_controller = get_concurrency_controller()
+        self.in_flight_budget = get_in_flight_budget()
+        self.spool_budget = get_spool_budget()
+        self.buffer_pool = get_buffer_pool()
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
+
+    @property
+    def started(self):
+        return self.upload_id is not None
+
+    def start(self):
+        # The multipart upload is only created once a file is known to be
+        # larger than a single part, smaller files are sent with put_object
+        extra_kwargs = {}
+        if self.checksum_algorithm:
+            extra_kwargs["ChecksumAlgorithm"] = self.checksum_algorithm
+
+        multipart = self.client.create_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            ContentType=self.content_type,
+            **extra_kwargs,
+        )
+        self.upload_id = multipart["UploadId"]
+
+    def get_part_size(self):
+        part_size = self.part_size * 2 ** (
+            self.part_number // S3_PART_SIZE_GROWTH_INTERVAL
+        )
+
+        if self.expected_size:
+            # Ceiling division, so that the expected size fits in the
+            # maximum number of parts
+            part_size = max(part_size, -(-self.expected_size // S3_MAX_PARTS))
+
+        return min(part_size, self.max_part_size)
 
     def add(self, body):
-        if body:
-            content_length = len(body)
-            self.queue.append(body)
-            self.current_queue_size += content_length
-
-        if not body or self.current_queue_size > S3_MIN_PART_SIZE:
-            self.part_number += 1
-            _body = self.drain_queue()
-            future = self.submit(
-                self.client.upload_part,
-                Bucket=self.bucket,
-                Key=self.key,
-                PartNumber=self.part_number,
-                UploadId=self.upload_id,
-                Body=_body,
-                ContentLength=len(_body),
-            )
-            self.futures.append(future)
-            self.parts.append((self.part_number, future))
-            logger.debug("Prepared part %s", self.part_number)
+        if not body:
+            if self.current_queue_size or not self.part_number:
+                self.flush()
+            return
+
+        # Chunks are copied straight into a part sized buffer, splitting
+        # them across parts where they straddle a part boundary
+        view = memoryview(body)
+        while view:
+            if self.buffer is None:
+                self.buffer = self.acquire_buffer(self.get_part_size())
+                if self.checksum_algorithm:
+                    self.hasher = checksums.get_hasher(self.checksum_algorithm)
+
+            size = min(len(view), len(self.buffer) - self.current_queue_size)
+            self.buffer[self.current_queue_size:self.current_queue_size + size] = view[:size]
+            if self.hasher:
+                self.hasher.update(view[:size])
+            self.current_queue_size += size
+            view = view[size:]
+
+            if self.current_queue_size == len(self.buffer):
+                self.flush()
+
+    def acquire_buffer(self, size):
+        # Parts only go to disk once memory is used up, and while there is
+        # room on disk, otherwise the request waits for the memory budget
+        if (
+            self.spool_budget is not None
+            and not self.in_flight_budget.has_room(size)
+            and self.spool_budget.has_room(size)
+        ):
+            return spooled_buffer(size, CHUNK_UPLOADER_SPOOL_DIRECTORY)
+
+        return self.buffer_pool.acquire(size)
+
+    def release_buffer(self, buffer):
+        if is_spooled(buffer):
+            close_spooled_buffer(buffer)
+        else:
+            self.buffer_pool.release(buffer)
+
+    def flush(self):
+        if self.failed:
+            raise AbortS3UploadException(f"A part of {self.key} could not be uploaded")
+
+        if not self.started:
+            self.start()
+
+        self.part_number += 1
+        self.digests[self.part_number] = self.take_digest()
+        buffer, size = self.drain_queue()
+
+        # Blocks the request thread until enough of the parts already
+        # submitted by any upload in this process have been sent
+        budget = self.spool_budget if is_spooled(buffer) else self.in_flight_budget
+        reserved = budget.acquire(size)
+        future = Future()
+        future.add_done_callback(
+            lambda _: self.part_done(buffer, budget, reserved)
+        )
+        self.futures.append(future)
+        self.parts.append((self.part_number, future))
+        logger.debug("Prepared part %s", self.part_number)
+
+        with self._pending_lock:
+            self.pending.append((future, self.part_number, buffer, size))
+            queued = len(self.pending)
+
+        signals.part_submitted.send_robust(
+            sender=self.__class__,
+            key=self.key,
+            part_number=self.part_number,
+            size=size,
+            queued=queued,
+            in_flight_bytes=self.in_flight_budget.in_flight,
+            spooled_bytes=self.spool_budget.in_flight if self.spool_budget else 0,
+        )
+        self.submit_pending()
+
+    def submit_pending(self):
+        with self._pending_lock:
+            while self.pending and (
+                not self.max_concurrency or self.running < self.max_concurrency
+            ):
+                self.running += 1
+                self.start_part(*self.pending.popleft())
+
+    def start_part(self, future, part_number, buffer, size):
+        self.submit(self.run_part, future, part_number, buffer, size)
+
+    def run_part(self, future, part_number, buffer, size):
+        try:
+            if future.set_running_or_notify_cancel():
+                started_at = time.monotonic()
+                try:
+                    response = self.upload_part(part_number, buffer, size)
+                except Exception as exc:
+                    self.part_completed(part_number, size, started_at, exc)
+                    future.set_exception(exc)
+                else:
+                    self.part_completed(part_number, size, started_at)
+                    future.set_result(response)
+        finally:
+            with self._pending_lock:
+                self.running -= 1
+            self.submit_pending()
+
+    def upload_part(self, part_number, buffer, size):
+        # The buffer is kept until the part has been sent, so only this
+        # part is sent again if it fails
+        attempt = 1
+        while True:
+            self.concurrency_controller.acquire()
+            started_at = time.monotonic()
+            try:
+                response = self.client.upload_part(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    PartNumber=part_number,
+                    UploadId=self.upload_id,
+                    Body=part_body(buffer, size),
+                    ContentLength=size,
+                    **self.get_checksum_kwargs(self.digests[part_number]),
+                )
+            except Exception as exc:
+                self.concurrency_controller.release(
+                    size,
+                    time.monotonic() - started_at,
+                    congested=is_retryable(exc),
+                )
+
+                if attempt >= CHUNK_UPLOADER_PART_ATTEMPTS or not is_retryable(exc):
+                    self.failed = True
+                    raise
+
+                logger.warning(
+                    "Retrying part %s of %s after attempt %s failed: %s",
+                    part_number, self.key, attempt, exc,
+                )
+                time.sleep(get_retry_delay(attempt))
+                attempt += 1
+
+                with self._retry_lock:
+                    self.retry_count += 1
+                    self.retry_time += time.monotonic() - started_at
+            else:
+                self.concurrency_controller.release(size, time.monotonic() - started_at)
+                return response
+
+    def part_completed(self, part_number, size, started_at, exception=None):
+        signals.part_completed.send_robust(
+            sender=self.__class__,
+            key=self.key,
+            part_number=part_number,
+            size=size,
+            duration=time.monotonic() - started_at,
+            exception=exception,
+        )
+
+    def part_done(self, buffer, budget, reserved):
+        budget.release(reserved)
+        if buffer is not None:
+            self.release_buffer(buffer)
+
+    def take_digest(self):
+        if not self.checksum_algorithm:
+            return None
+
+        hasher = self.hasher or checksums.get_hasher(self.checksum_algorithm)
+        self.hasher = None
+        return hasher.digest()
+
+    def get_checksum_kwargs(self, digest):
+        if digest is None:
+            return {}
+
+        return {
+            "ChecksumAlgorithm": self.checksum_algorithm,
+            f"Checksum{self.checksum_algorithm}": checksums.encode(digest),
+        }
+
+    def get_checksum_metadata(self):
+        if self.checksum is None:
+            return {}
+
+        return {f"checksum-{self.checksum_algorithm.lower()}": self.checksum}
 
     def drain_queue(self):
-        body = b"".join(self.queue)
-        self.queue = []
+        buffer = self.buffer
+        size = self.current_queue_size
+        self.buffer = None
         self.current_queue_size = 0
-        return body
+        return buffer, size
+
+    def put_object(self, **kwargs):
+        # Sends everything queued in a single request, for files that
+        # never filled a part
+        digest = self.take_digest()
+        buffer, size = self.drain_queue()
+
+        if digest is not None:
+            self.checksum = checksums.encode(digest)
+            kwargs["Metadata"] = {
+                **kwargs.get("Metadata", {}),
+                **self.get_checksum_metadata(),
+            }
+
+        try:
+            return self.client.put_object(
+                Bucket=self.bucket,
+                Body=part_body(buffer, size),
+                ContentLength=size,
+                **self.get_checksum_kwargs(digest),
+                **kwargs,
+            )
+        finally:
+            if buffer is not None:
+                self.release_buffer(buffer)
+
+    def discard(self):
+        buffer, _ = self.drain_queue()
+        if buffer is not None:
+            self.release_buffer(buffer)
 
     def get_parts(self):
-        return [
+        parts = [
             {
                 "PartNumber": part[0],
                 "ETag": part[1].result()["ETag"],
@@ -120,127 +940,370 @@ class ThreadedS3ChunkUploader(ThreadPoolExecutor):
             for part in self.parts
         ]
 
+        if self.checksum_algorithm:
+            digests = [self.digests[part["PartNumber"]] for part in parts]
+            for part, digest in zip(parts, digests):
+                part[f"Checksum{self.checksum_algorithm}"] = checksums.encode(digest)
+
+            self.checksum = checksums.composite_checksum(self.checksum_algorithm, digests)
+
+        return parts
+
 
 class S3FileUploadHandler(FileUploadHandler):
+    # Override to use different part sizes for a handler, otherwise
+    # CHUNK_UPLOADER_PART_SIZE and CHUNK_UPLOADER_MAX_PART_SIZE are used
+    part_size = None
+    max_part_size = None
+    # The most parts of a file sent at once, otherwise
+    # CHUNK_UPLOADER_UPLOAD_CONCURRENCY is used
+    max_concurrency = None
+    # Defaults to ThreadedS3ChunkUploader
+    uploader_class = None
+    content_length = None
+    started_at = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Seconds spent in each phase of the current file
+        self.timings = {}
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # The request body is an upper bound of the size of each file in it
+        self.content_length = content_length
+
     def new_file(self, *args, **kwargs):
         super().new_file(*args, **kwargs)
-        extension = pathlib.Path(self.file_name).suffix
-        time_stamp = f'{timezone.now().strftime("%Y%m%d%H%M%S")}'
-        self.new_file_name = f"{S3_ROOT_DIRECTORY}{self.file_name.replace(extension, '')}_{time_stamp}{extension}"
+        if self.part_size is not None:
+            check_part_size(self.part_size)
 
-        extra_kwargs = {}
-        if AWS_S3_ENDPOINT_URL:
-            extra_kwargs['endpoint_url'] = AWS_S3_ENDPOINT_URL
+        self.new_file_name = get_new_file_name(self.file_name)
 
-        if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
-            extra_kwargs['aws_access_key_id'] = AWS_ACCESS_KEY_ID
-            extra_kwargs['aws_secret_access_key'] = AWS_SECRET_ACCESS_KEY
-
-        self.s3_client = boto3_client(
-            "s3",
-            region_name=AWS_REGION,
-            **extra_kwargs,
-        )
+        self.s3_client = get_s3_client()
+        self.started_at = time.monotonic()
+        self.timings = {}
 
         self.parts = []
         self.part_number = 1
-        self.s3_key = f"chunk_upload_{str(uuid.uuid4())}"
-
-        self.multipart = self.s3_client.create_multipart_upload(
-            Bucket=AWS_STORAGE_BUCKET_NAME,
-            Key=self.s3_key,
-            ContentType=self.content_type,
-        )
+        if CHUNK_UPLOADER_ASYNC_SCAN:
+            self.s3_key = f"{CHUNK_UPLOADER_QUARANTINE_PREFIX}{self.new_file_name}"
+        elif CHUNK_UPLOADER_DIRECT_UPLOAD:
+            self.s3_key = self.new_file_name
+        else:
+            self.s3_key = f"{S3_TEMPORARY_KEY_PREFIX}{str(uuid.uuid4())}"
 
-        self.upload_id = self.multipart["UploadId"]
-        self.executor = ThreadedS3ChunkUploader(
+        uploader_class = self.uploader_class or ThreadedS3ChunkUploader
+        self.executor = uploader_class(
             self.s3_client,
             AWS_STORAGE_BUCKET_NAME,
             key=self.s3_key,
-            upload_id=self.upload_id,
+            content_type=self.content_type,
+            part_size=self.part_size,
+            max_part_size=self.max_part_size,
+            expected_size=self.content_length,
+            max_concurrency=self.max_concurrency,
+        )
+
+        signals.upload_started.send_robust(
+            sender=self.__class__,
+            handler=self,
+            file_name=self.file_name,
         )
 
     def receive_data_chunk(self, raw_data, start):
+        started_at = time.monotonic()
         try:
             self.executor.add(raw_data)
+            # Includes waiting for the in flight budget
+            add_timing(self.timings, "s3_buffer", started_at)
         except Exception as exc:
             logger.error("Aborting S3 upload", exc_info=exc)
             self.abort()
+            raise AbortS3UploadException(exc)
 
         return raw_data
 
+    def get_av_result(self):
+        for result in self.content_type_extra.get("clam_av_results", []):
+            if result["file_name"] == self.file_name:
+                return result
+
+        return None
+
+    def get_av_metadata(self, av_result):
+        return get_av_metadata(av_result["scanned_at"])
+
+    def get_metadata(self, av_result):
+        metadata = self.executor.get_checksum_metadata()
+        if av_result:
+            metadata.update(self.get_av_metadata(av_result))
+
+        return metadata
+
     def file_complete(self, file_size):
-        self.executor.add(None)
+        av_result = self.get_av_result()
+
+        if av_result and av_result.get("pending"):
+            return self.quarantine(av_result, file_size)
+
+        if self.executor.started:
+            etag = self.complete_multipart_upload(av_result, file_size)
+        else:
+            etag = self.put_object(av_result)
+
+        if av_result and not av_result["av_passed"]:
+            if CHUNK_UPLOADER_RAISE_EXCEPTION_ON_VIRUS_FOUND:
+                raise VirusFoundInFileException()
+            else:
+                file_with_virus = FileWithVirus(field_name=self.field_name)
+                file_with_virus.timings = self.get_timings()
+                return file_with_virus
+
+        self.upload_completed(self.new_file_name, file_size)
+
+        return S3UploadedFile(
+            self.new_file_name,
+            get_storage(),
+            size=file_size,
+            content_type=self.content_type,
+            original_name=self.file_name,
+            etag=etag,
+            # Lets validate_virus_check_result check the file without reading it
+            av_passed=av_result["av_passed"] if av_result else None,
+            scanned_at=av_result["scanned_at"] if av_result else None,
+            checksum=self.executor.checksum,
+            checksum_algorithm=self.executor.checksum_algorithm,
+            timings=self.get_timings(),
+        )
+
+    def get_timings(self):
+        # Adds this handler's phases to those of the handlers before it, the
+        # rest of the time was spent receiving the file from the client
+        timings = self.content_type_extra.setdefault("upload_timings", {})
+        timings.update(self.timings)
+
+        if self.started_at is not None:
+            total = time.monotonic() - self.started_at
+            timings["transfer"] = max(0, total - sum(timings.values()))
+            timings["total"] = total
+
+        return timings
+
+    def put_object(self, av_result):
+        if av_result and not av_result["av_passed"]:
+            # A file with a virus is never written to S3
+            self.executor.discard()
+            return
+
+        extra_kwargs = {}
+        if av_result:
+            extra_kwargs["Metadata"] = self.get_av_metadata(av_result)
 
-        # Wait for all threads to complete
-        wait(
-            self.executor.futures, return_when=concurrent.futures.ALL_COMPLETED
+        response = self.s3_request(
+            "put_object",
+            self.new_file_name,
+            self.executor.put_object,
+            Key=self.new_file_name,
+            ContentType=self.content_type,
+            **extra_kwargs,
         )
+        return response["ETag"]
+
+    def quarantine(self, av_result, file_size):
+        if self.executor.started:
+            etag = self.complete_parts()["ETag"]
+        else:
+            etag = self.s3_request(
+                "put_object",
+                self.s3_key,
+                self.executor.put_object,
+                Key=self.s3_key,
+                ContentType=self.content_type,
+            )["ETag"]
+
+        scanned_file = av_result["scanned_file"]
+        scanned_file.quarantine_key = self.s3_key
+        scanned_file.final_key = self.new_file_name
+        scanned_file.content_type = self.content_type
+        scanned_file.file_size = file_size
+        scanned_file.save(
+            update_fields=["quarantine_key", "final_key", "content_type", "file_size"],
+        )
+
+        if "verdict" in av_result:
+            av_result["verdict"].add_done_callback(
+                lambda future: self.promote(scanned_file),
+            )
+
+        self.upload_completed(self.s3_key, file_size)
+
+        uploaded_file = S3UploadedFile(
+            self.new_file_name,
+            get_storage(),
+            size=file_size,
+            content_type=self.content_type,
+            original_name=self.file_name,
+            etag=etag,
+            checksum=self.executor.checksum,
+            checksum_algorithm=self.executor.checksum_algorithm,
+            timings=self.get_timings(),
+        )
+        # The file is only at its name once the scan has passed
+        uploaded_file.scanned_file_id = scanned_file.pk
+
+        return uploaded_file
+
+    def promote(self, scanned_file):
+        try:
+            promote_scanned_file(scanned_file)
+        except Exception:
+            logger.error(
+                f"Error moving '{scanned_file.quarantine_key}' out of quarantine",
+                exc_info=True,
+            )
+
+    def complete_parts(self):
+        try:
+            started_at = time.monotonic()
+            self.executor.add(None)
 
-        parts = self.executor.get_parts()
+            # Wait for all threads to complete
+            wait(
+                self.executor.futures, return_when=concurrent.futures.ALL_COMPLETED
+            )
+            add_timing(self.timings, "s3_parts", started_at)
+
+            parts = self.executor.get_parts()
+        except Exception as exc:
+            logger.error("Aborting S3 upload", exc_info=exc)
+            self.abort()
+            raise AbortS3UploadException(exc)
 
-        self.s3_client.complete_multipart_upload(
+        if self.executor.retry_count:
+            logger.info(
+                "Uploaded %s after retrying %s parts for %.2f seconds",
+                self.s3_key, self.executor.retry_count, self.executor.retry_time,
+            )
+
+        return self.s3_request(
+            "complete_multipart_upload",
+            self.s3_key,
+            self.s3_client.complete_multipart_upload,
             Bucket=AWS_STORAGE_BUCKET_NAME,
             Key=self.s3_key,
-            UploadId=self.upload_id,
+            UploadId=self.executor.upload_id,
             MultipartUpload={"Parts": parts},
         )
 
-        self.s3_client.copy_object(
-            Bucket=AWS_STORAGE_BUCKET_NAME,
-            CopySource=f"{AWS_STORAGE_BUCKET_NAME}/{self.s3_key}",
-            Key=self.new_file_name,
+    def complete_multipart_upload(self, av_result, file_size):
+        if av_result and not av_result["av_passed"]:
+            # A file with a virus is never completed, so it never exists in
+            # S3, even briefly at its final key with direct uploads
+            self.abort_parts()
+            return
+
+        response = self.complete_parts()
+
+        metadata = self.get_metadata(av_result)
+
+        if self.s3_key == self.new_file_name:
+            if metadata:
+                self.s3_request(
+                    "put_object_tagging",
+                    self.new_file_name,
+                    self.s3_client.put_object_tagging,
+                    Bucket=AWS_STORAGE_BUCKET_NAME,
+                    Key=self.new_file_name,
+                    Tagging={
+                        "TagSet": [
+                            {"Key": key, "Value": value}
+                            for key, value in metadata.items()
+                        ],
+                    },
+                )
+            return response["ETag"]
+
+        extra_kwargs = {}
+        if metadata:
+            # Set AV and checksum headers
+            extra_kwargs["Metadata"] = metadata
+
+        etag = self.s3_request(
+            "copy_object",
+            self.new_file_name,
+            copy_object,
+            self.s3_client,
+            AWS_STORAGE_BUCKET_NAME,
+            self.s3_key,
+            self.new_file_name,
+            file_size,
             ContentType=self.content_type,
+            **extra_kwargs,
         )
 
-        self.s3_client.delete_object(
+        self.delete_temporary_object()
+
+        return etag
+
+    def abort_parts(self):
+        self.executor.discard()
+        wait(self.executor.futures)
+
+        self.s3_request(
+            "abort_multipart_upload",
+            self.s3_key,
+            self.s3_client.abort_multipart_upload,
             Bucket=AWS_STORAGE_BUCKET_NAME,
             Key=self.s3_key,
+            UploadId=self.executor.upload_id,
         )
 
-        if "clam_av_results" in self.content_type_extra:
-            for result in self.content_type_extra["clam_av_results"]:
-                if result["file_name"] == self.file_name:
-                    # Set AV headers
-                    if result["av_passed"]:
-                        self.s3_client.copy_object(
-                            Bucket=AWS_STORAGE_BUCKET_NAME,
-                            CopySource=f"{AWS_STORAGE_BUCKET_NAME}/{self.new_file_name}",
-                            Key=self.new_file_name,
-                            Metadata={
-                                "av-scanned-at": result["scanned_at"].strftime(
-                                    "%Y-%m-%d %H:%M:%S"
-                                ),
-                                "av-passed": "True",
-                            },
-                            ContentType=self.content_type,
-                            MetadataDirective="REPLACE",
-                        )
-                    else:
-                        # Remove file with virus from S3
-                        self.s3_client.delete_object(
-                            Bucket=AWS_STORAGE_BUCKET_NAME,
-                            Key=self.new_file_name,
-                        )
-
-                        if CHUNK_UPLOADER_RAISE_EXCEPTION_ON_VIRUS_FOUND:
-                            raise VirusFoundInFileException()
-                        else:
-                            return FileWithVirus(field_name=self.field_name)
-
-        storage = S3Boto3Storage()
-        file = S3Boto3StorageFile(self.new_file_name, "rb", storage)
-        file.content_type = self.content_type
-        file.original_name = self.file_name
-
-        file.file_size = file_size
-        file.close()
-
-        return file
+    def delete_temporary_object(self):
+        self.s3_request(
+            "delete_object",
+            self.s3_key,
+            self.s3_client.delete_object,
+            Bucket=AWS_STORAGE_BUCKET_NAME,
+            Key=self.s3_key,
+        )
+
+    def s3_request(self, operation, key, request, *args, **kwargs):
+        started_at = time.monotonic()
+        response = request(*args, **kwargs)
+        add_timing(self.timings, f"s3_{operation}", started_at)
+        signals.s3_request.send_robust(
+            sender=self.__class__,
+            operation=operation,
+            key=key,
+            duration=time.monotonic() - started_at,
+        )
+
+        return response
+
+    def upload_completed(self, key, file_size):
+        signals.upload_completed.send_robust(
+            sender=self.__class__,
+            handler=self,
+            key=key,
+            file_size=file_size,
+            duration=None if self.started_at is None else time.monotonic() - self.started_at,
+        )
 
     def abort(self):
+        signals.upload_aborted.send_robust(
+            sender=self.__class__,
+            handler=self,
+            key=self.s3_key,
+        )
+
+        if not self.executor.started:
+            return
+
+        # Parts still being sent could otherwise be stored after the abort
+        wait(self.executor.futures)
+
         self.s3_client.abort_multipart_upload(
             Bucket=AWS_STORAGE_BUCKET_NAME,
             Key=self.s3_key,
-            UploadId=self.upload_id,
+            UploadId=self.executor.upload_id,
         )
@@ -0,0 +1,155 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from django_chunk_upload_handlers.models import ScannedFile
+
+
+logger = logging.getLogger(__name__)
+
+
+# How scan records are written, "immediate" to save each one as the scan
+# completes, "request" to write them together at the end of the request or
+# "background" to hand them to a writer thread
+CLAM_AV_SCANNED_FILE_WRITES = getattr(settings, "CLAM_AV_SCANNED_FILE_WRITES", "immediate")
+CLAM_AV_SCANNED_FILE_QUEUE_SIZE = getattr(settings, "CLAM_AV_SCANNED_FILE_QUEUE_SIZE", 1000)
+CLAM_AV_SCANNED_FILE_BATCH_SIZE = getattr(settings, "CLAM_AV_SCANNED_FILE_BATCH_SIZE", 100)
+CLAM_AV_SCANNED_FILE_FLUSH_INTERVAL = getattr(
+    settings, "CLAM_AV_SCANNED_FILE_FLUSH_INTERVAL",
+    1,
+)
+CLAM_AV_SCANNED_FILE_RETENTION_DAYS = getattr(
+    settings, "CLAM_AV_SCANNED_FILE_RETENTION_DAYS",
+    90,
+)
+
+
+def save_scanned_files(scanned_files):
+    if scanned_files:
+        ScannedFile.objects.bulk_create(
+            scanned_files,
+            batch_size=CLAM_AV_SCANNED_FILE_BATCH_SIZE,
+        )
+
+
+def prune_scanned_files(retention_days, batch_size=1000, pause=0):
+    # Rows are deleted a batch at a time so that no single statement holds
+    # locks or writes to the log for long. Pending rows are kept until
+    # they have been scanned
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    old_rows = ScannedFile.objects.filter(
+        scanned_at__lt=cutoff,
+        pending=False,
+    ).order_by("scanned_at")
+
+    deleted = 0
+    while True:
+        pks = list(old_rows.values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            return deleted
+
+        deleted += ScannedFile.objects.filter(pk__in=pks).delete()[0]
+
+        if pause:
+            time.sleep(pause)
+
+
+class ScannedFileWriter:
+    def __init__(self, queue_size, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run,
+                    name="scanned_file_writer",
+                    daemon=True,
+                )
+                self.thread.start()
+
+    def put(self, scanned_file):
+        self.start()
+
+        try:
+            self.queue.put(scanned_file, timeout=self.flush_interval)
+        except queue.Full:
+            # Records are never dropped, the request writes its own if the
+            # writer cannot keep up
+            logger.warning("Scanned file queue is full, writing record directly")
+            save_scanned_files([scanned_file])
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                save_scanned_files(batch)
+            except Exception:
+                logger.error(
+                    f"Error writing {len(batch)} scanned file records",
+                    exc_info=True,
+                )
+                # The connection may be unusable after the error
+                connection.close()
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_scanned_file_writer():
+    global _writer
+
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = ScannedFileWriter(
+                    CLAM_AV_SCANNED_FILE_QUEUE_SIZE,
+                    CLAM_AV_SCANNED_FILE_BATCH_SIZE,
+                    CLAM_AV_SCANNED_FILE_FLUSH_INTERVAL,
+                )
+                atexit.register(_writer.flush)
+
+    return _writer
+
+
+def reset_scanned_file_writer():
+    global _writer, _writer_lock
+
+    _writer = None
+    _writer_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_scanned_file_writer)
@@ -0,0 +1,32 @@
+from django.dispatch import Signal
+
+
+# Sent by the upload handlers as a file starts, with handler and file_name
+upload_started = Signal()
+
+# Sent by the S3 uploader as a part is queued, with key, part_number, size,
+# queued (parts of the upload waiting to be sent), in_flight_bytes (bytes of
+# parts in memory being sent by every upload in the process) and
+# spooled_bytes (the same for parts spooled to disk)
+part_submitted = Signal()
+
+# Sent as a part has been sent or has failed, with key, part_number, size,
+# duration (seconds, including retries) and exception (None on success)
+part_completed = Signal()
+
+# Sent as ClamAV has answered, with handler, file_name, av_passed, av_reason,
+# duration (seconds waiting for the verdict once the file was sent) and
+# exception (None unless the scan could not be completed)
+av_response = Signal()
+
+# Sent after each request made to S3 to finish a file, with operation (one
+# of "put_object", "complete_multipart_upload", "abort_multipart_upload",
+# "copy_object", "put_object_tagging" or "delete_object"), key and duration
+s3_request = Signal()
+
+# Sent by the S3 handler once a file is stored, with handler, key, file_size
+# and duration (seconds since the file started)
+upload_completed = Signal()
+
+# Sent by the S3 handler as an upload is aborted, with handler and key
+upload_aborted = Signal()
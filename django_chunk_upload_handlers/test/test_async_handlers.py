@@ -0,0 +1,190 @@
+import concurrent.futures
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, patch
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from django_chunk_upload_handlers.async_handlers import (
+    AsyncClamAVFileUploadHandler,
+    AsyncS3ChunkUploader,
+)
+from django_chunk_upload_handlers.clam_av import AntiVirusServiceErrorException
+from django_chunk_upload_handlers.models import ScannedFile
+from django_chunk_upload_handlers.test.test_clamd import FakeClamdServer
+
+
+class FakeClamAVRestHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        body = b""
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if not size:
+                self.rfile.readline()
+                return body
+            body += self.rfile.read(size)
+            self.rfile.readline()
+
+    def do_POST(self):
+        body = self.read_body()
+        self.server.bodies.append(body)
+
+        content = json.dumps({"malware": b"EICAR" in body, "reason": "Eicar-Test-Signature"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class ClosingClamAVRestHandler(FakeClamAVRestHandler):
+    def do_POST(self):
+        # Reads the file and closes the connection without replying
+        self.server.bodies.append(self.read_body())
+        self.close_connection = True
+
+
+class AsyncClamAVFileHandlerTestCase(TestCase):
+    def start_server(self, server):
+        threading.Thread(
+            target=server.serve_forever,
+            kwargs={"poll_interval": 0.01},
+            daemon=True,
+        ).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+    def patch_setting(self, target, value):
+        patcher = patch(target, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scan(self, *chunks):
+        handler = AsyncClamAVFileUploadHandler(request=RequestFactory().request())
+        handler.new_file("file", "file.txt", "text/plain", 100, content_type_extra={})
+
+        start = 0
+        for chunk in chunks:
+            handler.receive_data_chunk(chunk, start)
+            start += len(chunk)
+
+        handler.file_complete(start)
+        handler.upload_complete()
+
+        return handler.content_type_extra["clam_av_results"][0]
+
+    def use_clamd(self):
+        server = FakeClamdServer()
+        self.start_server(server)
+        self.patch_setting("django_chunk_upload_handlers.clam_av.CLAM_AV_BACKEND", "clamd")
+        self.patch_setting("django_chunk_upload_handlers.clamd.CLAMD_HOST", "127.0.0.1")
+        self.patch_setting("django_chunk_upload_handlers.clamd.CLAMD_PORT", server.server_address[1])
+        return server
+
+    def use_rest(self, handler_class=FakeClamAVRestHandler):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        server.daemon_threads = True
+        server.bodies = []
+        self.start_server(server)
+        self.patch_setting("django_chunk_upload_handlers.clam_av.CLAM_USE_HTTP", True)
+        self.patch_setting(
+            "django_chunk_upload_handlers.clam_av.CLAM_AV_DOMAIN",
+            f"127.0.0.1:{server.server_address[1]}",
+        )
+        return server
+
+    def test_clamd_clean_file(self):
+        server = self.use_clamd()
+
+        result = self.scan(b"clean ", b"file")
+
+        self.assertTrue(result["av_passed"])
+        self.assertEqual(server.streams, [b"clean file"])
+
+        scanned_file = ScannedFile.objects.get()
+        self.assertTrue(scanned_file.av_passed)
+        self.assertEqual(scanned_file.content_hash, hashlib.sha256(b"clean file").hexdigest())
+
+    def test_clamd_virus(self):
+        self.use_clamd()
+
+        result = self.scan(b"EICAR")
+
+        self.assertFalse(result["av_passed"])
+        self.assertEqual(ScannedFile.objects.get().av_reason, "Eicar-Test-Signature")
+
+    @patch("django_chunk_upload_handlers.clamd.CLAMD_STREAM_MAX_LENGTH", 5)
+    def test_clamd_stream_max_length(self):
+        self.use_clamd()
+
+        with self.assertRaises(AntiVirusServiceErrorException):
+            self.scan(b"too large")
+
+        self.assertFalse(ScannedFile.objects.get().av_passed)
+
+    def test_rest_clean_file(self):
+        server = self.use_rest()
+
+        result = self.scan(b"clean ", b"file")
+
+        self.assertTrue(result["av_passed"])
+        self.assertEqual(server.bodies, [b"clean file"])
+
+    def test_rest_virus(self):
+        self.use_rest()
+
+        result = self.scan(b"EICAR")
+
+        self.assertFalse(result["av_passed"])
+
+    def test_rest_connection_closed_without_reply(self):
+        self.use_rest(ClosingClamAVRestHandler)
+
+        with self.assertRaises(AntiVirusServiceErrorException):
+            self.scan(b"clean")
+
+        self.assertTrue(ScannedFile.objects.get().av_reason.startswith("Malformed status line"))
+
+
+class AsyncS3ChunkUploaderTestCase(TestCase):
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    def test_parts_are_sent_on_event_loop(self):
+        sent = []
+
+        class FakeAsyncClient:
+            async def upload_part(self, **kwargs):
+                sent.append((kwargs["PartNumber"], bytes(kwargs["Body"]), threading.current_thread().name))
+                return {"ETag": str(kwargs["PartNumber"])}
+
+        async def get_async_s3_client():
+            return FakeAsyncClient()
+
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {"UploadId": "test"}
+
+        with patch(
+            "django_chunk_upload_handlers.async_handlers.get_async_s3_client",
+            get_async_s3_client,
+        ):
+            uploader = AsyncS3ChunkUploader(client, "bucket", "key")
+            uploader.add(b"tenbytes!!five!")
+            uploader.add(None)
+            concurrent.futures.wait(uploader.futures, timeout=5)
+
+        self.assertEqual(
+            uploader.get_parts(),
+            [{"PartNumber": 1, "ETag": "1"}, {"PartNumber": 2, "ETag": "2"}],
+        )
+        self.assertEqual(
+            sorted(sent),
+            [
+                (1, b"tenbytes!!", "chunk_uploader_loop"),
+                (2, b"five!", "chunk_uploader_loop"),
+            ],
+        )
+        client.upload_part.assert_not_called()
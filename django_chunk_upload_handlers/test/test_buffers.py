@@ -0,0 +1,89 @@
+import io
+
+from django.test import TestCase
+
+from django_chunk_upload_handlers.buffers import (
+    MemoryViewReader,
+    PartBufferPool,
+    close_spooled_buffer,
+    is_spooled,
+    part_body,
+    spooled_buffer,
+)
+
+
+class PartBufferPoolTestCase(TestCase):
+    def test_released_buffer_is_reused(self):
+        pool = PartBufferPool(100)
+
+        buffer = pool.acquire(10)
+        pool.release(buffer)
+
+        self.assertIs(pool.acquire(10), buffer)
+        self.assertEqual(pool.retained_bytes, 0)
+
+    def test_buffer_of_different_size_is_not_reused(self):
+        pool = PartBufferPool(100)
+
+        buffer = pool.acquire(10)
+        pool.release(buffer)
+
+        self.assertEqual(len(pool.acquire(20)), 20)
+        self.assertEqual(pool.retained_bytes, 10)
+
+    def test_buffers_beyond_limit_are_not_retained(self):
+        pool = PartBufferPool(15)
+
+        pool.release(pool.acquire(10))
+        pool.release(bytearray(10))
+
+        self.assertEqual(pool.retained_bytes, 10)
+
+
+class MemoryViewReaderTestCase(TestCase):
+    def test_read_and_seek(self):
+        reader = MemoryViewReader(memoryview(b"0123456789")[:6])
+
+        self.assertEqual(len(reader), 6)
+        self.assertEqual(reader.read(4), b"0123")
+        self.assertEqual(reader.read(), b"45")
+        self.assertEqual(reader.read(), b"")
+
+        reader.seek(0)
+        self.assertEqual(reader.read(), b"012345")
+
+        self.assertEqual(reader.seek(-2, io.SEEK_END), 4)
+        self.assertEqual(reader.read(), b"45")
+
+    def test_full_buffer_is_not_wrapped(self):
+        buffer = bytearray(b"full")
+
+        self.assertIs(part_body(buffer, 4), buffer)
+        self.assertEqual(part_body(buffer, 2).read(), b"fu")
+        self.assertEqual(part_body(None, 0), b"")
+
+
+class SpooledBufferTestCase(TestCase):
+    def test_spooled_buffer_is_read_from_the_start(self):
+        buffer = spooled_buffer(4)
+        buffer[0:4] = memoryview(b"full")
+
+        self.assertTrue(is_spooled(buffer))
+        self.assertFalse(is_spooled(bytearray(4)))
+
+        # Each attempt at sending the part gets its own reader
+        self.assertEqual(part_body(buffer, 4).read(), b"full")
+        self.assertEqual(part_body(buffer, 4).read(), b"full")
+        self.assertEqual(part_body(buffer, 2).read(), b"fu")
+
+        close_spooled_buffer(buffer)
+        self.assertTrue(buffer.closed)
+
+    def test_buffer_with_views_is_left_open(self):
+        buffer = spooled_buffer(4)
+        body = part_body(buffer, 4)
+
+        close_spooled_buffer(buffer)
+
+        self.assertFalse(buffer.closed)
+        self.assertEqual(body.read(), bytes(4))
@@ -0,0 +1,34 @@
+import zlib
+from unittest import skipIf
+
+from django.test import TestCase
+
+from django_chunk_upload_handlers import checksums
+
+
+class ChecksumsTestCase(TestCase):
+    def test_crc32_is_incremental(self):
+        hasher = checksums.get_hasher("CRC32")
+        hasher.update(b"hello ")
+        hasher.update(memoryview(b"world"))
+
+        self.assertEqual(hasher.digest(), zlib.crc32(b"hello world").to_bytes(4, "big"))
+
+    @skipIf(checksums.crc32c is None, "awscrt is not installed")
+    def test_crc32c(self):
+        hasher = checksums.get_hasher("CRC32C")
+        hasher.update(b"123456789")
+
+        self.assertEqual(hasher.digest().hex(), "e3069283")
+
+    def test_composite_checksum(self):
+        self.assertEqual(
+            checksums.composite_checksum("CRC32", [b"\0\0\0\0", b"\0\0\0\1"]),
+            f"{checksums.encode(zlib.crc32(bytes([0, 0, 0, 0, 0, 0, 0, 1])).to_bytes(4, 'big'))}-2",
+        )
+
+    def test_unknown_algorithm(self):
+        self.assertFalse(checksums.is_available("MD5"))
+
+        with self.assertRaises(ValueError):
+            checksums.get_hasher("MD5")
@@ -1,25 +1,50 @@
+import hashlib
+import socket
+import ssl
 from unittest.mock import MagicMock, Mock, call, patch
 
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models.fields.files import FieldFile
 from django.test import TestCase
 from django.test.client import RequestFactory
 
 from django_chunk_upload_handlers.clam_av import (
     AntiVirusServiceErrorException,
+    ClamAVConnectionPool,
     ClamAVFileUploadHandler,
+    FileWithVirus,
     MalformedAntiVirusResponseException,
     VirusFoundInFileException,
+    get_connection_pool,
+    reset_connection_pool,
+    validate_virus_check_result,
 )
 from django_chunk_upload_handlers.models import ScannedFile
+from django_chunk_upload_handlers.s3 import S3UploadedFile
 
 test_clam_av_domain = "test.com"
 
 
+def mock_socket():
+    sock = MagicMock()
+    sock.sent = b""
+
+    def sendmsg(buffers):
+        sock.sent += b"".join(buffers)
+        return sum(len(buffer) for buffer in buffers)
+
+    sock.sendmsg.side_effect = sendmsg
+    return sock
+
+
 # Need to directly override settings rather than using
 # override_settings as it does not work with logic used
 class ClamAVFileHandlerTestCase(TestCase):
     def setUp(self):
         self.request_factory = RequestFactory()
         self.request = self.request_factory.request()
+        reset_connection_pool()
 
     @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_DOMAIN", test_clam_av_domain)
     def create_av_handler(self):
@@ -34,6 +59,9 @@ class ClamAVFileHandlerTestCase(TestCase):
         )
         setattr(self.clam_av_file_handler, 'content_type_extra', {})
 
+        if hasattr(self.clam_av_file_handler, "av_conn"):
+            self.clam_av_file_handler.av_conn.sock = mock_socket()
+
     @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
     def test_init_connection(self, http_connection):
         self.create_av_handler()
@@ -44,13 +72,71 @@ class ClamAVFileHandlerTestCase(TestCase):
     @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
     def test_chunk_is_received(self, http_connection):
         self.create_av_handler()
-        self.clam_av_file_handler.av_conn = MagicMock()
         self.clam_av_file_handler.receive_data_chunk(
             b"test",
             0,
         )
-        # Check that we started to send data
-        self.clam_av_file_handler.av_conn.mock_calls[0] = call.send(b"4")
+        # Check that the chunk was framed and sent in one write
+        sock = self.clam_av_file_handler.av_conn.sock
+        sock.sendmsg.assert_called_once()
+        self.assertEqual(sock.sent, b"4\r\ntest\r\n")
+
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_partial_send_is_completed(self, http_connection):
+        self.create_av_handler()
+        sock = self.clam_av_file_handler.av_conn.sock
+        sent = []
+
+        def sendmsg(buffers):
+            # Only write up to three bytes at a time
+            data = b"".join(buffers)[:3]
+            sent.append(data)
+            return len(data)
+
+        sock.sendmsg.side_effect = sendmsg
+
+        self.clam_av_file_handler.receive_data_chunk(b"test", 0)
+
+        self.assertEqual(b"".join(sent), b"4\r\ntest\r\n")
+
+    @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_FRAME_SIZE", 10)
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_small_chunks_are_coalesced(self, http_connection):
+        self.create_av_handler()
+        sock = self.clam_av_file_handler.av_conn.sock
+
+        self.clam_av_file_handler.receive_data_chunk(b"four", 0)
+        self.clam_av_file_handler.receive_data_chunk(b"five!", 4)
+        sock.sendmsg.assert_not_called()
+
+        self.clam_av_file_handler.receive_data_chunk(b"large chunk", 9)
+
+        sock.sendmsg.assert_called_once()
+        self.assertEqual(sock.sent, b"9\r\nfourfive!\r\nb\r\nlarge chunk\r\n")
+
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_ssl_socket_is_written_once(self, http_connection):
+        self.create_av_handler()
+        sock = MagicMock(spec=ssl.SSLSocket)
+        self.clam_av_file_handler.av_conn.sock = sock
+
+        self.clam_av_file_handler.receive_data_chunk(b"test", 0)
+
+        sock.sendall.assert_called_once_with(b"4\r\ntest\r\n")
+
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_ssl_socket_large_chunk_is_not_copied(self, http_connection):
+        self.create_av_handler()
+        sock = MagicMock(spec=ssl.SSLSocket)
+        self.clam_av_file_handler.av_conn.sock = sock
+        chunk = b"x" * (64 * 1024)
+
+        self.clam_av_file_handler.receive_data_chunk(chunk, 0)
+
+        self.assertEqual(sock.sendall.call_count, 3)
+        self.assertEqual(sock.sendall.call_args_list[0][0][0], b"10000\r\n")
+        self.assertIs(sock.sendall.call_args_list[1][0][0], chunk)
+        self.assertEqual(sock.sendall.call_args_list[2][0][0], b"\r\n")
 
     @patch(
         "django_chunk_upload_handlers.clam_av.CLAM_AV_IGNORE_EXTENSIONS",
@@ -108,9 +194,12 @@ class ClamAVFileHandlerTestCase(TestCase):
             status=403,
         )
 
-        with self.assertRaises(AntiVirusServiceErrorException):
-            self.clam_av_file_handler.file_complete(0)
+        with patch("django_chunk_upload_handlers.clam_av.logger") as logger:
+            with self.assertRaises(AntiVirusServiceErrorException):
+                self.clam_av_file_handler.file_complete(0)
 
+        # No malware was found
+        logger.error.assert_not_called()
         self.assertEqual(ScannedFile.objects.count(), 1)
         self.assertFalse(ScannedFile.objects.first().av_passed)
 
@@ -137,6 +226,7 @@ class ClamAVFileHandlerTestCase(TestCase):
         )
 
         self.clam_av_file_handler.file_complete(0)
+        self.clam_av_file_handler.upload_complete()
 
         self.assertFalse(
             self.clam_av_file_handler.content_type_extra["clam_av_results"][0]["av_passed"]
@@ -157,6 +247,7 @@ class ClamAVFileHandlerTestCase(TestCase):
         )
 
         self.clam_av_file_handler.file_complete(0)
+        self.clam_av_file_handler.upload_complete()
 
         self.assertEqual(ScannedFile.objects.count(), 1)
         self.assertTrue(ScannedFile.objects.first().av_passed)
@@ -166,3 +257,255 @@ class ClamAVFileHandlerTestCase(TestCase):
                 "av_passed"
             ]
         )
+
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_phase_timings_are_recorded(self, _http_connection):
+        self.create_av_handler()
+
+        self.clam_av_file_handler.av_conn.getresponse.return_value = Mock(
+            status=200, read=Mock(return_value='{ "malware": false }')
+        )
+
+        self.clam_av_file_handler.receive_data_chunk(b"test", 0)
+        self.clam_av_file_handler.file_complete(4)
+
+        self.assertEqual(
+            set(self.clam_av_file_handler.content_type_extra["upload_timings"]),
+            {"av_connect", "av_stream", "av_verdict"},
+        )
+
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_connection_is_returned_to_pool(self, _http_connection):
+        self.create_av_handler()
+        av_conn = self.clam_av_file_handler.av_conn
+
+        av_conn.getresponse.return_value = Mock(
+            status=200,
+            read=Mock(return_value='{ "malware": false }'),
+            will_close=False,
+        )
+
+        self.clam_av_file_handler.file_complete(0)
+
+        av_conn.close.assert_not_called()
+        self.assertEqual(len(get_connection_pool()._connections), 1)
+
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_connection_is_closed_if_server_closes(self, _http_connection):
+        self.create_av_handler()
+        av_conn = self.clam_av_file_handler.av_conn
+
+        av_conn.getresponse.return_value = Mock(
+            status=200,
+            read=Mock(return_value='{ "malware": false }'),
+            will_close=True,
+        )
+
+        self.clam_av_file_handler.file_complete(0)
+
+        av_conn.close.assert_called_once()
+        self.assertEqual(len(get_connection_pool()._connections), 0)
+
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_stale_pooled_connection_is_replaced(self, http_connection):
+        stale_conn = MagicMock()
+        stale_conn.putrequest.side_effect = ConnectionResetError()
+        get_connection_pool().get = Mock(return_value=stale_conn)
+
+        self.create_av_handler()
+
+        stale_conn.close.assert_called_once()
+        self.assertIs(self.clam_av_file_handler.av_conn, http_connection.return_value)
+        self.clam_av_file_handler.av_conn.endheaders.assert_called_once()
+
+
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_content_hash_is_recorded(self, _http_connection):
+        self.create_av_handler()
+        self.clam_av_file_handler.receive_data_chunk(b"test", 0)
+
+        self.clam_av_file_handler.av_conn.getresponse.return_value = Mock(
+            status=200, read=Mock(return_value='{ "malware": false }')
+        )
+
+        self.clam_av_file_handler.file_complete(4)
+        self.clam_av_file_handler.upload_complete()
+
+        self.assertEqual(
+            ScannedFile.objects.get().content_hash,
+            hashlib.sha256(b"test").hexdigest(),
+        )
+
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_clean_records_are_written_as_scan_completes(self, _http_connection):
+        self.create_av_handler()
+
+        self.clam_av_file_handler.av_conn.getresponse.return_value = Mock(
+            status=200, read=Mock(return_value='{ "malware": false }')
+        )
+
+        # A later handler raising ends the request without upload_complete
+        self.clam_av_file_handler.file_complete(0)
+
+        self.assertTrue(ScannedFile.objects.get().av_passed)
+
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_clean_records_are_written_at_end_of_request(self, _http_connection):
+        self.create_av_handler()
+        self.clam_av_file_handler.scanned_file_writes = "request"
+        self.clam_av_file_handler.receive_data_chunk(b"test", 0)
+
+        self.clam_av_file_handler.av_conn.getresponse.return_value = Mock(
+            status=200, read=Mock(return_value='{ "malware": false }')
+        )
+
+        self.clam_av_file_handler.file_complete(4)
+        self.assertEqual(ScannedFile.objects.count(), 0)
+
+        self.clam_av_file_handler.upload_complete()
+
+        scanned_file = ScannedFile.objects.get()
+        self.assertEqual(scanned_file.file_name, "file.txt")
+        self.assertEqual(scanned_file.file_size, 4)
+        self.assertIsNotNone(scanned_file.scan_duration)
+
+    @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_SIGNATURE_VERSION", "1/1")
+    @patch("django_chunk_upload_handlers.clam_av.get_verdict_cache")
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_cached_clean_verdict_skips_response(self, _http_connection, get_verdict_cache):
+        get_verdict_cache.return_value.is_clean.return_value = True
+
+        self.create_av_handler()
+        self.clam_av_file_handler.receive_data_chunk(b"test", 0)
+        self.clam_av_file_handler.file_complete(4)
+        self.clam_av_file_handler.upload_complete()
+
+        get_verdict_cache.return_value.is_clean.assert_called_once_with(
+            hashlib.sha256(b"test").hexdigest(), "1/1",
+        )
+        self.clam_av_file_handler.av_conn.getresponse.assert_not_called()
+        self.clam_av_file_handler.av_conn.close.assert_called_once()
+
+        self.assertTrue(
+            self.clam_av_file_handler.content_type_extra["clam_av_results"][0]["av_passed"]
+        )
+        self.assertTrue(ScannedFile.objects.get().av_passed)
+
+    @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_SIGNATURE_VERSION", "1/1")
+    @patch("django_chunk_upload_handlers.clam_av.get_verdict_cache")
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_clean_verdict_is_cached(self, _http_connection, get_verdict_cache):
+        get_verdict_cache.return_value.is_clean.return_value = False
+
+        self.create_av_handler()
+        self.clam_av_file_handler.av_conn.getresponse.return_value = Mock(
+            status=200, read=Mock(return_value='{ "malware": false }')
+        )
+        self.clam_av_file_handler.file_complete(0)
+
+        get_verdict_cache.return_value.set_clean.assert_called_once_with(
+            hashlib.sha256().hexdigest(), "1/1",
+        )
+
+    @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_SIGNATURE_VERSION", "1/1")
+    @patch("django_chunk_upload_handlers.clam_av.get_verdict_cache")
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_virus_verdict_is_not_cached(self, _http_connection, get_verdict_cache):
+        get_verdict_cache.return_value.is_clean.return_value = False
+
+        self.create_av_handler()
+        self.clam_av_file_handler.av_conn.getresponse.return_value = Mock(
+            status=200, read=Mock(return_value='{ "malware": true, "reason": "test" }')
+        )
+        self.clam_av_file_handler.file_complete(0)
+
+        get_verdict_cache.return_value.set_clean.assert_not_called()
+
+
+class ClamAVConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self.local_socket, self.remote_socket = socket.socketpair()
+        self.connection = Mock(sock=self.local_socket)
+
+    def tearDown(self):
+        self.local_socket.close()
+        self.remote_socket.close()
+
+    def test_idle_connection_is_reused(self):
+        pool = ClamAVConnectionPool(max_size=1, idle_timeout=30)
+        pool.put(self.connection)
+
+        self.assertIs(pool.get(), self.connection)
+
+    def test_connection_closed_by_server_is_not_reused(self):
+        pool = ClamAVConnectionPool(max_size=1, idle_timeout=30)
+        pool.put(self.connection)
+        self.remote_socket.close()
+
+        with patch.object(pool, "create_connection") as create_connection:
+            self.assertIs(pool.get(), create_connection.return_value)
+
+        self.connection.close.assert_called_once()
+
+    def test_expired_connection_is_not_reused(self):
+        pool = ClamAVConnectionPool(max_size=1, idle_timeout=0)
+        pool.put(self.connection)
+
+        with patch.object(pool, "create_connection") as create_connection:
+            self.assertIs(pool.get(), create_connection.return_value)
+
+        self.connection.close.assert_called_once()
+
+    def test_connections_beyond_size_are_closed(self):
+        pool = ClamAVConnectionPool(max_size=1, idle_timeout=30)
+        other_connection = Mock()
+
+        pool.put(self.connection)
+        pool.put(other_connection)
+
+        other_connection.close.assert_called_once()
+
+
+class ValidateVirusCheckResultTestCase(TestCase):
+    def test_file_with_virus_is_invalid(self):
+        with self.assertRaises(ValidationError):
+            validate_virus_check_result(FileWithVirus(field_name="file"))
+
+    def test_clean_file_is_not_read(self):
+        file = Mock(av_passed=True)
+
+        validate_virus_check_result(file)
+
+        file.readline.assert_not_called()
+
+    @patch("django_chunk_upload_handlers.s3.S3Boto3StorageFile")
+    def test_uploaded_s3_file_is_not_fetched(self, storage_file):
+        file = S3UploadedFile(
+            "file.txt",
+            Mock(location=""),
+            size=4,
+            content_type="text/plain",
+            original_name="file.txt",
+            av_passed=True,
+        )
+
+        validate_virus_check_result(file)
+
+        storage_file.assert_not_called()
+
+    def test_unscanned_file_is_not_read(self):
+        file = Mock(av_passed=None)
+
+        validate_virus_check_result(file)
+
+        file.readline.assert_not_called()
+
+    def test_wrapped_file_result_is_used(self):
+        field_file = FieldFile(None, Mock(), "file.txt")
+        field_file.file = FileWithVirus(field_name="file")
+
+        with self.assertRaises(ValidationError):
+            validate_virus_check_result(field_file)
+
+    def test_file_without_result_is_read(self):
+        validate_virus_check_result(SimpleUploadedFile("file.txt", b"test"))
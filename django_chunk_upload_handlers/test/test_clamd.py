@@ -0,0 +1,270 @@
+import socketserver
+import struct
+import threading
+from concurrent.futures import Future
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from django_chunk_upload_handlers.clam_av import (
+    AntiVirusServiceErrorException,
+    ClamAVFileUploadHandler,
+)
+from django_chunk_upload_handlers.clamd import (
+    ClamdError,
+    ClamdInstream,
+    get_version,
+    parse_reply,
+)
+from django_chunk_upload_handlers.models import ScannedFile
+
+
+class FakeClamdHandler(socketserver.BaseRequestHandler):
+    def read_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            received = self.request.recv(size - len(data))
+            if not received:
+                raise ConnectionError()
+            data += received
+        return data
+
+    def handle(self):
+        command = b""
+        while not command.endswith(b"\0"):
+            command += self.read_exactly(1)
+
+        self.server.commands.append(command)
+
+        if command == b"zVERSION\0":
+            self.request.sendall(b"ClamAV 1.0.1/26890/Thu Apr 20 07:26:00 2023\0")
+            return
+
+        stream = b""
+        while True:
+            try:
+                (size,) = struct.unpack("!L", self.read_exactly(4))
+            except ConnectionError:
+                # The client gave up on the stream
+                return
+
+            if not size:
+                break
+            stream += self.read_exactly(size)
+
+        self.server.streams.append(stream)
+
+        if b"EICAR" in stream:
+            self.request.sendall(b"stream: Eicar-Test-Signature FOUND\0")
+        else:
+            self.request.sendall(b"stream: OK\0")
+
+
+class ImmediateExecutor:
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+class DeferredExecutor:
+    # Runs submitted calls when asked to, as a busy scan executor would
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.calls.append((future, fn, args))
+        return future
+
+    def run(self):
+        for future, fn, args in self.calls:
+            future.set_result(fn(*args))
+
+
+class FakeClamdServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeClamdHandler)
+        self.commands = []
+        self.streams = []
+
+
+class ClamdTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeClamdServer()
+        threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.01},
+            daemon=True,
+        ).start()
+
+        port_patcher = patch(
+            "django_chunk_upload_handlers.clamd.CLAMD_PORT",
+            self.server.server_address[1],
+        )
+        host_patcher = patch("django_chunk_upload_handlers.clamd.CLAMD_HOST", "127.0.0.1")
+        port_patcher.start()
+        host_patcher.start()
+        self.addCleanup(port_patcher.stop)
+        self.addCleanup(host_patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_clean_stream(self):
+        clamd_stream = ClamdInstream()
+        clamd_stream.send(b"clean ")
+        clamd_stream.send(b"file")
+
+        self.assertEqual(clamd_stream.get_result(), (True, None))
+        self.assertEqual(self.server.commands, [b"zINSTREAM\0"])
+        self.assertEqual(self.server.streams, [b"clean file"])
+
+    def test_infected_stream(self):
+        clamd_stream = ClamdInstream()
+        clamd_stream.send(b"EICAR")
+
+        self.assertEqual(clamd_stream.get_result(), (False, "Eicar-Test-Signature"))
+
+    @patch("django_chunk_upload_handlers.clamd.CLAMD_STREAM_MAX_LENGTH", 5)
+    def test_stream_max_length_is_respected(self):
+        clamd_stream = ClamdInstream()
+        clamd_stream.send(b"four")
+        clamd_stream.send(b"more")
+
+        self.assertEqual(clamd_stream.bytes_sent, 4)
+
+        with self.assertRaises(ClamdError):
+            clamd_stream.get_result()
+
+    def test_get_version(self):
+        self.assertEqual(get_version(), "1.0.1/26890")
+
+    def test_parse_error_reply(self):
+        with self.assertRaises(ClamdError):
+            parse_reply("INSTREAM size limit exceeded. ERROR")
+
+    @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_BACKEND", "clamd")
+    def create_av_handler(self):
+        self.clam_av_file_handler = ClamAVFileUploadHandler(
+            request=RequestFactory().request(),
+        )
+        self.clam_av_file_handler.new_file(
+            "file",
+            "file.txt",
+            "text/plain",
+            100,
+            content_type_extra={},
+        )
+
+    @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_BACKEND", "clamd")
+    def test_handler_records_clean_result(self):
+        self.create_av_handler()
+        self.clam_av_file_handler.receive_data_chunk(b"clean", 0)
+        self.clam_av_file_handler.file_complete(5)
+        self.clam_av_file_handler.upload_complete()
+
+        results = self.clam_av_file_handler.content_type_extra["clam_av_results"]
+        self.assertTrue(results[0]["av_passed"])
+        self.assertTrue(ScannedFile.objects.get().av_passed)
+
+    @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_BACKEND", "clamd")
+    def test_handler_records_virus(self):
+        self.create_av_handler()
+        self.clam_av_file_handler.receive_data_chunk(b"EICAR", 0)
+        self.clam_av_file_handler.file_complete(5)
+        self.clam_av_file_handler.upload_complete()
+
+        results = self.clam_av_file_handler.content_type_extra["clam_av_results"]
+        self.assertFalse(results[0]["av_passed"])
+
+        scanned_file = ScannedFile.objects.get()
+        self.assertFalse(scanned_file.av_passed)
+        self.assertEqual(scanned_file.av_reason, "Eicar-Test-Signature")
+
+    @patch("django_chunk_upload_handlers.clamd.CLAMD_STREAM_MAX_LENGTH", 5)
+    @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_BACKEND", "clamd")
+    def test_handler_fails_file_over_stream_max_length(self):
+        self.create_av_handler()
+        self.clam_av_file_handler.receive_data_chunk(b"too large", 0)
+
+        with self.assertRaises(AntiVirusServiceErrorException):
+            self.clam_av_file_handler.file_complete(9)
+
+        self.assertFalse(ScannedFile.objects.get().av_passed)
+
+    @patch("django_chunk_upload_handlers.clam_av.connection")
+    @patch("django_chunk_upload_handlers.clam_av.get_scan_executor", ImmediateExecutor)
+    @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_BACKEND", "clamd")
+    def test_thread_scan_returns_pending_result(self, _connection):
+        self.create_av_handler()
+        self.clam_av_file_handler.async_scan = "thread"
+        self.clam_av_file_handler.receive_data_chunk(b"EICAR", 0)
+        self.clam_av_file_handler.file_complete(5)
+
+        result = self.clam_av_file_handler.content_type_extra["clam_av_results"][0]
+        self.assertTrue(result["pending"])
+        self.assertIsNone(result["av_passed"])
+        self.assertFalse(result["verdict"].result())
+
+        scanned_file = ScannedFile.objects.get()
+        self.assertEqual(result["scanned_file"], scanned_file)
+        self.assertFalse(scanned_file.pending)
+        self.assertEqual(scanned_file.av_reason, "Eicar-Test-Signature")
+
+    @patch("django_chunk_upload_handlers.clam_av.connection")
+    @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_BACKEND", "clamd")
+    def test_thread_scans_of_each_file_are_kept_apart(self, _connection):
+        executor = DeferredExecutor()
+        self.create_av_handler()
+        self.clam_av_file_handler.async_scan = "thread"
+
+        with patch("django_chunk_upload_handlers.clam_av.get_scan_executor", return_value=executor):
+            self.clam_av_file_handler.receive_data_chunk(b"EICAR", 0)
+            self.clam_av_file_handler.file_complete(5)
+
+            self.clam_av_file_handler.new_file(
+                "file", "clean.txt", "text/plain", 100, content_type_extra={},
+            )
+            self.clam_av_file_handler.async_scan = "thread"
+            self.clam_av_file_handler.receive_data_chunk(b"clean", 0)
+            self.clam_av_file_handler.file_complete(5)
+
+        executor.run()
+
+        self.assertEqual(
+            [future.result() for future, _, _ in executor.calls],
+            [False, True],
+        )
+        infected, clean = ScannedFile.objects.order_by("pk")
+        self.assertEqual(infected.file_name, "file.txt")
+        self.assertFalse(infected.pending)
+        self.assertFalse(infected.av_passed)
+        self.assertEqual(clean.file_name, "clean.txt")
+        self.assertFalse(clean.pending)
+        self.assertTrue(clean.av_passed)
+
+    @patch("django_chunk_upload_handlers.clam_av.CLAM_AV_BACKEND", "clamd")
+    def test_database_scan_does_not_connect(self):
+        clam_av_file_handler = ClamAVFileUploadHandler(
+            request=RequestFactory().request(),
+        )
+        clam_av_file_handler.async_scan = "database"
+        clam_av_file_handler.new_file(
+            "file", "file.txt", "text/plain", 100, content_type_extra={},
+        )
+        clam_av_file_handler.receive_data_chunk(b"clean", 0)
+        clam_av_file_handler.file_complete(5)
+
+        result = clam_av_file_handler.content_type_extra["clam_av_results"][0]
+        self.assertTrue(result["pending"])
+        self.assertNotIn("verdict", result)
+        self.assertEqual(self.server.commands, [])
+
+        scanned_file = ScannedFile.objects.get()
+        self.assertTrue(scanned_file.pending)
+        self.assertIsNotNone(scanned_file.content_hash)
@@ -0,0 +1,143 @@
+from datetime import datetime
+from unittest.mock import MagicMock, Mock, patch
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from django_chunk_upload_handlers import signals
+from django_chunk_upload_handlers.clam_av import ClamAVFileUploadHandler
+from django_chunk_upload_handlers.metrics import Histogram, MetricsCollector
+from django_chunk_upload_handlers.s3 import (
+    S3FileUploadHandler,
+    ThreadedS3ChunkUploader,
+    reset_s3_clients,
+)
+
+
+class MetricsCollectorTestCase(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().request()
+        self.collector = MetricsCollector()
+        self.collector.connect()
+        self.addCleanup(self.collector.disconnect)
+        reset_s3_clients()
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3Storage")
+    def test_multipart_upload_is_counted(self, storage, client):
+        handler = S3FileUploadHandler(request=self.request)
+        handler.new_file("file", "file.txt", "text/plain", 100, content_type_extra=None)
+        handler.content_type_extra = {"clam_av_results": [
+            {"file_name": "file.txt", "av_passed": True, "scanned_at": datetime.now()},
+        ]}
+
+        s3_client = handler.s3_client
+        s3_client.create_multipart_upload.return_value = {"UploadId": "test"}
+        s3_client.upload_part.return_value = {"ETag": "test"}
+        s3_client.copy_object.return_value = {"CopyObjectResult": {"ETag": "test"}}
+
+        handler.receive_data_chunk(b"tenbytes!!", 0)
+        handler.receive_data_chunk(b"five!", 10)
+        handler.file_complete(15)
+
+        snapshot = self.collector.snapshot()
+        counters = snapshot["counters"]
+        self.assertEqual(counters["files_started"], 1)
+        self.assertEqual(counters["parts_submitted"], 2)
+        self.assertEqual(counters["parts_uploaded"], 2)
+        self.assertEqual(counters["bytes_uploaded"], 15)
+        self.assertEqual(counters["s3_complete_multipart_upload"], 1)
+        self.assertEqual(counters["s3_copy_object"], 1)
+        self.assertEqual(counters["s3_delete_object"], 1)
+        self.assertEqual(counters["files_uploaded"], 1)
+        self.assertEqual(counters["bytes_stored"], 15)
+        self.assertEqual(snapshot["histograms"]["part_seconds"]["count"], 2)
+        self.assertEqual(snapshot["histograms"]["upload_seconds"]["count"], 1)
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    def test_failed_part_is_counted(self):
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {"UploadId": "test"}
+        client.upload_part.side_effect = ValueError("failed")
+
+        uploader = ThreadedS3ChunkUploader(client, "bucket", "key")
+        uploader.add(b"tenbytes!!")
+        uploader.futures[0].exception()
+
+        counters = self.collector.snapshot()["counters"]
+        self.assertEqual(counters["parts_failed"], 1)
+        self.assertNotIn("parts_uploaded", counters)
+
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3Storage")
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_file_started_by_both_handlers_is_counted_once(self, _http_connection, storage, client):
+        ClamAVFileUploadHandler(request=self.request).new_file(
+            "file", "file.txt", "text/plain", 100,
+        )
+        S3FileUploadHandler(request=self.request).new_file(
+            "file", "file.txt", "text/plain", 100, content_type_extra=None,
+        )
+
+        counters = self.collector.snapshot()["counters"]
+        self.assertEqual(counters["files_started"], 1)
+        self.assertEqual(counters["scans_started"], 1)
+
+    @patch("django_chunk_upload_handlers.clam_av.HTTPSConnection")
+    def test_av_response_is_counted(self, _http_connection):
+        handler = ClamAVFileUploadHandler(request=self.request)
+        handler.new_file("file", "file.txt", "text/plain", 100)
+        handler.content_type_extra = {}
+        handler.av_conn.sock.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
+        handler.av_conn.getresponse.return_value = Mock(
+            status=200, read=Mock(return_value='{ "malware": true, "reason": "test" }')
+        )
+
+        responses = []
+
+        def receiver(sender, **kwargs):
+            responses.append(kwargs)
+
+        signals.av_response.connect(receiver)
+        self.addCleanup(signals.av_response.disconnect, receiver)
+
+        handler.file_complete(0)
+
+        self.assertEqual(responses[0]["file_name"], "file.txt")
+        self.assertFalse(responses[0]["av_passed"])
+        self.assertEqual(responses[0]["av_reason"], "test")
+        self.assertIsNone(responses[0]["exception"])
+
+        snapshot = self.collector.snapshot()
+        self.assertEqual(snapshot["counters"]["av_failed"], 1)
+        self.assertEqual(snapshot["histograms"]["av_response_seconds"]["count"], 1)
+
+    def test_failing_receiver_does_not_fail_upload(self):
+        def receiver(sender, **kwargs):
+            raise ValueError("broken receiver")
+
+        signals.part_submitted.connect(receiver)
+        self.addCleanup(signals.part_submitted.disconnect, receiver)
+
+        client = MagicMock()
+        client.upload_part.return_value = {"ETag": "test"}
+
+        uploader = ThreadedS3ChunkUploader(client, "bucket", "key", upload_id="test")
+        with self.assertLogs("django.dispatch", "ERROR"):
+            uploader.add(b"")
+
+        self.assertEqual(uploader.get_parts(), [{"PartNumber": 1, "ETag": "test"}])
+
+
+class HistogramTestCase(TestCase):
+    def test_values_are_counted_in_buckets(self):
+        histogram = Histogram([0.1, 1])
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["count"], 4)
+        self.assertEqual(snapshot["buckets"], {0.1: 2, 1: 1, float("inf"): 1})
+        self.assertEqual(snapshot["p50"], 0.1)
+        self.assertIsNone(snapshot["p99"])
@@ -0,0 +1,53 @@
+from unittest.mock import MagicMock, patch
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils.datastructures import MultiValueDict
+
+from django_chunk_upload_handlers.middleware import ServerTimingMiddleware
+
+
+class ServerTimingMiddlewareTestCase(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().post("/upload/")
+        self.response = HttpResponse()
+        self.middleware = ServerTimingMiddleware(lambda request: self.response)
+
+    def test_file_timings_are_summed(self):
+        first_file = MagicMock(timings={"av_verdict": 0.5, "s3_parts": 0.25})
+        second_file = SimpleUploadedFile("file.txt", b"test")
+        second_file.content_type_extra = {"upload_timings": {"av_verdict": 0.25}}
+        self.request._files = MultiValueDict({"file": [first_file, second_file]})
+
+        response = self.middleware(self.request)
+
+        self.assertEqual(
+            response["Server-Timing"],
+            "av-verdict;dur=750.0, s3-parts;dur=250.0",
+        )
+
+    def test_existing_header_is_kept(self):
+        self.response["Server-Timing"] = "db;dur=10"
+        self.request._files = MultiValueDict({"file": [MagicMock(timings={"total": 1})]})
+
+        response = self.middleware(self.request)
+
+        self.assertEqual(response["Server-Timing"], "db;dur=10, total;dur=1000.0")
+
+    def test_unparsed_body_is_not_read(self):
+        response = self.middleware(self.request)
+
+        self.assertFalse(response.has_header("Server-Timing"))
+        self.assertNotIn("_files", self.request.__dict__)
+
+    @patch("django_chunk_upload_handlers.middleware.CHUNK_UPLOADER_LOG_TIMINGS", True)
+    def test_timings_are_logged(self):
+        self.request._files = MultiValueDict({"file": [MagicMock(timings={"total": 1})]})
+
+        with self.assertLogs("django_chunk_upload_handlers.middleware", "INFO") as logs:
+            self.middleware(self.request)
+
+        self.assertEqual(logs.records[0].upload_timings, {"total": 1000.0})
+        self.assertEqual(logs.records[0].upload_path, "/upload/")
@@ -0,0 +1,197 @@
+import threading
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+from botocore.exceptions import ClientError
+from django.test import TestCase
+from django.utils import timezone
+
+from django_chunk_upload_handlers.models import ScannedFile
+from django_chunk_upload_handlers.pipeline import process_pending_scans
+from django_chunk_upload_handlers.test.test_clam_av import mock_socket
+from django_chunk_upload_handlers.test.test_clamd import FakeClamdServer
+
+
+class ProcessPendingScansTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeClamdServer()
+        threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.01},
+            daemon=True,
+        ).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        for patcher in [
+            patch("django_chunk_upload_handlers.clamd.CLAMD_PORT", self.server.server_address[1]),
+            patch("django_chunk_upload_handlers.clamd.CLAMD_HOST", "127.0.0.1"),
+            patch("django_chunk_upload_handlers.clam_av.CLAM_AV_BACKEND", "clamd"),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.s3_client = MagicMock()
+        self.s3_client.copy_object.return_value = {"CopyObjectResult": {"ETag": "etag"}}
+        for patcher in [
+            patch("django_chunk_upload_handlers.pipeline.get_s3_client", return_value=self.s3_client),
+            patch("django_chunk_upload_handlers.s3.get_s3_client", return_value=self.s3_client),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def create_pending_file(self, content):
+        self.s3_client.get_object.return_value = {"Body": MagicMock()}
+        self.s3_client.get_object.return_value["Body"].iter_chunks.return_value = [content]
+
+        return ScannedFile.objects.create(
+            pending=True,
+            quarantine_key="quarantine/file_1.txt",
+            final_key="file_1.txt",
+            content_type="text/plain",
+            file_size=len(content),
+        )
+
+    def test_clean_file_is_promoted(self):
+        scanned_file = self.create_pending_file(b"clean")
+
+        self.assertEqual(process_pending_scans(), 1)
+
+        self.assertEqual(self.server.streams, [b"clean"])
+        self.s3_client.copy_object.assert_called_once()
+        self.s3_client.delete_object.assert_called_once_with(
+            Bucket="",
+            Key="quarantine/file_1.txt",
+        )
+
+        scanned_file.refresh_from_db()
+        self.assertFalse(scanned_file.pending)
+        self.assertTrue(scanned_file.av_passed)
+
+    def test_file_with_virus_is_deleted(self):
+        scanned_file = self.create_pending_file(b"EICAR")
+
+        process_pending_scans()
+
+        self.s3_client.copy_object.assert_not_called()
+        self.s3_client.delete_object.assert_called_once()
+
+        scanned_file.refresh_from_db()
+        self.assertFalse(scanned_file.pending)
+        self.assertFalse(scanned_file.av_passed)
+
+    def test_file_stays_pending_without_clamd(self):
+        scanned_file = self.create_pending_file(b"clean")
+        self.server.shutdown()
+        self.server.server_close()
+
+        self.assertEqual(process_pending_scans(), 0)
+
+        scanned_file.refresh_from_db()
+        self.assertTrue(scanned_file.pending)
+        self.s3_client.delete_object.assert_not_called()
+
+    def test_file_stays_pending_after_service_error(self):
+        scanned_file = self.create_pending_file(b"clean")
+
+        with patch("django_chunk_upload_handlers.clam_av.CLAM_AV_BACKEND", "rest"), patch(
+            "django_chunk_upload_handlers.clam_av.get_connection_pool",
+        ) as get_connection_pool:
+            av_conn = get_connection_pool.return_value.get.return_value
+            av_conn.sock = mock_socket()
+            av_conn.getresponse.return_value = MagicMock(status=503, will_close=True)
+
+            self.assertEqual(process_pending_scans(), 0)
+
+        scanned_file.refresh_from_db()
+        self.assertTrue(scanned_file.pending)
+        self.assertIsNone(scanned_file.av_reason)
+        self.s3_client.copy_object.assert_not_called()
+        self.s3_client.delete_object.assert_not_called()
+
+    def test_error_does_not_hold_up_other_files(self):
+        failing_file = self.create_pending_file(b"clean")
+        scanned_file = self.create_pending_file(b"clean")
+        self.s3_client.get_object.side_effect = [
+            ClientError({"Error": {"Code": "InternalError"}}, "GetObject"),
+            self.s3_client.get_object.return_value,
+        ]
+
+        self.assertEqual(process_pending_scans(), 1)
+
+        scanned_file.refresh_from_db()
+        self.assertFalse(scanned_file.pending)
+        self.assertTrue(scanned_file.av_passed)
+
+        failing_file.refresh_from_db()
+        self.assertTrue(failing_file.pending)
+        self.assertEqual(failing_file.scan_attempts, 1)
+        self.assertGreater(failing_file.next_scan_at, timezone.now())
+
+        # The failed file waits before it is scanned again
+        self.assertEqual(process_pending_scans(), 0)
+        self.assertEqual(self.s3_client.get_object.call_count, 2)
+
+    def test_file_being_scanned_is_skipped(self):
+        scanned_file = self.create_pending_file(b"clean")
+        ScannedFile.objects.filter(pk=scanned_file.pk).update(
+            next_scan_at=timezone.now() + timedelta(minutes=5),
+        )
+
+        self.assertEqual(process_pending_scans(), 0)
+
+        self.s3_client.get_object.assert_not_called()
+
+    def test_file_too_large_to_scan_fails(self):
+        scanned_file = self.create_pending_file(b"too large")
+
+        with patch("django_chunk_upload_handlers.clamd.CLAMD_STREAM_MAX_LENGTH", 4):
+            self.assertEqual(process_pending_scans(), 1)
+
+        self.assertEqual(self.server.streams, [])
+        self.s3_client.copy_object.assert_not_called()
+        self.s3_client.delete_object.assert_called_once()
+
+        scanned_file.refresh_from_db()
+        self.assertFalse(scanned_file.pending)
+        self.assertFalse(scanned_file.av_passed)
+        self.assertEqual(scanned_file.av_reason, "File is too large to scan")
+
+    def test_missing_file_fails(self):
+        scanned_file = self.create_pending_file(b"clean")
+        self.s3_client.get_object.side_effect = ClientError(
+            {"Error": {"Code": "NoSuchKey"}}, "GetObject",
+        )
+
+        self.assertEqual(process_pending_scans(), 1)
+
+        scanned_file.refresh_from_db()
+        self.assertFalse(scanned_file.pending)
+        self.assertEqual(scanned_file.av_reason, "File is missing from quarantine")
+
+    def test_file_is_given_up_on_after_max_attempts(self):
+        scanned_file = self.create_pending_file(b"clean")
+        ScannedFile.objects.filter(pk=scanned_file.pk).update(scan_attempts=9)
+        self.server.shutdown()
+        self.server.server_close()
+
+        self.assertEqual(process_pending_scans(), 0)
+
+        scanned_file.refresh_from_db()
+        self.assertFalse(scanned_file.pending)
+        self.assertFalse(scanned_file.av_passed)
+        self.assertEqual(scanned_file.av_reason, "File could not be scanned")
+        self.s3_client.delete_object.assert_called_once()
+
+    def test_file_not_promoted_is_scanned_again(self):
+        scanned_file = self.create_pending_file(b"clean")
+        self.s3_client.copy_object.side_effect = ClientError(
+            {"Error": {"Code": "InternalError"}}, "CopyObject",
+        )
+
+        self.assertEqual(process_pending_scans(), 0)
+
+        scanned_file.refresh_from_db()
+        self.assertTrue(scanned_file.pending)
+        self.assertEqual(scanned_file.scan_attempts, 1)
+        self.s3_client.delete_object.assert_not_called()
@@ -0,0 +1,118 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+
+class ReapChunkUploadsTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        old = now - timedelta(days=2)
+
+        pages = {
+            "list_multipart_uploads": [
+                {"Uploads": [
+                    {"Key": "chunk_upload_1", "UploadId": "old", "Initiated": old},
+                    {"Key": "chunk_upload_2", "UploadId": "new", "Initiated": now},
+                    {"Key": "uploads/file_2.txt", "UploadId": "direct", "Initiated": old},
+                ]},
+            ],
+            "list_objects_v2": [
+                {"Contents": [
+                    {"Key": "chunk_upload_3", "Size": 10, "LastModified": old},
+                ]},
+                {"Contents": [
+                    {"Key": "chunk_upload_4", "Size": 5, "LastModified": old},
+                    {"Key": "chunk_upload_5", "Size": 1, "LastModified": now},
+                    {"Key": "uploads/file_1.txt", "Size": 20, "LastModified": old},
+                ]},
+            ],
+        }
+
+        def get_paginator(name):
+            def paginate(Bucket, Prefix):
+                return [
+                    {
+                        field: [item for item in items if item["Key"].startswith(Prefix)]
+                        for field, items in page.items()
+                    }
+                    for page in pages[name]
+                ]
+
+            return MagicMock(paginate=MagicMock(side_effect=paginate))
+
+        self.client = MagicMock()
+        self.client.get_paginator.side_effect = get_paginator
+        self.client.delete_objects.return_value = {}
+
+        patcher = patch(
+            "django_chunk_upload_handlers.reaper.get_s3_client",
+            return_value=self.client,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_old_uploads_are_removed(self):
+        out = StringIO()
+        call_command("reap_chunk_uploads", stdout=out)
+
+        self.client.abort_multipart_upload.assert_called_once_with(
+            Bucket="",
+            Key="chunk_upload_1",
+            UploadId="old",
+        )
+        self.client.delete_objects.assert_called_once_with(
+            Bucket="",
+            Delete={
+                "Objects": [{"Key": "chunk_upload_3"}, {"Key": "chunk_upload_4"}],
+                "Quiet": True,
+            },
+        )
+        self.assertEqual(
+            out.getvalue().strip(),
+            "Aborted 1 of 1 multipart uploads and deleted 2 of 2 objects (15 bytes), 0 errors",
+        )
+
+    @patch("django_chunk_upload_handlers.reaper.S3_DELETE_OBJECTS_BATCH_SIZE", 1)
+    def test_failed_deletes_are_reported(self):
+        self.client.delete_objects.side_effect = [
+            {},
+            {"Errors": [{"Key": "chunk_upload_4", "Message": "Access Denied"}]},
+        ]
+
+        out = StringIO()
+        call_command("reap_chunk_uploads", stdout=out)
+
+        self.assertEqual(self.client.delete_objects.call_count, 2)
+        self.assertIn("deleted 1 of 2 objects (15 bytes), 1 errors", out.getvalue())
+
+    def test_dry_run_removes_nothing(self):
+        out = StringIO()
+        call_command("reap_chunk_uploads", dry_run=True, stdout=out)
+
+        self.client.abort_multipart_upload.assert_not_called()
+        self.client.delete_objects.assert_not_called()
+        self.assertEqual(
+            out.getvalue().strip(),
+            "Would abort 1 multipart uploads and delete 2 objects (15 bytes)",
+        )
+
+    def test_finished_files_under_prefix_are_kept(self):
+        out = StringIO()
+        call_command("reap_chunk_uploads", prefix="uploads/", stdout=out)
+
+        self.client.abort_multipart_upload.assert_called_once_with(
+            Bucket="",
+            Key="uploads/file_2.txt",
+            UploadId="direct",
+        )
+        self.client.delete_objects.assert_called_once_with(
+            Bucket="",
+            Delete={
+                "Objects": [{"Key": "chunk_upload_3"}, {"Key": "chunk_upload_4"}],
+                "Quiet": True,
+            },
+        )
@@ -0,0 +1,361 @@
+import io
+import json
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+from botocore.exceptions import ClientError
+from django.http import Http404
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from django_chunk_upload_handlers.models import ResumableUpload, ScannedFile
+from django_chunk_upload_handlers.reaper import reap_chunk_uploads
+from django_chunk_upload_handlers.resumable import (
+    UploadGone,
+    UploadOffsetMismatch,
+    append_to_upload,
+    complete_resumable_upload,
+    create_resumable_upload,
+    scan_in_background,
+)
+from django_chunk_upload_handlers.views import ResumableUploadView
+
+
+class S3ClientMixin:
+    def setUp(self):
+        self.s3_client = MagicMock()
+        self.s3_client.create_multipart_upload.return_value = {"UploadId": "upload_id"}
+        self.bodies = []
+
+        def upload_part(**kwargs):
+            body = kwargs["Body"]
+            self.bodies.append(body.read() if hasattr(body, "read") else bytes(body))
+            return {"ETag": f"etag_{kwargs['PartNumber']}"}
+
+        self.s3_client.upload_part.side_effect = upload_part
+
+        for patcher in [
+            patch("django_chunk_upload_handlers.resumable.CHUNK_UPLOADER_PART_SIZE", 4),
+            patch("django_chunk_upload_handlers.resumable.CHUNK_UPLOADER_CHECKSUM_ALGORITHM", None),
+            patch("django_chunk_upload_handlers.resumable.get_s3_client", return_value=self.s3_client),
+            patch("django_chunk_upload_handlers.s3.get_s3_client", return_value=self.s3_client),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class ResumableUploadTestCase(S3ClientMixin, TestCase):
+    def test_upload_is_created(self):
+        upload = create_resumable_upload("file.txt", 10, "text/plain")
+
+        self.assertEqual(upload.upload_id, "upload_id")
+        self.assertEqual(upload.part_size, 4)
+        self.assertEqual(upload.offset, 0)
+        self.assertTrue(upload.key.startswith("chunk_upload_"))
+        self.s3_client.create_multipart_upload.assert_called_once_with(
+            Bucket="",
+            Key=upload.key,
+            ContentType="text/plain",
+        )
+
+    def test_only_whole_parts_are_kept(self):
+        upload = create_resumable_upload("file.txt", 10)
+
+        upload = append_to_upload(upload, io.BytesIO(b"abcdef"), 0, 5)
+
+        self.assertEqual(upload.offset, 4)
+        self.assertEqual(upload.parts, [{"PartNumber": 1, "ETag": "etag_1"}])
+        self.s3_client.upload_part.assert_called_once()
+        upload.refresh_from_db()
+        self.assertEqual(upload.offset, 4)
+
+    def test_short_request_keeps_sent_parts(self):
+        upload = create_resumable_upload("file.txt", 10)
+
+        upload = append_to_upload(upload, io.BytesIO(b"abcde"), 0, 9)
+
+        self.assertEqual(upload.offset, 4)
+
+    def test_failed_part_is_not_acknowledged(self):
+        upload = create_resumable_upload("file.txt", 10)
+        self.s3_client.upload_part.side_effect = [
+            {"ETag": "etag_1"},
+            ClientError({"Error": {"Code": "AccessDenied"}}, "UploadPart"),
+        ]
+
+        upload = append_to_upload(upload, io.BytesIO(b"abcdefgh"), 0, 7)
+
+        self.assertEqual(upload.offset, 4)
+        self.assertEqual(upload.parts, [{"PartNumber": 1, "ETag": "etag_1"}])
+
+    def test_upload_continues_from_offset(self):
+        upload = create_resumable_upload("file.txt", 10)
+        upload = append_to_upload(upload, io.BytesIO(b"abcd"), 0, 3)
+
+        upload = append_to_upload(upload, io.BytesIO(b"efghij"), 4, 9)
+
+        self.assertEqual(upload.offset, 10)
+        self.assertEqual(
+            [part["PartNumber"] for part in upload.parts],
+            [1, 2, 3],
+        )
+        self.assertEqual(self.bodies, [b"abcd", b"efgh", b"ij"])
+
+    def test_wrong_offset_is_rejected(self):
+        upload = create_resumable_upload("file.txt", 10)
+
+        with self.assertRaises(UploadOffsetMismatch) as context:
+            append_to_upload(upload, io.BytesIO(b"efgh"), 4, 7)
+
+        self.assertEqual(context.exception.offset, 0)
+        self.s3_client.upload_part.assert_not_called()
+
+    def test_concurrent_append_is_rejected(self):
+        upload = create_resumable_upload("file.txt", 10)
+        stale = ResumableUpload.objects.get(pk=upload.pk)
+        append_to_upload(upload, io.BytesIO(b"abcd"), 0, 3)
+
+        with self.assertRaises(UploadOffsetMismatch) as context:
+            append_to_upload(stale, io.BytesIO(b"wxyz"), 0, 3)
+
+        self.assertEqual(context.exception.offset, 4)
+
+    def test_expired_upload_is_gone(self):
+        upload = create_resumable_upload("file.txt", 10)
+        self.s3_client.upload_part.side_effect = ClientError(
+            {"Error": {"Code": "NoSuchUpload"}}, "UploadPart",
+        )
+
+        with self.assertRaises(UploadGone):
+            append_to_upload(upload, io.BytesIO(b"abcd"), 0, 3)
+
+        self.assertFalse(ResumableUpload.objects.exists())
+
+    @patch("django_chunk_upload_handlers.resumable.get_scan_executor")
+    def test_completed_upload_is_scanned(self, get_scan_executor):
+        upload = create_resumable_upload("file.txt", 2, "text/plain")
+        upload = append_to_upload(upload, io.BytesIO(b"ab"), 0, 1)
+
+        scanned_file = complete_resumable_upload(upload)
+
+        self.s3_client.complete_multipart_upload.assert_called_once_with(
+            Bucket="",
+            Key=upload.key,
+            UploadId="upload_id",
+            MultipartUpload={"Parts": [{"PartNumber": 1, "ETag": "etag_1"}]},
+        )
+        self.assertTrue(scanned_file.pending)
+        self.assertEqual(scanned_file.quarantine_key, upload.key)
+        self.assertEqual(scanned_file.final_key, upload.final_key)
+        get_scan_executor.return_value.submit.assert_called_once_with(
+            scan_in_background, scanned_file,
+        )
+        self.assertTrue(ResumableUpload.objects.get(pk=upload.pk).completed)
+
+    @patch("django_chunk_upload_handlers.resumable.CHUNK_UPLOADER_ASYNC_SCAN", "database")
+    @patch("django_chunk_upload_handlers.resumable.get_scan_executor")
+    def test_completed_upload_is_left_to_database(self, get_scan_executor):
+        upload = create_resumable_upload("file.txt", 2)
+        upload = append_to_upload(upload, io.BytesIO(b"ab"), 0, 1)
+
+        scanned_file = complete_resumable_upload(upload)
+
+        self.assertTrue(scanned_file.pending)
+        get_scan_executor.assert_not_called()
+
+    @patch("django_chunk_upload_handlers.resumable.scan_claimed_file")
+    def test_background_scan_claims_file(self, scan_claimed_file):
+        scanned_file = ScannedFile.objects.create(
+            pending=True,
+            quarantine_key="chunk_upload_pending",
+        )
+
+        scan_in_background(scanned_file)
+        # Already claimed, so not scanned twice
+        scan_in_background(scanned_file)
+
+        scan_claimed_file.assert_called_once()
+        self.assertEqual(scan_claimed_file.call_args[0][0].pk, scanned_file.pk)
+        self.assertEqual(ScannedFile.objects.get().scan_attempts, 1)
+
+    @patch("django_chunk_upload_handlers.resumable.get_scan_executor")
+    def test_incomplete_upload_is_not_completed(self, get_scan_executor):
+        upload = create_resumable_upload("file.txt", 10)
+
+        with self.assertRaises(UploadOffsetMismatch):
+            complete_resumable_upload(upload)
+
+        self.s3_client.complete_multipart_upload.assert_not_called()
+        self.assertFalse(ScannedFile.objects.exists())
+
+    def reap(self, uploads=(), objects=()):
+        pages = {
+            "list_multipart_uploads": [{"Uploads": list(uploads)}],
+            "list_objects_v2": [{"Contents": list(objects)}],
+        }
+        self.s3_client.get_paginator.side_effect = lambda name: MagicMock(
+            paginate=MagicMock(return_value=pages[name]),
+        )
+        self.s3_client.delete_objects.return_value = {}
+
+        with patch("django_chunk_upload_handlers.reaper.get_s3_client", return_value=self.s3_client):
+            return reap_chunk_uploads("chunk_upload_", timezone.now() - timedelta(days=1))
+
+    def test_stale_uploads_are_reaped(self):
+        stale = create_resumable_upload("stale.txt", 10)
+        ResumableUpload.objects.filter(pk=stale.pk).update(
+            created_at=timezone.now() - timedelta(days=3),
+            updated_at=timezone.now() - timedelta(days=2),
+        )
+        create_resumable_upload("new.txt", 10)
+
+        summary = self.reap()
+
+        self.assertEqual(summary["resumable_uploads_found"], 1)
+        self.assertEqual(
+            list(ResumableUpload.objects.values_list("file_name", flat=True)),
+            ["new.txt"],
+        )
+
+    def test_old_upload_still_being_sent_is_kept(self):
+        self.s3_client.create_multipart_upload.return_value = {"UploadId": "active"}
+        upload = create_resumable_upload("file.txt", 10)
+        old = timezone.now() - timedelta(days=2)
+        ResumableUpload.objects.filter(pk=upload.pk).update(created_at=old)
+
+        summary = self.reap(uploads=[
+            {"Key": upload.key, "UploadId": "active", "Initiated": old},
+            {"Key": "chunk_upload_other", "UploadId": "abandoned", "Initiated": old},
+        ])
+
+        self.assertEqual(summary["resumable_uploads_found"], 0)
+        self.assertTrue(ResumableUpload.objects.filter(pk=upload.pk).exists())
+        self.s3_client.abort_multipart_upload.assert_called_once_with(
+            Bucket="",
+            Key="chunk_upload_other",
+            UploadId="abandoned",
+        )
+
+    def test_completed_file_waiting_for_scan_is_kept(self):
+        old = timezone.now() - timedelta(days=2)
+        ScannedFile.objects.create(
+            pending=True,
+            quarantine_key="chunk_upload_pending",
+            final_key="file.txt",
+        )
+
+        summary = self.reap(objects=[
+            {"Key": "chunk_upload_pending", "Size": 10, "LastModified": old},
+            {"Key": "chunk_upload_stale", "Size": 5, "LastModified": old},
+        ])
+
+        self.assertEqual(summary["objects_found"], 1)
+        self.s3_client.delete_objects.assert_called_once_with(
+            Bucket="",
+            Delete={"Objects": [{"Key": "chunk_upload_stale"}], "Quiet": True},
+        )
+
+
+@patch("django_chunk_upload_handlers.resumable.get_scan_executor")
+class ResumableUploadViewTestCase(S3ClientMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+        self.view = ResumableUploadView.as_view()
+
+    def put(self, upload, content, content_range):
+        request = self.factory.put(
+            f"/uploads/{upload.token}/",
+            content,
+            content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE=content_range,
+        )
+        return self.view(request, token=upload.token)
+
+    def test_upload_is_started(self, get_scan_executor):
+        request = self.factory.post(
+            "/uploads/",
+            json.dumps({"file_name": "file.txt", "size": 10}),
+            content_type="application/json",
+        )
+
+        response = self.view(request)
+
+        upload = ResumableUpload.objects.get()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response["Location"], f"/uploads/{upload.token}/")
+        self.assertEqual(response["Upload-Offset"], "0")
+
+    def test_missing_size_is_rejected(self, get_scan_executor):
+        request = self.factory.post(
+            "/uploads/",
+            json.dumps({"file_name": "file.txt"}),
+            content_type="application/json",
+        )
+
+        self.assertEqual(self.view(request).status_code, 400)
+
+    def test_upload_is_completed_by_last_range(self, get_scan_executor):
+        upload = create_resumable_upload("file.txt", 6)
+
+        response = self.put(upload, b"abcdef", "bytes 0-5/6")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Upload-Offset"], "6")
+        content = json.loads(response.content)
+        self.assertTrue(content["completed"])
+        self.assertEqual(content["key"], upload.final_key)
+        get_scan_executor.return_value.submit.assert_called_once()
+
+    def test_offset_mismatch_is_a_conflict(self, get_scan_executor):
+        upload = create_resumable_upload("file.txt", 10)
+
+        response = self.put(upload, b"efgh", "bytes 4-7/10")
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response["Upload-Offset"], "0")
+        self.assertEqual(json.loads(response.content)["offset"], 0)
+
+    def test_missing_content_range_is_rejected(self, get_scan_executor):
+        upload = create_resumable_upload("file.txt", 10)
+
+        self.assertEqual(self.put(upload, b"abcd", "").status_code, 400)
+
+    def test_state_is_returned(self, get_scan_executor):
+        upload = create_resumable_upload("file.txt", 10)
+        append_to_upload(upload, io.BytesIO(b"abcd"), 0, 3)
+
+        response = self.view(self.factory.get(f"/uploads/{upload.token}/"), token=upload.token)
+
+        self.assertEqual(response["Upload-Offset"], "4")
+        self.assertEqual(json.loads(response.content)["part_size"], 4)
+
+    def test_unknown_upload_is_not_found(self, get_scan_executor):
+        with self.assertRaises(Http404):
+            self.view(self.factory.get("/uploads/unknown/"), token="unknown")
+
+    def test_upload_is_aborted(self, get_scan_executor):
+        upload = create_resumable_upload("file.txt", 10)
+
+        response = self.view(self.factory.delete(f"/uploads/{upload.token}/"), token=upload.token)
+
+        self.assertEqual(response.status_code, 204)
+        self.s3_client.abort_multipart_upload.assert_called_once_with(
+            Bucket="",
+            Key=upload.key,
+            UploadId="upload_id",
+        )
+        self.assertFalse(ResumableUpload.objects.exists())
+
+    def test_failed_scan_is_reported(self, get_scan_executor):
+        upload = create_resumable_upload("file.txt", 6)
+        self.put(upload, b"abcdef", "bytes 0-5/6")
+        ScannedFile.objects.update(pending=False, av_reason="File could not be scanned")
+
+        response = self.view(self.factory.get(f"/uploads/{upload.token}/"), token=upload.token)
+
+        content = json.loads(response.content)
+        self.assertFalse(content["pending"])
+        self.assertFalse(content["av_passed"])
+        self.assertEqual(content["av_reason"], "File could not be scanned")
@@ -1,13 +1,32 @@
 import concurrent.futures
+import hashlib
+import threading
+from base64 import b64encode
+from concurrent.futures import Future
 from datetime import datetime
-from unittest.mock import MagicMock, call, patch
+from unittest.mock import ANY, MagicMock, call, patch
 
+from botocore.exceptions import ClientError
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.utils import timezone
 
+from django_chunk_upload_handlers.buffers import PartBufferPool
+from django_chunk_upload_handlers.models import ScannedFile
 from django_chunk_upload_handlers.s3 import (
+    AbortS3UploadException,
+    ConcurrencyController,
+    InFlightBudget,
+    S3_MIN_PART_SIZE,
     S3FileUploadHandler,
+    S3UploadedFile,
     ThreadedS3ChunkUploader,
+    check_part_size,
+    copy_object,
+    get_s3_client,
+    promote_scanned_file,
+    reset_s3_clients,
 )
 
 from django_chunk_upload_handlers.clam_av import FileWithVirus, VirusFoundInFileException
@@ -17,6 +36,7 @@ class S3FileHandlerTestCase(TestCase):
     def setUp(self):
         self.request_factory = RequestFactory()
         self.request = self.request_factory.request()
+        reset_s3_clients()
 
     def create_s3_handler(self):
         self.s3_file_handler = S3FileUploadHandler(
@@ -42,8 +62,8 @@ class S3FileHandlerTestCase(TestCase):
             content_type_extra=None,
         )
 
-        self.s3_file_handler.s3_client.create_multipart_upload.assert_called_once()
-        boto3_client.assert_called_with("s3", region_name="")
+        self.s3_file_handler.s3_client.create_multipart_upload.assert_not_called()
+        boto3_client.assert_called_with("s3", region_name="", config=ANY)
 
         thread_pool.assert_called_once()
 
@@ -61,14 +81,41 @@ class S3FileHandlerTestCase(TestCase):
             content_type_extra=None,
         )
 
-        self.s3_file_handler.s3_client.create_multipart_upload.assert_called_once()
+        self.s3_file_handler.s3_client.create_multipart_upload.assert_not_called()
         boto3_client.assert_called_with("s3",
                                         region_name="",
+                                        config=ANY,
                                         aws_access_key_id='access-key',
                                         aws_secret_access_key='secret-key')
 
         thread_pool.assert_called_once()
 
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    def test_client_is_shared_between_files(self, boto3_client):
+        self.assertIs(get_s3_client(), get_s3_client())
+        boto3_client.assert_called_once()
+
+        pool_connections = boto3_client.call_args[1]["config"].max_pool_connections
+        self.assertEqual(pool_connections, 10)
+
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    def test_client_cache_is_reset(self, boto3_client):
+        get_s3_client()
+        reset_s3_clients()
+        get_s3_client()
+
+        self.assertEqual(boto3_client.call_count, 2)
+
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    @patch("django_chunk_upload_handlers.s3.AWS_REGION", "eu-west-2")
+    def test_client_cache_is_keyed_by_region(self, boto3_client):
+        get_s3_client()
+
+        with patch("django_chunk_upload_handlers.s3.AWS_REGION", "us-east-1"):
+            get_s3_client()
+
+        self.assertEqual(boto3_client.call_count, 2)
+
     @patch("django_chunk_upload_handlers.s3.boto3_client")
     def test_chunk_is_received(self, client):
         self.create_s3_handler()
@@ -80,11 +127,123 @@ class S3FileHandlerTestCase(TestCase):
         # Check that we started to send data
         self.s3_file_handler.executor.mock_calls[0] = call.send(b"4")
 
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3Storage")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3StorageFile")
+    def test_small_file_is_put_in_one_request(self, storage_file, storage, client):
+        self.create_s3_handler()
+
+        # Add content_type_extra which would have been added by file handler processor
+        self.s3_file_handler.content_type_extra = {"clam_av_results": []}
+        self.s3_file_handler.content_type_extra["clam_av_results"].append(
+            {"file_name": "file.txt", "av_passed": True, "scanned_at": datetime.now()}
+        )
+
+        self.s3_file_handler.receive_data_chunk(b"small", 0)
+        self.s3_file_handler.receive_data_chunk(b"file", 5)
+        self.s3_file_handler.file_complete(9)
+
+        s3_client = self.s3_file_handler.s3_client
+        s3_client.create_multipart_upload.assert_not_called()
+        s3_client.copy_object.assert_not_called()
+        s3_client.delete_object.assert_not_called()
+        s3_client.head_object.assert_not_called()
+
+        put_object_kwargs = s3_client.put_object.call_args[1]
+        self.assertEqual(put_object_kwargs["Key"], self.s3_file_handler.new_file_name)
+        self.assertEqual(put_object_kwargs["Body"].read(), b"smallfile")
+        self.assertEqual(put_object_kwargs["ContentLength"], 9)
+        self.assertEqual(put_object_kwargs["ContentType"], "text/plain")
+        self.assertEqual(put_object_kwargs["Metadata"]["av-passed"], "True")
+
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3Storage")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3StorageFile")
+    def test_small_file_with_virus_is_not_put(self, storage_file, storage, client):
+        self.create_s3_handler()
+
+        # Add content_type_extra which would have been added by file handler processor
+        self.s3_file_handler.content_type_extra = {"clam_av_results": []}
+        self.s3_file_handler.content_type_extra["clam_av_results"].append(
+            {"file_name": "file.txt", "av_passed": False, "scanned_at": datetime.now()}
+        )
+
+        self.s3_file_handler.receive_data_chunk(b"virus", 0)
+        outcome = self.s3_file_handler.file_complete(5)
+
+        self.assertEqual(type(outcome).__name__, "FileWithVirus")
+        self.s3_file_handler.s3_client.put_object.assert_not_called()
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3Storage")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3StorageFile")
+    def test_large_file_starts_multipart_upload(self, storage_file, storage, client):
+        self.create_s3_handler()
+        self.s3_file_handler.content_type_extra = {}
+
+        s3_client = self.s3_file_handler.s3_client
+        s3_client.create_multipart_upload.return_value = {"UploadId": "test"}
+        s3_client.upload_part.return_value = {"ETag": "test"}
+
+        self.s3_file_handler.receive_data_chunk(b"ninebytes", 0)
+        s3_client.create_multipart_upload.assert_not_called()
+
+        self.s3_file_handler.receive_data_chunk(b"morebytes", 9)
+        s3_client.create_multipart_upload.assert_called_once()
+
+        self.s3_file_handler.file_complete(18)
+
+        s3_client.put_object.assert_not_called()
+        s3_client.complete_multipart_upload.assert_called_once()
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3Storage")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3StorageFile")
+    def test_phase_timings_are_recorded(self, storage_file, storage, client):
+        self.create_s3_handler()
+        # Added by the ClamAV handler
+        self.s3_file_handler.content_type_extra = {
+            "clam_av_results": [
+                {"file_name": "file.txt", "av_passed": True, "scanned_at": datetime.now()},
+            ],
+            "upload_timings": {"av_verdict": 0},
+        }
+
+        s3_client = self.s3_file_handler.s3_client
+        s3_client.create_multipart_upload.return_value = {"UploadId": "test"}
+        s3_client.upload_part.return_value = {"ETag": "test"}
+        s3_client.copy_object.return_value = {"CopyObjectResult": {"ETag": "test"}}
+
+        self.s3_file_handler.receive_data_chunk(b"ninebytesmorebytes", 0)
+        uploaded_file = self.s3_file_handler.file_complete(18)
+
+        self.assertEqual(
+            set(uploaded_file.timings),
+            {
+                "av_verdict",
+                "s3_buffer",
+                "s3_parts",
+                "s3_complete_multipart_upload",
+                "s3_copy_object",
+                "s3_delete_object",
+                "transfer",
+                "total",
+            },
+        )
+        self.assertIs(
+            self.s3_file_handler.content_type_extra["upload_timings"],
+            uploaded_file.timings,
+        )
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
     @patch("django_chunk_upload_handlers.s3.boto3_client")
     @patch("django_chunk_upload_handlers.s3.S3Boto3Storage")
     @patch("django_chunk_upload_handlers.s3.S3Boto3StorageFile")
     def test_addition_of_av_header(self, storage_file, storage, client):
         self.create_s3_handler()
+        self.s3_file_handler.receive_data_chunk(b"elevenbytes", 0)
 
         # Add content_type_extra which would have been added by file handler processor
         self.s3_file_handler.content_type_extra = {"clam_av_results": []}
@@ -97,22 +256,82 @@ class S3FileHandlerTestCase(TestCase):
             "ETag": "Test...",
         }
 
-        self.s3_file_handler.file_complete(0)
+        test_file = self.s3_file_handler.file_complete(0)
+        self.assertTrue(test_file.av_passed)
 
-        # copy_object should have been called twice,
-        # the second time to add the AV metadata
-        self.assertEqual(
-            self.s3_file_handler.s3_client.copy_object.call_count,
-            2,
+        # copy_object should have been called once, adding the AV metadata
+        # as the object is copied from its temporary key
+        self.s3_file_handler.s3_client.copy_object.assert_called_once()
+
+        copy_obj_call_list = (
+            self.s3_file_handler.s3_client.copy_object.call_args_list[0][1]
         )
 
-        second_copy_obj_call_list = (
-            self.s3_file_handler.s3_client.copy_object.call_args_list[1][1]
+        self.assertTrue("Metadata" in copy_obj_call_list)
+        self.assertTrue("av-passed" in copy_obj_call_list["Metadata"])
+        self.assertTrue(copy_obj_call_list["Metadata"]["av-passed"])
+        self.assertEqual(copy_obj_call_list["MetadataDirective"], "REPLACE")
+
+        self.s3_file_handler.s3_client.delete_object.assert_called_once_with(
+            Bucket="",
+            Key=self.s3_file_handler.s3_key,
         )
 
-        self.assertTrue("Metadata" in second_copy_obj_call_list)
-        self.assertTrue("av-passed" in second_copy_obj_call_list["Metadata"])
-        self.assertTrue(second_copy_obj_call_list["Metadata"]["av-passed"])
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_DIRECT_UPLOAD", True)
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3Storage")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3StorageFile")
+    def test_direct_upload_tags_av_result(self, storage_file, storage, client):
+        self.create_s3_handler()
+        self.assertEqual(self.s3_file_handler.s3_key, self.s3_file_handler.new_file_name)
+
+        self.s3_file_handler.receive_data_chunk(b"elevenbytes", 0)
+
+        # Add content_type_extra which would have been added by file handler processor
+        self.s3_file_handler.content_type_extra = {"clam_av_results": []}
+        self.s3_file_handler.content_type_extra["clam_av_results"].append(
+            {"file_name": "file.txt", "av_passed": True, "scanned_at": datetime.now()}
+        )
+
+        self.s3_file_handler.file_complete(11)
+
+        s3_client = self.s3_file_handler.s3_client
+        s3_client.copy_object.assert_not_called()
+        s3_client.delete_object.assert_not_called()
+
+        tagging_kwargs = s3_client.put_object_tagging.call_args[1]
+        self.assertEqual(tagging_kwargs["Key"], self.s3_file_handler.new_file_name)
+        self.assertIn(
+            {"Key": "av-passed", "Value": "True"},
+            tagging_kwargs["Tagging"]["TagSet"],
+        )
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3Storage")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3StorageFile")
+    def test_file_with_virus_is_not_copied(self, storage_file, storage, client):
+        self.create_s3_handler()
+        self.s3_file_handler.receive_data_chunk(b"elevenbytes", 0)
+
+        # Add content_type_extra which would have been added by file handler processor
+        self.s3_file_handler.content_type_extra = {"clam_av_results": []}
+        self.s3_file_handler.content_type_extra["clam_av_results"].append(
+            {"file_name": "file.txt", "av_passed": False, "scanned_at": datetime.now()}
+        )
+
+        self.s3_file_handler.file_complete(11)
+
+        s3_client = self.s3_file_handler.s3_client
+        s3_client.complete_multipart_upload.assert_not_called()
+        s3_client.copy_object.assert_not_called()
+        s3_client.delete_object.assert_not_called()
+        s3_client.abort_multipart_upload.assert_called_once_with(
+            Bucket="",
+            Key=self.s3_file_handler.s3_key,
+            UploadId=self.s3_file_handler.executor.upload_id,
+        )
 
     @patch("django_chunk_upload_handlers.s3.boto3_client")
     @patch("django_chunk_upload_handlers.s3.S3Boto3Storage")
@@ -145,8 +364,113 @@ class S3FileHandlerTestCase(TestCase):
         outcome = self.s3_file_handler.file_complete(0)
         self.assertEqual(type(outcome).__name__, "FileWithVirus")
 
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_ASYNC_SCAN", "thread")
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    @patch("django_chunk_upload_handlers.s3.S3Boto3Storage")
+    def test_pending_file_is_quarantined(self, storage, client):
+        self.create_s3_handler()
+        self.assertEqual(
+            self.s3_file_handler.s3_key,
+            f"quarantine/{self.s3_file_handler.new_file_name}",
+        )
+
+        scanned_file = ScannedFile.objects.create(pending=True)
+        verdict = Future()
+        self.s3_file_handler.content_type_extra = {"clam_av_results": [{
+            "file_name": "file.txt",
+            "av_passed": None,
+            "scanned_at": None,
+            "pending": True,
+            "scanned_file": scanned_file,
+            "verdict": verdict,
+        }]}
+
+        s3_client = self.s3_file_handler.s3_client
+        s3_client.put_object.return_value = {"ETag": "etag"}
+        s3_client.copy_object.return_value = {"CopyObjectResult": {"ETag": "etag"}}
+
+        self.s3_file_handler.receive_data_chunk(b"clean", 0)
+        uploaded_file = self.s3_file_handler.file_complete(5)
+
+        self.assertIsNone(uploaded_file.av_passed)
+        self.assertEqual(uploaded_file.scanned_file_id, scanned_file.pk)
+        self.assertEqual(s3_client.put_object.call_args[1]["Key"], self.s3_file_handler.s3_key)
+        s3_client.copy_object.assert_not_called()
+
+        scanned_file.refresh_from_db()
+        self.assertEqual(scanned_file.quarantine_key, self.s3_file_handler.s3_key)
+        self.assertEqual(scanned_file.final_key, self.s3_file_handler.new_file_name)
+        self.assertEqual(scanned_file.file_size, 5)
+
+        # The file is moved out of quarantine once the scan passes
+        scanned_file.pending = False
+        scanned_file.av_passed = True
+        scanned_file.scanned_at = timezone.now()
+        verdict.set_result(True)
+
+        copy_kwargs = s3_client.copy_object.call_args[1]
+        self.assertEqual(copy_kwargs["Key"], self.s3_file_handler.new_file_name)
+        self.assertEqual(copy_kwargs["Metadata"]["av-passed"], "True")
+        s3_client.delete_object.assert_called_once_with(
+            Bucket="",
+            Key=self.s3_file_handler.s3_key,
+        )
+
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    def test_failed_quarantined_file_is_deleted(self, client):
+        scanned_file = ScannedFile(
+            av_passed=False,
+            quarantine_key="quarantine/file.txt",
+            final_key="file.txt",
+            file_size=5,
+        )
+
+        promote_scanned_file(scanned_file)
+
+        s3_client = get_s3_client()
+        s3_client.copy_object.assert_not_called()
+        s3_client.delete_object.assert_called_once_with(
+            Bucket="",
+            Key="quarantine/file.txt",
+        )
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_RETRY_BASE_DELAY", 0)
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    def test_failed_part_aborts_upload(self, client):
+        self.create_s3_handler()
+        self.s3_file_handler.content_type_extra = {}
+
+        s3_client = self.s3_file_handler.s3_client
+        s3_client.create_multipart_upload.return_value = {"UploadId": "test"}
+        s3_client.upload_part.side_effect = slow_down_error()
+
+        self.s3_file_handler.receive_data_chunk(b"tenbytes!!", 0)
+
+        with self.assertRaises(AbortS3UploadException):
+            self.s3_file_handler.file_complete(10)
+
+        self.assertEqual(s3_client.upload_part.call_count, 5)
+        s3_client.complete_multipart_upload.assert_not_called()
+        s3_client.abort_multipart_upload.assert_called_once_with(
+            Bucket="",
+            Key=self.s3_file_handler.s3_key,
+            UploadId="test",
+        )
+
+
+def slow_down_error():
+    return ClientError(
+        {
+            "Error": {"Code": "SlowDown", "Message": "Please reduce your request rate."},
+            "ResponseMetadata": {"HTTPStatusCode": 503},
+        },
+        "UploadPart",
+    )
+
+
 class ThreadedS3ChunkUploaderTestCase(TestCase):
-    @patch("django_chunk_upload_handlers.s3.S3_MIN_PART_SIZE", 10)
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
     @patch("django_chunk_upload_handlers.s3.boto3_client")
     def test_add_future_with_body(self, client):
         test_etag = "test"
@@ -161,9 +485,10 @@ class ThreadedS3ChunkUploaderTestCase(TestCase):
 
         threaded_s3_uploader.client.upload_part.assert_not_called()
 
-        # Push total bytes above min size
+        # Push total bytes above min size, the bytes beyond the part size
+        # are kept for the next part
         threaded_s3_uploader.add(b"morebytes")
-        self.assertEqual(threaded_s3_uploader.current_queue_size, 0)
+        self.assertEqual(threaded_s3_uploader.current_queue_size, 8)
         self.assertEqual(len(threaded_s3_uploader.futures), 1)
 
         # Wait for upload threads to complete
@@ -197,3 +522,465 @@ class ThreadedS3ChunkUploaderTestCase(TestCase):
 
         test_file = threaded_s3_uploader.file_complete(file_size=1)
         self.assertEqual(test_file.original_name, "filename.jpg")
+        self.assertIsNone(test_file.av_passed)
+
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    def test_uploaders_share_executor(self, client):
+        first = ThreadedS3ChunkUploader(client, "test_bucket", "key_1", "id_1")
+        second = ThreadedS3ChunkUploader(client, "test_bucket", "key_2", "id_2")
+
+        self.assertIs(first.executor, second.executor)
+        self.assertIs(first.in_flight_budget, second.in_flight_budget)
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    def test_budget_is_released_when_part_completes(self, client):
+        client.upload_part.return_value = {"ETag": "test"}
+
+        threaded_s3_uploader = ThreadedS3ChunkUploader(
+            client, "test_bucket", "test_key", "test_upload_id"
+        )
+        threaded_s3_uploader.in_flight_budget = InFlightBudget(100)
+
+        threaded_s3_uploader.add(b"elevenbytes")
+        concurrent.futures.wait(threaded_s3_uploader.futures)
+
+        self.assertEqual(threaded_s3_uploader.in_flight_budget.in_flight, 0)
+
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 4)
+    def test_parts_beyond_budget_are_spooled(self):
+        client = MagicMock()
+        bodies = []
+        sending = threading.Event()
+        blocked = threading.Event()
+
+        def upload_part(**kwargs):
+            body = kwargs["Body"]
+            content = bytes(body) if isinstance(body, bytearray) else body.read()
+            bodies.append((kwargs["PartNumber"], type(body).__name__, content))
+            sending.set()
+            blocked.wait(5)
+            return {"ETag": str(kwargs["PartNumber"])}
+
+        client.upload_part.side_effect = upload_part
+
+        uploader = ThreadedS3ChunkUploader(client, "bucket", "key", "upload_id")
+        uploader.in_flight_budget = InFlightBudget(4)
+        uploader.spool_budget = InFlightBudget(100)
+
+        # The first part fills the memory budget while S3 is held up, the
+        # second goes to disk rather than waiting for it
+        uploader.add(b"abcd")
+        sending.wait(5)
+        uploader.add(b"efgh")
+
+        self.assertEqual(uploader.spool_budget.in_flight, 4)
+        self.assertEqual(uploader.in_flight_budget.in_flight, 4)
+
+        blocked.set()
+        concurrent.futures.wait(uploader.futures)
+
+        self.assertEqual(uploader.spool_budget.in_flight, 0)
+        self.assertEqual(uploader.in_flight_budget.in_flight, 0)
+        self.assertEqual(
+            sorted(bodies),
+            [(1, "bytearray", b"abcd"), (2, "MemoryViewReader", b"efgh")],
+        )
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 4)
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    def test_chunks_are_split_into_parts(self, client):
+        bodies = []
+
+        def upload_part(**kwargs):
+            body = kwargs["Body"]
+            bodies.append(bytes(body) if isinstance(body, bytearray) else body.read())
+            return {"ETag": str(kwargs["PartNumber"])}
+
+        client.upload_part.side_effect = upload_part
+
+        threaded_s3_uploader = ThreadedS3ChunkUploader(
+            client, "test_bucket", "test_key", "test_upload_id"
+        )
+
+        threaded_s3_uploader.add(b"abcdefghij")
+        threaded_s3_uploader.add(None)
+
+        concurrent.futures.wait(threaded_s3_uploader.futures)
+
+        self.assertEqual(sorted(bodies), [b"abcd", b"efgh", b"ij"])
+        self.assertEqual(
+            [part["PartNumber"] for part in threaded_s3_uploader.get_parts()],
+            [1, 2, 3],
+        )
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 4)
+    @patch("django_chunk_upload_handlers.s3.boto3_client")
+    def test_buffers_are_returned_to_pool(self, client):
+        client.upload_part.return_value = {"ETag": "test"}
+
+        threaded_s3_uploader = ThreadedS3ChunkUploader(
+            client, "test_bucket", "test_key", "test_upload_id"
+        )
+        threaded_s3_uploader.buffer_pool = PartBufferPool(100)
+
+        threaded_s3_uploader.add(b"abcdefgh")
+        concurrent.futures.wait(threaded_s3_uploader.futures)
+
+        self.assertEqual(threaded_s3_uploader.buffer_pool.retained_bytes, 8)
+
+    def test_part_size_grows_with_part_number(self):
+        threaded_s3_uploader = ThreadedS3ChunkUploader(
+            MagicMock(), "test_bucket", "test_key", part_size=10, max_part_size=50,
+        )
+
+        self.assertEqual(threaded_s3_uploader.get_part_size(), 10)
+
+        threaded_s3_uploader.part_number = 1000
+        self.assertEqual(threaded_s3_uploader.get_part_size(), 20)
+
+        threaded_s3_uploader.part_number = 2000
+        self.assertEqual(threaded_s3_uploader.get_part_size(), 40)
+
+        # Limited by the maximum part size
+        threaded_s3_uploader.part_number = 3000
+        self.assertEqual(threaded_s3_uploader.get_part_size(), 50)
+
+    def test_part_size_fits_expected_size_in_part_limit(self):
+        threaded_s3_uploader = ThreadedS3ChunkUploader(
+            MagicMock(),
+            "test_bucket",
+            "test_key",
+            part_size=10,
+            max_part_size=1000,
+            expected_size=200001,
+        )
+
+        self.assertEqual(threaded_s3_uploader.get_part_size(), 21)
+
+    def test_part_size_from_handler(self):
+        handler = S3FileUploadHandler(request=RequestFactory().request())
+        handler.part_size = 6 * 1024 * 1024
+        handler.handle_raw_input(None, {}, 100, "boundary")
+
+        with patch("django_chunk_upload_handlers.s3.boto3_client"):
+            reset_s3_clients()
+            handler.new_file("file", "file.txt", "text/plain", 100, content_type_extra={})
+
+        self.assertEqual(handler.executor.part_size, 6 * 1024 * 1024)
+        self.assertEqual(handler.executor.expected_size, 100)
+
+    def test_part_size_below_s3_minimum_is_refused(self):
+        handler = S3FileUploadHandler(request=RequestFactory().request())
+        handler.part_size = 1024 * 1024
+
+        with self.assertRaises(ImproperlyConfigured):
+            handler.new_file("file", "file.txt", "text/plain", 100, content_type_extra={})
+
+        with self.assertRaises(ImproperlyConfigured):
+            check_part_size(S3_MIN_PART_SIZE - 1)
+
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_RETRY_BASE_DELAY", 0)
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    def test_failed_part_is_retried(self):
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {"UploadId": "test"}
+        client.upload_part.side_effect = [slow_down_error(), {"ETag": "part-1"}]
+
+        uploader = ThreadedS3ChunkUploader(client, "bucket", "key")
+        uploader.add(b"tenbytes!!")
+        uploader.add(None)
+
+        self.assertEqual(uploader.get_parts(), [{"PartNumber": 1, "ETag": "part-1"}])
+        self.assertEqual(client.upload_part.call_count, 2)
+        self.assertEqual(uploader.retry_count, 1)
+        self.assertFalse(uploader.failed)
+
+        # The part is resent with the same content
+        for upload_part_call in client.upload_part.call_args_list:
+            self.assertEqual(bytes(upload_part_call[1]["Body"]), b"tenbytes!!")
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    def test_client_error_is_not_retried(self):
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {"UploadId": "test"}
+        client.upload_part.side_effect = ClientError(
+            {"Error": {"Code": "AccessDenied"}, "ResponseMetadata": {"HTTPStatusCode": 403}},
+            "UploadPart",
+        )
+
+        uploader = ThreadedS3ChunkUploader(client, "bucket", "key")
+        uploader.add(b"tenbytes!!")
+        concurrent.futures.wait(uploader.futures)
+
+        client.upload_part.assert_called_once()
+        self.assertTrue(uploader.failed)
+
+        # No further parts are sent once a part has failed
+        with self.assertRaises(AbortS3UploadException):
+            uploader.add(b"tenbytes!!")
+
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    def test_upload_concurrency_is_limited(self):
+        sending = threading.Semaphore(0)
+        release = threading.Event()
+        sent = []
+
+        def upload_part(**kwargs):
+            sent.append(kwargs["PartNumber"])
+            sending.release()
+            release.wait(5)
+            return {"ETag": str(kwargs["PartNumber"])}
+
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {"UploadId": "test"}
+        client.upload_part.side_effect = upload_part
+
+        uploader = ThreadedS3ChunkUploader(client, "bucket", "key", max_concurrency=1)
+        uploader.add(b"tenbytes!!tenbytes!!")
+
+        self.assertTrue(sending.acquire(timeout=5))
+        self.assertFalse(sending.acquire(timeout=0.1))
+        self.assertEqual(sent, [1])
+        self.assertEqual(len(uploader.pending), 1)
+
+        release.set()
+        concurrent.futures.wait(uploader.futures, timeout=5)
+        self.assertEqual(sent, [1, 2])
+
+
+    @patch("django_chunk_upload_handlers.s3.CHUNK_UPLOADER_PART_SIZE", 10)
+    def test_part_checksums_are_sent(self):
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {"UploadId": "test"}
+        client.upload_part.return_value = {"ETag": "etag"}
+
+        uploader = ThreadedS3ChunkUploader(
+            client, "bucket", "key", checksum_algorithm="SHA256",
+        )
+        uploader.add(b"tenbytes!!")
+        uploader.add(b"five!")
+        uploader.add(None)
+        parts = uploader.get_parts()
+
+        first_digest = hashlib.sha256(b"tenbytes!!").digest()
+        second_digest = hashlib.sha256(b"five!").digest()
+
+        self.assertEqual(
+            client.create_multipart_upload.call_args[1]["ChecksumAlgorithm"],
+            "SHA256",
+        )
+        self.assertEqual(
+            [call[1]["ChecksumSHA256"] for call in client.upload_part.call_args_list],
+            [b64encode(first_digest).decode(), b64encode(second_digest).decode()],
+        )
+        self.assertEqual(parts[1]["ChecksumSHA256"], b64encode(second_digest).decode())
+
+        composite = hashlib.sha256(first_digest + second_digest).digest()
+        self.assertEqual(uploader.checksum, f"{b64encode(composite).decode()}-2")
+
+    def test_put_object_checksum(self):
+        client = MagicMock()
+
+        uploader = ThreadedS3ChunkUploader(
+            client, "bucket", "key", checksum_algorithm="SHA256",
+        )
+        uploader.add(b"small")
+        uploader.put_object(Key="key", Metadata={"av-passed": "True"})
+
+        checksum = b64encode(hashlib.sha256(b"small").digest()).decode()
+        put_object_kwargs = client.put_object.call_args[1]
+        self.assertEqual(put_object_kwargs["ChecksumSHA256"], checksum)
+        self.assertEqual(
+            put_object_kwargs["Metadata"],
+            {"av-passed": "True", "checksum-sha256": checksum},
+        )
+        self.assertEqual(uploader.checksum, checksum)
+
+
+class ConcurrencyControllerTestCase(TestCase):
+    part_size = 5 * 1024 * 1024
+
+    def send_part(self, controller, elapsed, congested=False):
+        controller.acquire()
+        controller.release(self.part_size, elapsed, congested=congested)
+
+    def test_limit_grows_while_parts_succeed(self):
+        controller = ConcurrencyController(2, 10, 2)
+
+        for _ in range(5):
+            self.send_part(controller, 1)
+
+        self.assertEqual(controller.limit, 7)
+
+        for _ in range(10):
+            self.send_part(controller, 1)
+
+        self.assertEqual(controller.limit, 10)
+
+    def test_limit_halves_when_throttled(self):
+        controller = ConcurrencyController(2, 10, 2)
+        controller.limit = 8
+
+        self.send_part(controller, 0.01, congested=True)
+
+        self.assertEqual(controller.limit, 4)
+        self.assertFalse(controller.slow_start)
+
+        # Growth is additive once congestion has been seen
+        self.send_part(controller, 0.01)
+        self.assertEqual(controller.limit, 4.25)
+
+    def test_limit_halves_on_latency_spike(self):
+        controller = ConcurrencyController(2, 10, 2)
+        controller.limit = 8
+        controller.latency = 1 / self.part_size
+
+        self.send_part(controller, 3)
+
+        self.assertEqual(controller.limit, 4)
+
+    def test_limit_does_not_drop_below_minimum(self):
+        controller = ConcurrencyController(2, 10, 2)
+
+        self.send_part(controller, 0.01, congested=True)
+
+        self.assertEqual(controller.limit, 2)
+
+    def test_acquire_blocks_at_limit(self):
+        controller = ConcurrencyController(1, 10, 2)
+        controller.acquire()
+
+        acquired = threading.Event()
+
+        def acquire():
+            controller.acquire()
+            acquired.set()
+
+        threading.Thread(target=acquire, daemon=True).start()
+        self.assertFalse(acquired.wait(0.1))
+
+        controller.release(self.part_size, 1)
+        self.assertTrue(acquired.wait(5))
+
+
+class S3UploadedFileTestCase(TestCase):
+    @patch("django_chunk_upload_handlers.s3.S3Boto3StorageFile")
+    def test_known_attributes_do_not_access_s3(self, storage_file):
+        storage = MagicMock(location="root")
+        test_file = S3UploadedFile(
+            "root/file.txt",
+            storage,
+            size=10,
+            content_type="text/plain",
+            original_name="original.txt",
+            etag='"etag"',
+            av_passed=True,
+        )
+
+        self.assertEqual(test_file.name, "file.txt")
+        self.assertEqual(test_file.size, 10)
+        self.assertEqual(test_file.file_size, 10)
+        self.assertEqual(test_file.etag, '"etag"')
+        self.assertTrue(test_file.av_passed)
+        self.assertTrue(test_file.closed)
+
+        test_file.close()
+
+        storage_file.assert_not_called()
+
+    @patch("django_chunk_upload_handlers.s3.S3Boto3StorageFile")
+    def test_content_is_read_from_s3(self, storage_file):
+        storage = MagicMock(location="")
+        storage_file.return_value.read.return_value = b"content"
+
+        test_file = S3UploadedFile(
+            "file.txt",
+            storage,
+            size=7,
+            content_type="text/plain",
+            original_name="file.txt",
+        )
+
+        self.assertEqual(test_file.read(), b"content")
+        storage_file.assert_called_once_with("file.txt", "rb", storage)
+
+
+class CopyObjectTestCase(TestCase):
+    def test_small_object_is_copied_in_one_request(self):
+        client = MagicMock()
+
+        copy_object(client, "bucket", "source", "dest", 100, ContentType="text/plain")
+
+        client.copy_object.assert_called_once_with(
+            Bucket="bucket",
+            CopySource="bucket/source",
+            Key="dest",
+            MetadataDirective="REPLACE",
+            ContentType="text/plain",
+        )
+        client.upload_part_copy.assert_not_called()
+
+    @patch("django_chunk_upload_handlers.s3.S3_MAX_COPY_SIZE", 10)
+    @patch("django_chunk_upload_handlers.s3.S3_COPY_PART_SIZE", 10)
+    def test_large_object_is_copied_in_parts(self):
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {"UploadId": "test"}
+        client.upload_part_copy.return_value = {"CopyPartResult": {"ETag": "test"}}
+
+        copy_object(client, "bucket", "source", "dest", 25, ContentType="text/plain")
+
+        client.copy_object.assert_not_called()
+        ranges = sorted(
+            kwargs["CopySourceRange"]
+            for _, kwargs in client.upload_part_copy.call_args_list
+        )
+        self.assertEqual(ranges, ["bytes=0-9", "bytes=10-19", "bytes=20-24"])
+
+        parts = client.complete_multipart_upload.call_args[1]["MultipartUpload"]["Parts"]
+        self.assertEqual([part["PartNumber"] for part in parts], [1, 2, 3])
+
+    @patch("django_chunk_upload_handlers.s3.S3_MAX_COPY_SIZE", 10)
+    @patch("django_chunk_upload_handlers.s3.S3_COPY_PART_SIZE", 10)
+    def test_failed_part_copy_aborts_upload(self):
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {"UploadId": "test"}
+        client.upload_part_copy.side_effect = Exception("failed")
+
+        with self.assertRaises(Exception):
+            copy_object(client, "bucket", "source", "dest", 25)
+
+        client.abort_multipart_upload.assert_called_once()
+        client.complete_multipart_upload.assert_not_called()
+
+
+class InFlightBudgetTestCase(TestCase):
+    def test_acquire_blocks_until_release(self):
+        budget = InFlightBudget(10)
+        budget.acquire(8)
+
+        acquired = threading.Event()
+
+        def acquire():
+            budget.acquire(5)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+
+        self.assertFalse(acquired.wait(0.1))
+
+        budget.release(8)
+        thread.join(1)
+
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(budget.in_flight, 5)
+
+    def test_oversized_acquire_is_capped(self):
+        budget = InFlightBudget(10)
+
+        self.assertEqual(budget.acquire(50), 10)
+        self.assertEqual(budget.in_flight, 10)
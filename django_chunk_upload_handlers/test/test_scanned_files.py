@@ -0,0 +1,63 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from django_chunk_upload_handlers.models import ScannedFile
+from django_chunk_upload_handlers.scanned_files import ScannedFileWriter
+
+
+class ScannedFileWriterTestCase(TestCase):
+    @patch("django_chunk_upload_handlers.scanned_files.save_scanned_files")
+    def test_records_are_written_in_batches(self, save_scanned_files):
+        writer = ScannedFileWriter(queue_size=10, batch_size=2, flush_interval=0.05)
+        scanned_files = [ScannedFile(file_name=f"{i}.txt") for i in range(3)]
+
+        for scanned_file in scanned_files:
+            writer.put(scanned_file)
+        writer.flush()
+
+        written = [
+            scanned_file
+            for call in save_scanned_files.call_args_list
+            for scanned_file in call[0][0]
+        ]
+        self.assertEqual(written, scanned_files)
+        self.assertTrue(all(len(call[0][0]) <= 2 for call in save_scanned_files.call_args_list))
+
+    @patch("django_chunk_upload_handlers.scanned_files.save_scanned_files")
+    def test_write_error_does_not_stop_writer(self, save_scanned_files):
+        save_scanned_files.side_effect = [Exception(), None]
+        writer = ScannedFileWriter(queue_size=10, batch_size=1, flush_interval=0.01)
+
+        writer.put(ScannedFile(file_name="1.txt"))
+        writer.flush()
+        writer.put(ScannedFile(file_name="2.txt"))
+        writer.flush()
+
+        self.assertEqual(save_scanned_files.call_count, 2)
+
+
+class PruneScannedFilesTestCase(TestCase):
+    def test_old_records_are_deleted_in_batches(self):
+        old = timezone.now() - timedelta(days=91)
+        ScannedFile.objects.bulk_create(
+            [ScannedFile(file_name=f"{i}.txt", scanned_at=old) for i in range(5)]
+            + [
+                ScannedFile(file_name="pending.txt", scanned_at=old, pending=True),
+                ScannedFile(file_name="new.txt"),
+            ]
+        )
+
+        out = StringIO()
+        with self.assertNumQueries(7):
+            call_command("prune_scanned_files", batch_size=2, pause=0, stdout=out)
+
+        self.assertEqual(out.getvalue().strip(), "Deleted 5 scanned file records")
+        self.assertEqual(
+            sorted(ScannedFile.objects.values_list("file_name", flat=True)),
+            ["new.txt", "pending.txt"],
+        )
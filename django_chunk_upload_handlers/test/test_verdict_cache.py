@@ -0,0 +1,56 @@
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.test import TestCase
+
+from django_chunk_upload_handlers.verdict_cache import VerdictCache
+
+
+class VerdictCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = caches["default"]
+        self.cache.clear()
+
+    def test_clean_verdict_is_cached(self):
+        verdict_cache = VerdictCache(self.cache, 60, 10)
+
+        self.assertFalse(verdict_cache.is_clean("hash", "1/1"))
+
+        verdict_cache.set_clean("hash", "1/1")
+
+        self.assertTrue(verdict_cache.is_clean("hash", "1/1"))
+
+    def test_verdict_is_keyed_on_signature_version(self):
+        verdict_cache = VerdictCache(self.cache, 60, 10)
+        verdict_cache.set_clean("hash", "1/1")
+
+        self.assertFalse(verdict_cache.is_clean("hash", "1/2"))
+
+    def test_local_cache_is_used_before_shared_cache(self):
+        verdict_cache = VerdictCache(self.cache, 60, 10)
+        verdict_cache.set_clean("hash", "1/1")
+
+        with patch.object(self.cache, "get") as cache_get:
+            self.assertTrue(verdict_cache.is_clean("hash", "1/1"))
+
+        cache_get.assert_not_called()
+
+    def test_shared_cache_is_used_by_other_processes(self):
+        VerdictCache(self.cache, 60, 10).set_clean("hash", "1/1")
+
+        self.assertTrue(VerdictCache(self.cache, 60, 10).is_clean("hash", "1/1"))
+
+    def test_local_cache_is_limited_in_size(self):
+        verdict_cache = VerdictCache(self.cache, 60, 2)
+
+        verdict_cache.set_clean("first", "1/1")
+        verdict_cache.set_clean("second", "1/1")
+        verdict_cache.set_clean("third", "1/1")
+
+        self.assertEqual(
+            list(verdict_cache._local),
+            [
+                verdict_cache.get_key("second", "1/1"),
+                verdict_cache.get_key("third", "1/1"),
+            ],
+        )
@@ -1,4 +1,5 @@
 import logging
+import time
 
 from django.conf import settings
 
@@ -20,3 +21,24 @@ def check_required_setting(setting_key, secondary_setting_key=""):
         return getattr(settings, secondary_setting_key)
 
     return getattr(settings, setting_key)
+
+
+def sendmsg_all(sock, buffers):
+    buffers = [memoryview(buffer) for buffer in buffers if len(buffer)]
+
+    while buffers:
+        sent = sock.sendmsg(buffers)
+
+        # Drop whatever was written, sendmsg may stop part way through
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+def add_timing(timings, phase, started_at):
+    # Phases can be entered more than once per file, such as once per chunk
+    timings[phase] = timings.get(phase, 0) + time.monotonic() - started_at
@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+# The alias of the Django cache used to share clean verdicts between
+# processes, the verdict cache is disabled if not set
+CLAM_AV_VERDICT_CACHE = getattr(settings, "CLAM_AV_VERDICT_CACHE", None)
+CLAM_AV_VERDICT_CACHE_TTL = getattr(settings, "CLAM_AV_VERDICT_CACHE_TTL", 60 * 60)
+CLAM_AV_VERDICT_CACHE_LOCAL_SIZE = getattr(
+    settings, "CLAM_AV_VERDICT_CACHE_LOCAL_SIZE",
+    1024,
+)
+
+
+class VerdictCache:
+    def __init__(self, cache, ttl, local_size):
+        self.cache = cache
+        self.ttl = ttl
+        self.local_size = local_size
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_key(self, content_hash, signature_version):
+        return f"clam_av_verdict:{signature_version}:{content_hash}"
+
+    def is_clean(self, content_hash, signature_version):
+        key = self.get_key(content_hash, signature_version)
+
+        with self._lock:
+            expires_at = self._local.get(key)
+            if expires_at is not None:
+                if expires_at > time.monotonic():
+                    self._local.move_to_end(key)
+                    return True
+                del self._local[key]
+
+        if self.cache.get(key):
+            self.set_local(key)
+            return True
+
+        return False
+
+    def set_clean(self, content_hash, signature_version):
+        key = self.get_key(content_hash, signature_version)
+
+        self.cache.set(key, True, self.ttl)
+        self.set_local(key)
+
+    def set_local(self, key):
+        with self._lock:
+            self._local[key] = time.monotonic() + self.ttl
+            self._local.move_to_end(key)
+
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+
+_verdict_cache = None
+_verdict_cache_lock = threading.Lock()
+
+
+def get_verdict_cache():
+    global _verdict_cache
+
+    if CLAM_AV_VERDICT_CACHE is None:
+        return None
+
+    if _verdict_cache is None:
+        with _verdict_cache_lock:
+            if _verdict_cache is None:
+                _verdict_cache = VerdictCache(
+                    caches[CLAM_AV_VERDICT_CACHE],
+                    CLAM_AV_VERDICT_CACHE_TTL,
+                    CLAM_AV_VERDICT_CACHE_LOCAL_SIZE,
+                )
+
+    return _verdict_cache
@@ -0,0 +1,137 @@
+import json
+import re
+
+from django.core.exceptions import ValidationError
+from django.http import Http404, HttpResponse, JsonResponse
+from django.views import View
+
+from django_chunk_upload_handlers.models import ResumableUpload
+from django_chunk_upload_handlers.resumable import (
+    ResumableUploadError,
+    UploadOffsetMismatch,
+    abort_resumable_upload,
+    append_to_upload,
+    complete_resumable_upload,
+    create_resumable_upload,
+)
+
+
+CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+
+class ResumableUploadView(View):
+    # POST to start an upload, with file_name, size and content_type as JSON.
+    # PUT parts of the file to the upload's URL with a Content-Range header,
+    # GET (or HEAD) it to find where to continue from and DELETE it to give
+    # up. The upload is completed, and the file scanned, once every byte is
+    # stored. Route it both with and without a token argument, authentication
+    # and scoping uploads to their owner are left to subclasses
+    http_method_names = ["get", "head", "post", "put", "delete"]
+
+    def get_queryset(self):
+        return ResumableUpload.objects.select_related("scanned_file")
+
+    def get_upload(self, token):
+        if token is None:
+            raise Http404()
+
+        try:
+            return self.get_queryset().get(token=token)
+        except (ResumableUpload.DoesNotExist, ValidationError):
+            raise Http404()
+
+    def get_location(self, upload):
+        return f"{self.request.path.rstrip('/')}/{upload.token}/"
+
+    def get_state(self, upload):
+        state = {
+            "id": str(upload.token),
+            "offset": upload.offset,
+            "size": upload.size,
+            "part_size": upload.part_size,
+            "completed": upload.completed,
+        }
+
+        # The scanned file is gone once prune_scanned_files has removed it
+        scanned_file = upload.scanned_file if upload.completed else None
+        if scanned_file is not None:
+            state.update({
+                "key": scanned_file.final_key,
+                "scanned_file_id": scanned_file.pk,
+                "pending": scanned_file.pending,
+                "av_passed": None if scanned_file.pending else scanned_file.av_passed,
+            })
+
+            if not scanned_file.pending and not scanned_file.av_passed:
+                state["av_reason"] = scanned_file.av_reason
+
+        return state
+
+    def respond(self, upload, status=200):
+        response = JsonResponse(self.get_state(upload), status=status)
+        response["Upload-Offset"] = str(upload.offset)
+        return response
+
+    def respond_error(self, error):
+        content = {"error": str(error)}
+        if isinstance(error, UploadOffsetMismatch):
+            content["offset"] = error.offset
+
+        response = JsonResponse(content, status=error.status)
+        if isinstance(error, UploadOffsetMismatch):
+            response["Upload-Offset"] = str(error.offset)
+        return response
+
+    def post(self, request, token=None):
+        if token is not None:
+            return self.http_method_not_allowed(request)
+
+        try:
+            data = json.loads(request.body)
+            file_name = str(data["file_name"])
+            size = int(data["size"])
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({"error": "file_name and size are required"}, status=400)
+
+        try:
+            upload = create_resumable_upload(file_name, size, data.get("content_type"))
+        except ResumableUploadError as error:
+            return self.respond_error(error)
+
+        response = self.respond(upload, status=201)
+        response["Location"] = self.get_location(upload)
+        return response
+
+    def get(self, request, token=None):
+        return self.respond(self.get_upload(token))
+
+    def put(self, request, token=None):
+        upload = self.get_upload(token)
+        if upload.completed:
+            return self.respond(upload)
+
+        match = CONTENT_RANGE_RE.match(request.headers.get("Content-Range", ""))
+        if match is None:
+            # An empty body says bytes */size
+            if request.headers.get("Content-Range") == f"bytes */{upload.size}":
+                start, end = upload.offset, upload.offset - 1
+            else:
+                return JsonResponse({"error": "Content-Range is required"}, status=400)
+        else:
+            start, end, total = (int(value) for value in match.groups())
+            if total != upload.size:
+                return JsonResponse({"error": "Content-Range does not match the file size"}, status=400)
+
+        try:
+            upload = append_to_upload(upload, request, start, end)
+
+            if upload.offset == upload.size:
+                complete_resumable_upload(upload)
+        except ResumableUploadError as error:
+            return self.respond_error(error)
+
+        return self.respond(upload)
+
+    def delete(self, request, token=None):
+        abort_resumable_upload(self.get_upload(token))
+        return HttpResponse(status=204)